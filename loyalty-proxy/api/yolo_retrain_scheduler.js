@@ -104,6 +104,8 @@ async function runRetrain() {
     const yoloWrapper = require('../ml/yolo-wrapper');
 
     // 1. Экспорт тренировочных данных
+    // Каталог экспорта сохраняется между запусками: экспорт инкрементальный
+    // (дописывает новые сэмплы, убирает удалённые) — не удалять после обучения
     const exportDir = path.join(ML_DIR, 'retrain-dataset');
     const exportResult = await yoloWrapper.exportTrainingData(exportDir);
 
@@ -112,6 +114,15 @@ async function runRetrain() {
     }
 
     console.log(`[YOLO Retrain] Экспорт завершён: ${exportResult.total_images || exportResult.train_images} train / ${exportResult.val_images} val`);
+    if (exportResult.dedup) {
+      const dd = exportResult.dedup;
+      console.log(`[YOLO Retrain] Дубли: ${dd.before} → ${dd.after} изображений (${dd.duplicateClusters} кластеров дублей, крупнейший ${dd.largestCluster})` +
+        (dd.estimatedSecondsSavedPerEpoch != null ? `, экономия ~${dd.estimatedSecondsSavedPerEpoch}с на эпоху` : ''));
+    }
+    if (exportResult.resize_cache) {
+      const rc = exportResult.resize_cache;
+      console.log(`[YOLO Retrain] Кэш уменьшенных изображений (${rc.imgsz}px): hit rate ${rc.hitRate} (${rc.hits} hit / ${rc.misses} miss), ${rc.seconds}с`);
+    }
 
     // 2. Бэкап текущей модели
     const modelPath = yoloWrapper.DEFAULT_MODEL;
@@ -123,12 +134,21 @@ async function runRetrain() {
 
     // 3. Обучение
     const dataYaml = path.join(exportDir, 'data.yaml');
-    const trainResult = await yoloWrapper.trainModel(dataYaml, 100);
+    // Есть рабочая модель → дообучение (короткое, с продолжением после сбоя)
+    const trainResult = await fileExists(modelPath)
+      ? await yoloWrapper.fineTuneModel(dataYaml)
+      : await yoloWrapper.trainModel(dataYaml, 100);
 
     const duration = Math.round((Date.now() - startTime) / 1000);
 
     if (trainResult.success) {
       console.log(`[YOLO Retrain] Обучение завершено за ${duration}с. Модель: ${trainResult.model_path}`);
+      if (trainResult.time_saved_seconds != null) {
+        console.log(`[YOLO Retrain] Дообучение${trainResult.resumed ? ' (продолжено)' : ''}: ${trainResult.wall_seconds}с, экономия ~${trainResult.time_saved_seconds}с против обучения с нуля (${trainResult.scratch_seconds_source})`);
+      }
+      if (trainResult.epoch_seconds_mean) {
+        console.log(`[YOLO Retrain] Среднее время эпохи: ${trainResult.epoch_seconds_mean}с (${trainResult.epochs_run} эпох)`);
+      }
 
       // Обновляем state
       state.lastTrainedAt = new Date().toISOString();
@@ -167,14 +187,7 @@ async function runRetrain() {
 
     await saveState(state);
 
-    // 4. Очистка temp dataset
-    try {
-      await fsp.rm(exportDir, { recursive: true, force: true });
-    } catch (e) {
-      console.warn('[YOLO Retrain] Не удалось очистить temp dataset:', e.message);
-    }
-
-    // 5. Очистка старых бэкапов (оставляем 3 последних)
+    // 4. Очистка старых бэкапов (оставляем 3 последних)
     try {
       const modelsDir = yoloWrapper.MODELS_DIR;
       if (await fileExists(modelsDir)) {
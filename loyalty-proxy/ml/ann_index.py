@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+IVF approximate nearest-neighbour index for L2-normalized embeddings.
+
+Coarse quantizer: spherical k-means (cosine) with `nlist` cells.
+Each vector lives in the cell of its nearest centroid; a query scans only
+the `nprobe` cells closest to it (the recall/speed knob: nprobe=nlist is
+exact search).
+
+Vectors added after training go to a small unsorted tail that every query
+scans exhaustively; the tail is merged into the cell-sorted main arrays
+once it grows past a fraction of the index. Removals are tombstones.
+
+Vectors may be stored as float16 to halve memory; similarities are always
+computed in float32.
+
+Persistence: one .npz file (see save/load).
+"""
+import numpy as np
+
+DEFAULT_NPROBE = 8
+TAIL_COMPACT_RATIO = 0.05   # merge tail when it exceeds 5% of the main arrays
+TRAIN_SAMPLES_PER_LIST = 64
+
+
+def default_nlist(num_vectors):
+    """Cells for a given catalog size (~4 * sqrt(N), at least 1)"""
+    return max(1, min(num_vectors, int(4 * np.sqrt(max(num_vectors, 1)))))
+
+
+def _assign(vectors, centroids, chunk=8192):
+    """Nearest centroid (max cosine) for each row, in chunks to bound memory"""
+    out = np.empty(len(vectors), dtype=np.int32)
+    for i in range(0, len(vectors), chunk):
+        out[i:i + chunk] = np.argmax(vectors[i:i + chunk] @ centroids.T, axis=1)
+    return out
+
+
+def spherical_kmeans(vectors, k, iterations=20, seed=0):
+    """
+    k-means on the unit sphere (cosine similarity).
+
+    Returns:
+        (k, D) float32 L2-normalized centroids
+    """
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), size=k, replace=False)].copy()
+
+    for _ in range(iterations):
+        assign = _assign(vectors, centroids)
+        order = np.argsort(assign, kind='stable')
+        counts = np.bincount(assign, minlength=k)
+        nonempty = np.flatnonzero(counts)
+        starts = (np.cumsum(counts) - counts)[nonempty]
+        sums = np.add.reduceat(vectors[order], starts, axis=0)
+
+        new_centroids = centroids.copy()
+        new_centroids[nonempty] = sums
+        # Re-seed empty cells with random vectors
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            new_centroids[empty] = vectors[rng.choice(len(vectors), size=len(empty), replace=False)]
+
+        norms = np.linalg.norm(new_centroids, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        new_centroids /= norms
+
+        if np.allclose(new_centroids, centroids, atol=1e-5):
+            centroids = new_centroids
+            break
+        centroids = new_centroids
+
+    return centroids.astype(np.float32)
+
+
+class IVFIndex:
+    """Inverted-file index over labeled vectors (labels are product ids)"""
+
+    def __init__(self, centroids, nprobe=DEFAULT_NPROBE, dtype=np.float32):
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.nprobe = nprobe
+        self.dtype = np.dtype(dtype)
+        dim = self.centroids.shape[1]
+
+        # Main arrays, sorted by cell: cell c is rows offsets[c]:offsets[c + 1]
+        self.vectors = np.empty((0, dim), dtype=self.dtype)
+        self.codes = np.empty(0, dtype=np.int32)       # label code per row
+        self.alive = np.empty(0, dtype=bool)
+        self.offsets = np.zeros(len(self.centroids) + 1, dtype=np.int64)
+
+        # Unsorted tail of recent inserts
+        self._tail_vectors = []
+        self._tail_codes = []
+        self._tail_cache = None
+
+        self.labels = []          # code -> label
+        self._label_codes = {}    # label -> code
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    @property
+    def dim(self):
+        return self.centroids.shape[1]
+
+    def __len__(self):
+        return int(self.alive.sum()) + len(self._tail_codes)
+
+    @property
+    def nbytes(self):
+        """Resident size of the index arrays"""
+        return (self.centroids.nbytes + self.vectors.nbytes + self.codes.nbytes
+                + self.alive.nbytes + self.offsets.nbytes + len(self._tail_codes) * (self.dim * 4 + 4))
+
+    @classmethod
+    def train(cls, vectors, nlist=None, nprobe=DEFAULT_NPROBE, seed=0, dtype=np.float32):
+        """Train the coarse quantizer on (a sample of) the given vectors"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        nlist = min(nlist or default_nlist(len(vectors)), len(vectors))
+        rng = np.random.default_rng(seed)
+        max_train = nlist * TRAIN_SAMPLES_PER_LIST
+        sample = vectors if len(vectors) <= max_train else vectors[rng.choice(len(vectors), max_train, replace=False)]
+        return cls(spherical_kmeans(sample, nlist, seed=seed), nprobe, dtype)
+
+    def _code(self, label):
+        code = self._label_codes.get(label)
+        if code is None:
+            code = len(self.labels)
+            self.labels.append(label)
+            self._label_codes[label] = code
+        return code
+
+    def add(self, vectors, labels):
+        """Insert vectors (rows, L2-normalized) with their labels"""
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        for vec, label in zip(vectors, labels):
+            self._tail_vectors.append(vec)
+            self._tail_codes.append(self._code(label))
+        self._tail_cache = None
+
+        if len(self._tail_codes) > max(256, TAIL_COMPACT_RATIO * len(self.codes)):
+            self.compact()
+
+    def remove_label(self, label):
+        """Drop every vector with this label (tombstone)"""
+        code = self._label_codes.get(label)
+        if code is None:
+            return
+        self.alive[self.codes == code] = False
+        keep = [i for i, c in enumerate(self._tail_codes) if c != code]
+        self._tail_vectors = [self._tail_vectors[i] for i in keep]
+        self._tail_codes = [self._tail_codes[i] for i in keep]
+        self._tail_cache = None
+
+    def compact(self):
+        """Merge tail into the cell-sorted main arrays and drop tombstones"""
+        keep = self.alive
+        vectors = self.vectors[keep]
+        codes = self.codes[keep]
+
+        if self._tail_codes:
+            vectors = np.concatenate([vectors, np.array(self._tail_vectors, dtype=self.dtype)])
+            codes = np.concatenate([codes, np.array(self._tail_codes, dtype=np.int32)])
+
+        cells = _assign(vectors, self.centroids) if len(vectors) else np.empty(0, dtype=np.int32)
+        order = np.argsort(cells, kind='stable')
+        self.vectors = np.ascontiguousarray(vectors[order])
+        self.codes = codes[order]
+        self.alive = np.ones(len(self.codes), dtype=bool)
+        counts = np.bincount(cells, minlength=self.nlist)
+        self.offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+        self._tail_vectors = []
+        self._tail_codes = []
+        self._tail_cache = None
+
+    def _tail(self):
+        if self._tail_cache is None:
+            if self._tail_codes:
+                self._tail_cache = (np.array(self._tail_vectors, dtype=np.float32),
+                                    np.array(self._tail_codes, dtype=np.int32))
+            else:
+                self._tail_cache = (np.empty((0, self.dim), dtype=np.float32), np.empty(0, dtype=np.int32))
+        return self._tail_cache
+
+    def search(self, queries, k=10, nprobe=None):
+        """
+        Approximate k nearest vectors per query.
+
+        Args:
+            queries: (Q, D) L2-normalized float32
+            k: neighbours per query
+            nprobe: cells scanned per query (default self.nprobe)
+
+        Returns:
+            (codes, similarities) — (Q, k) arrays, best first; code -1 = no result.
+            Map codes to labels with self.labels.
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        tail_vectors, tail_codes = self._tail()
+
+        out_codes = np.full((len(queries), k), -1, dtype=np.int64)
+        out_sims = np.full((len(queries), k), -np.inf, dtype=np.float32)
+
+        coarse = queries @ self.centroids.T
+        if nprobe < self.nlist:
+            probes = np.argpartition(-coarse, nprobe - 1, axis=1)[:, :nprobe]
+        else:
+            probes = np.broadcast_to(np.arange(self.nlist), coarse.shape)
+
+        for i, q in enumerate(queries):
+            starts = self.offsets[probes[i]]
+            lengths = self.offsets[probes[i] + 1] - starts
+            rows = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(int(lengths.sum()))
+            rows = rows[self.alive[rows]]
+
+            sims = np.concatenate([self.vectors[rows].astype(np.float32, copy=False) @ q, tail_vectors @ q])
+            codes = np.concatenate([self.codes[rows], tail_codes])
+            if len(sims) == 0:
+                continue
+
+            n = min(k, len(sims))
+            top = np.argpartition(-sims, n - 1)[:n] if n < len(sims) else np.arange(len(sims))
+            top = top[np.argsort(-sims[top], kind='stable')]
+            out_codes[i, :n] = codes[top]
+            out_sims[i, :n] = sims[top]
+
+        return out_codes, out_sims
+
+    def save(self, path):
+        """Persist index (tail is merged first)"""
+        self.compact()
+        # np.savez appends .npz unless the name already ends with it
+        with open(path, 'wb') as f:
+            np.savez(
+                f,
+                centroids=self.centroids,
+                vectors=self.vectors,
+                codes=self.codes,
+                offsets=self.offsets,
+                labels=np.array(self.labels, dtype=str),
+                nprobe=np.array(self.nprobe),
+            )
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls.from_arrays(data['centroids'], data['vectors'], data['codes'], data['offsets'],
+                               data['labels'].tolist(), int(data['nprobe']))
+
+    @classmethod
+    def from_arrays(cls, centroids, vectors, codes, offsets, labels, nprobe=DEFAULT_NPROBE):
+        """Wrap existing (e.g. memory-mapped) compacted arrays without copying them"""
+        index = cls(centroids, nprobe, vectors.dtype)
+        index.vectors = vectors
+        index.codes = codes
+        index.offsets = offsets
+        index.alive = np.ones(len(codes), dtype=bool)
+        index.labels = list(labels)
+        index._label_codes = {label: code for code, label in enumerate(index.labels)}
+        return index
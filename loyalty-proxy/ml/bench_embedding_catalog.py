@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for embedding_catalog search.
+
+Fills the catalog with random L2-normalized vectors (no model, no disk I/O)
+and compares the old full-argsort search against search_batch with partial
+top-k selection, one query at a time and in batches.
+
+With --ann, benchmarks the IVF index instead: recall@1 against exact search
+and queries/sec for several nprobe values, on clustered synthetic vectors
+(products x packaging variants x per-photo noise, like real catalogs).
+
+Usage:
+  python3 bench_embedding_catalog.py [--sizes 1000 10000 100000] [--queries 64] [--top-k 1]
+  python3 bench_embedding_catalog.py --ann [--sizes 10000 100000 300000] [--nprobe 1 4 8 16 32]
+"""
+import sys
+import time
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+SCRIPT_DIR = Path(__file__).parent
+sys.path.insert(0, str(SCRIPT_DIR))
+
+import embedding_catalog as catalog
+from ann_index import IVFIndex
+
+DIM = 576
+
+
+def random_unit_vectors(n, dim=DIM, seed=0):
+    """Random L2-normalized float32 vectors"""
+    rng = np.random.default_rng(seed)
+    vectors = rng.standard_normal((n, dim)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def fill_catalog(rows):
+    """Install a synthetic search matrix directly, bypassing the JSON catalog"""
+    catalog._catalog = {'version': 1, 'products': {}}
+    ids = [f'bench_{i}' for i in range(rows)]
+    catalog._state = catalog._EMPTY._replace(matrix=random_unit_vectors(rows, seed=1), product_ids=ids,
+                                             row_of={pid: i for i, pid in enumerate(ids)})
+
+
+def argsort_search(query, top_k, threshold):
+    """Reference: the previous full-argsort implementation"""
+    similarities = (catalog.snapshot().matrix @ query.reshape(-1, 1)).flatten()
+    indices = np.argsort(similarities)[::-1][:top_k]
+    return [int(i) for i in indices if similarities[i] >= threshold]
+
+
+def timeit(fn, repeat):
+    """Best-of-3 mean time per call, in milliseconds"""
+    best = float('inf')
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            fn()
+        best = min(best, (time.perf_counter() - start) / repeat)
+    return best * 1000
+
+
+def bench_size(rows, num_queries, top_k, threshold):
+    fill_catalog(rows)
+    queries = random_unit_vectors(num_queries, seed=2)
+    repeat = max(1, 20000 // rows)
+
+    def old_single():
+        for q in queries:
+            argsort_search(q, top_k, threshold)
+
+    def new_single():
+        for q in queries:
+            catalog.search_batch(q, top_k, threshold)
+
+    def new_batch():
+        catalog.search_batch(queries, top_k, threshold)
+
+    # Sanity: partial selection returns the same best match as argsort
+    indices, _ = catalog.search_batch(queries, top_k, -1.0)
+    for q, row in zip(queries, indices):
+        assert argsort_search(q, 1, -1.0)[0] == row[0]
+
+    old_ms = timeit(old_single, repeat) / num_queries
+    single_ms = timeit(new_single, repeat) / num_queries
+    batch_ms = timeit(new_batch, repeat) / num_queries
+
+    print(f"[Bench] rows={rows:>7}  argsort={old_ms:8.3f} ms/q  "
+          f"search_batch(1)={single_ms:8.3f} ms/q  "
+          f"search_batch({num_queries})={batch_ms:8.3f} ms/q  "
+          f"speedup={old_ms / batch_ms:5.1f}x")
+
+
+def clustered_vectors(n, seed=0, samples_per_product=20, noise=1.6):
+    """Per-sample embeddings: product centers, 3 variants each, noisy shots"""
+    rng = np.random.default_rng(seed)
+    products = max(1, n // samples_per_product)
+    variants = 0.6 * random_unit_vectors(products * 3, seed=seed) \
+        + np.repeat(random_unit_vectors(products, seed=seed + 1), 3, axis=0)
+    owner = rng.integers(0, products * 3, size=n)
+    vectors = variants[owner] + noise * rng.standard_normal((n, DIM)).astype(np.float32) / np.sqrt(DIM)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors.astype(np.float32), owner // 3
+
+
+def bench_ann(rows, num_queries, nprobes):
+    vectors, labels = clustered_vectors(rows + num_queries, seed=3)
+    base, queries = vectors[:rows], vectors[rows:]
+
+    start = time.perf_counter()
+    index = IVFIndex.train(base)
+    index.add(base, labels[:rows].tolist())
+    index.compact()
+    build_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    exact = np.argmax(queries @ base.T, axis=1)
+    exact_qps = num_queries / (time.perf_counter() - start)
+    exact_labels = labels[:rows][exact]
+
+    print(f"[Bench] rows={rows:>7}  nlist={index.nlist}  build={build_s:6.2f} s  exact={exact_qps:9.0f} q/s (batched)")
+    for nprobe in nprobes:
+        start = time.perf_counter()
+        codes, _ = index.search(queries, k=1, nprobe=nprobe)
+        qps = num_queries / (time.perf_counter() - start)
+        found = np.array([int(index.labels[c]) if c >= 0 else -1 for c in codes[:, 0]])
+        recall = float(np.mean(found == exact_labels))
+        print(f"[Bench]          nprobe={nprobe:>4}  recall@1={recall:.4f}  {qps:9.0f} q/s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark embedding catalog search')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='Catalog sizes (rows in the search matrix)')
+    parser.add_argument('--queries', type=int, default=64, help='Queries per batch (crops per photo)')
+    parser.add_argument('--top-k', type=int, default=1, help='top_k passed to search')
+    parser.add_argument('--threshold', type=float, default=0.0, help='Similarity threshold')
+    parser.add_argument('--ann', action='store_true', help='Benchmark the IVF index (recall@1, q/s)')
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 4, 8, 16, 32],
+                        help='nprobe values for --ann')
+    args = parser.parse_args()
+
+    if args.ann:
+        print(f"[Bench] IVF index, dim={DIM}, queries={args.queries} (recall@1 = same product as exact top-1)")
+        for rows in args.sizes:
+            bench_ann(rows, args.queries, args.nprobe)
+    else:
+        print(f"[Bench] dim={DIM}, queries={args.queries}, top_k={args.top_k}")
+        for rows in args.sizes:
+            bench_size(rows, args.queries, args.top_k, args.threshold)
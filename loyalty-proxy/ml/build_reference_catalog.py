@@ -6,26 +6,57 @@ Reads labeled training images (display-training + counting-training),
 crops bounding boxes, computes MobileNetV3-Small embeddings,
 and saves to embedding catalog.
 
+Pipeline: a pool of decode workers reads images, crops boxes and applies
+the embedder transform; a bounded prefetch window keeps at most --prefetch
+images in flight; the main thread embeds crops --batch-size at a time.
+Crops reach the catalog in the same order as a serial build, so the result
+has the same products, samples and prototypes. The default --batch-size 1
+embeds every crop in its own forward pass, bit-identical to per-crop
+embedding. Larger batches are faster but may change the last float bits
+depending on the backend; --verify N embeds the first N crops at the
+requested batch size and aborts the build on any difference.
+
+Incremental: a manifest (build_manifest.json) records every processed
+sample's image and label hash (taken from the training manifest,
+training_manifest.py) plus the embedder version, and the crop
+embeddings are cached (build_embeddings.npz). Re-runs embed only new or
+changed samples and drop embeddings of deleted samples; --full rebuilds.
+
 Usage:
-  python3 build_reference_catalog.py [--dry-run]
+  python3 build_reference_catalog.py [--dry-run] [--ann] [--full]
+  python3 build_reference_catalog.py --workers 8 --batch-size 64 --threads 4 --verify 200
 """
 import os
 import sys
 import json
+import time
+import hashlib
 import argparse
+from collections import deque
 from pathlib import Path
 
+import numpy as np
+
 SCRIPT_DIR = Path(__file__).parent
 sys.path.insert(0, str(SCRIPT_DIR))
 
 DATA_DIR = SCRIPT_DIR.parent / 'data'
 CLASS_MAPPING_FILE = DATA_DIR / 'class-mapping.json'
+MANIFEST_FILE = DATA_DIR / 'embedding-catalog' / 'build_manifest.json'
+EMBEDDINGS_CACHE_FILE = DATA_DIR / 'embedding-catalog' / 'build_embeddings.npz'
+
+# Bump when the embedder or its preprocessing changes: cached embeddings become invalid
+EMBEDDER_VERSION = 'mobilenet_v3_small/IMAGENET1K_V1/224/l2'
 
 TRAINING_DIRS = [
     DATA_DIR / 'display-training',
     DATA_DIR / 'counting-training',
 ]
 
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1)
+DEFAULT_BATCH_SIZE = 1   # bit-exact; larger batches need --verify
+PROGRESS_EVERY = 500   # images
+
 
 def load_class_mapping():
     """Load class mapping: productId -> classId"""
@@ -74,20 +105,13 @@ def parse_yolo_label(label_path, img_width, img_height):
     return boxes
 
 
-def build_catalog(dry_run=False):
-    """Build reference catalog from training data"""
-    from PIL import Image
-
-    # Import after path setup
-    import embedding_catalog as catalog
-
-    mapping, inverted = load_class_mapping()
-    if not inverted:
-        print("[Build] No class mapping — cannot map class IDs to product IDs")
-        return
+def load_embedder():
+    """
+    Load MobileNetV3-Small feature extractor (same setup as yolo_server).
 
-    # Load embedding model
-    print("[Build] Loading MobileNetV3-Small...")
+    Returns:
+        (net, transform)
+    """
     import torch
     import torchvision.transforms as T
     from torchvision.models import mobilenet_v3_small, MobileNet_V3_Small_Weights
@@ -102,86 +126,465 @@ def build_catalog(dry_run=False):
         T.ToTensor(),
         T.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
     ])
+    return net, transform
 
-    print("[Build] Model loaded")
 
-    # Load or create catalog
-    catalog.load()
-    stats_before = catalog.get_stats()
-    print(f"[Build] Catalog before: {stats_before['productCount']} products, {stats_before['totalEmbeddings']} embeddings")
+def embed_crop(net, transform, crop):
+    """Compute L2-normalized 576-dim embedding (numpy) for one PIL crop"""
+    import torch
 
-    total_added = 0
-    total_errors = 0
-    total_images = 0
+    tensor = transform(crop).unsqueeze(0)
+    with torch.no_grad():
+        features = net(tensor)
+
+    emb = features.squeeze().numpy()
+    norm = float((emb ** 2).sum() ** 0.5)
+    if norm > 0:
+        emb = emb / norm
+    return emb
+
+
+def embed_batch(net, tensors):
+    """
+    Embed a batch of transformed crops in one forward pass.
+
+    Args:
+        tensors: list of (3, 224, 224) tensors from the embedder transform
+
+    Returns:
+        (n, 576) float32 numpy array, rows L2-normalized
+    """
+    import torch
+
+    with torch.no_grad():
+        features = net(torch.stack(tensors)).numpy().reshape(len(tensors), -1)
+
+    norms = (features ** 2).sum(axis=1, keepdims=True) ** 0.5
+    norms[norms == 0] = 1
+    return features / norms
+
+
+def labeled_samples():
+    """
+    Labeled training images from the training manifest (refreshed first).
+
+    Returns:
+        list of manifest rows (dicts with image/label Paths, size, mtime_ns,
+        sha1, label_size, label_mtime_ns, label_sha1), in deterministic order
+    """
+    import training_manifest
 
+    sources = [(train_dir, 'images', 'labels') for train_dir in TRAINING_DIRS]
+    rows = training_manifest.training_images(sources, labeled_only=True)
     for train_dir in TRAINING_DIRS:
-        images_dir = train_dir / 'images'
-        labels_dir = train_dir / 'labels'
+        count = sum(1 for row in rows if row['source'] == train_dir.name)
+        print(f"[Build] {train_dir.name}: {count} labeled images")
+    return rows
 
-        if not images_dir.exists() or not labels_dir.exists():
-            print(f"[Build] Skipping {train_dir.name} — no images/labels dirs")
-            continue
 
-        print(f"\n[Build] Processing {train_dir.name}...")
+def iter_labeled_images(rows=None):
+    """
+    Yield (train_dir, label_file, img_path) for every labeled training image,
+    in deterministic order.
+    """
+    for row in (rows if rows is not None else labeled_samples()):
+        yield DATA_DIR / row['source'], row['label'], row['image']
 
-        # Find all label files
-        label_files = sorted(labels_dir.glob('*.txt'))
-        print(f"[Build] Found {len(label_files)} label files")
 
-        for label_file in label_files:
-            # Find corresponding image
-            stem = label_file.stem
-            img_path = None
-            for ext in ['.jpg', '.jpeg', '.png']:
-                candidate = images_dir / f"{stem}{ext}"
-                if candidate.exists():
-                    img_path = candidate
-                    break
+def load_crops(img_path, label_file, inverted):
+    """
+    Crop every labeled box of one image.
 
-            if img_path is None:
-                continue
+    Returns:
+        list of (product_id, PIL crop) — boxes with unmapped classes are skipped
+    """
+    from PIL import Image
 
-            total_images += 1
+    img = Image.open(img_path).convert('RGB')
+    img_w, img_h = img.size
 
-            try:
-                img = Image.open(img_path).convert('RGB')
-                img_w, img_h = img.size
+    crops = []
+    for cls_id, x1, y1, x2, y2 in parse_yolo_label(label_file, img_w, img_h):
+        product_id = inverted.get(cls_id)
+        if not product_id:
+            continue
+        crops.append((product_id, img.crop((x1, y1, x2, y2))))
+    return crops
 
-                boxes = parse_yolo_label(label_file, img_w, img_h)
 
-                for cls_id, x1, y1, x2, y2 in boxes:
-                    product_id = inverted.get(cls_id)
-                    if not product_id:
-                        continue
+def _decode_image(img_path, label_file, inverted, transform):
+    """Worker: crops of one image as (product_id, tensor) pairs, plus busy time"""
+    start = time.perf_counter()
+    try:
+        crops = [(pid, transform(crop)) for pid, crop in load_crops(img_path, label_file, inverted)]
+        return crops, None, time.perf_counter() - start
+    except Exception as e:
+        return None, e, time.perf_counter() - start
 
-                    crop = img.crop((x1, y1, x2, y2))
 
-                    # Compute embedding
-                    tensor = transform(crop).unsqueeze(0)
-                    with torch.no_grad():
-                        features = net(tensor)
+def new_pipeline_stats(workers, batch_size):
+    return {'workers': workers, 'batchSize': batch_size, 'images': 0, 'crops': 0, 'errors': 0,
+            'batches': 0, 'decodeBusy': 0.0, 'embedBusy': 0.0, 'embedWait': 0.0, 'start': time.perf_counter()}
 
-                    emb = features.squeeze().numpy()
-                    norm = float((emb ** 2).sum() ** 0.5)
-                    if norm > 0:
-                        emb = emb / norm
 
-                    if not dry_run:
-                        catalog.add_embedding(product_id, emb.tolist(), name='')
+def iter_embedded_images(inverted, net, transform, workers=DEFAULT_WORKERS, batch_size=DEFAULT_BATCH_SIZE,
+                         prefetch=None, stats=None, images=None):
+    """
+    Decode images in a worker pool and embed their crops in fixed-size batches.
 
-                    total_added += 1
+    Yields, in the same order as iter_labeled_images():
+        (train_dir, label_file, img_path, [(product_id, embedding)], error)
+    where error is the exception that stopped the image (then no embeddings).
 
-            except Exception as e:
+    Args:
+        prefetch: max images decoded ahead of the embedder (default 4 * workers)
+        stats: dict from new_pipeline_stats(), updated in place
+        images: iterable of (train_dir, label_file, img_path) (default: all labeled images)
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    images = iter(images if images is not None else iter_labeled_images())
+    prefetch = prefetch or 4 * workers
+    stats = stats if stats is not None else new_pipeline_stats(workers, batch_size)
+
+    in_flight = deque()     # (meta, future) — decode submitted, not yet consumed
+    waiting = deque()       # [meta, results, error, remaining] — decoded, awaiting embeddings
+    crop_queue = deque()    # (waiting entry, product_id, tensor)
+
+    def flush(limit):
+        """Embed up to `limit` queued crops, then hand back completed images in order"""
+        if crop_queue and limit:
+            chunk = [crop_queue.popleft() for _ in range(min(limit, len(crop_queue)))]
+            start = time.perf_counter()
+            vectors = embed_batch(net, [tensor for _, _, tensor in chunk])
+            stats['embedBusy'] += time.perf_counter() - start
+            stats['batches'] += 1
+            for (entry, pid, _), emb in zip(chunk, vectors):
+                entry[1].append((pid, emb))
+                entry[3] -= 1
+        while waiting and waiting[0][3] == 0:
+            meta, results, error, _ = waiting.popleft()
+            yield (*meta, results, error)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        def top_up():
+            while len(in_flight) < prefetch:
+                meta = next(images, None)
+                if meta is None:
+                    return
+                in_flight.append((meta, pool.submit(_decode_image, meta[2], meta[1], inverted, transform)))
+
+        top_up()
+        while in_flight:
+            meta, future = in_flight.popleft()
+            start = time.perf_counter()
+            crops, error, busy = future.result()
+            stats['embedWait'] += time.perf_counter() - start
+            stats['decodeBusy'] += busy
+            top_up()
+
+            stats['images'] += 1
+            if error is not None:
+                stats['errors'] += 1
+                waiting.append([meta, [], error, 0])
+            else:
+                entry = [meta, [], None, len(crops)]
+                waiting.append(entry)
+                crop_queue.extend((entry, pid, tensor) for pid, tensor in crops)
+                stats['crops'] += len(crops)
+
+            while len(crop_queue) >= batch_size:
+                yield from flush(batch_size)
+            yield from flush(0)
+
+            if stats['images'] % PROGRESS_EVERY == 0:
+                print_pipeline_progress(stats)
+
+        while crop_queue:
+            yield from flush(batch_size)
+        yield from flush(0)
+
+
+def print_pipeline_progress(stats):
+    elapsed = max(time.perf_counter() - stats['start'], 1e-9)
+    print(f"[Build] {stats['images']} images, {stats['crops']} crops, "
+          f"{stats['crops'] / elapsed:.1f} crops/s")
+
+
+def pipeline_report(stats):
+    """Throughput and stage utilization of a finished pipeline run"""
+    elapsed = max(time.perf_counter() - stats['start'], 1e-9)
+    return {
+        'seconds': round(elapsed, 2),
+        'images': stats['images'],
+        'crops': stats['crops'],
+        'errors': stats['errors'],
+        'batches': stats['batches'],
+        'imagesPerSec': round(stats['images'] / elapsed, 1),
+        'cropsPerSec': round(stats['crops'] / elapsed, 1),
+        # Share of worker capacity spent decoding/cropping/transforming
+        'decodeUtilization': round(stats['decodeBusy'] / (elapsed * stats['workers']), 3),
+        # Share of wall time the embedder was running / starved waiting for decodes
+        'embedUtilization': round(stats['embedBusy'] / elapsed, 3),
+        'embedStarved': round(stats['embedWait'] / elapsed, 3),
+    }
+
+
+def verify_batched(net, transform, inverted, count, batch_size=DEFAULT_BATCH_SIZE):
+    """Max abs difference between batch_size-batched and per-crop embeddings on the first `count` crops"""
+    tensors, crops = [], []
+    for _, label_file, img_path in iter_labeled_images():
+        for _, crop in load_crops(img_path, label_file, inverted):
+            crops.append(crop)
+            tensors.append(transform(crop))
+            if len(crops) >= count:
+                break
+        if len(crops) >= count:
+            break
+    if not crops:
+        return 0.0
+    batched = np.concatenate([embed_batch(net, tensors[i:i + batch_size])
+                              for i in range(0, len(tensors), batch_size)])
+    serial = [embed_crop(net, transform, crop) for crop in crops]
+    return float(max(abs(b - s).max() for b, s in zip(batched, serial)))
+
+
+def _sample_key(img_path):
+    """Manifest key: image path relative to the data dir"""
+    return str(Path(img_path).relative_to(DATA_DIR))
+
+
+def mapping_hash(mapping):
+    return hashlib.sha1(json.dumps(mapping, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def load_manifest():
+    """
+    Load the processed-sample manifest and its cached crop embeddings.
+
+    Returns:
+        (manifest dict or None, cache dict: sample key -> (product_ids, (n, 576) float32))
+    """
+    if not MANIFEST_FILE.exists():
+        return None, {}
+    try:
+        with open(MANIFEST_FILE) as f:
+            manifest = json.load(f)
+        cache = {}
+        if EMBEDDINGS_CACHE_FILE.exists():
+            data = np.load(EMBEDDINGS_CACHE_FILE)
+            keys, pids, vectors = data['keys'].tolist(), data['product_ids'].tolist(), data['vectors']
+            start = 0
+            while start < len(keys):
+                end = start
+                while end < len(keys) and keys[end] == keys[start]:
+                    end += 1
+                cache[keys[start]] = (pids[start:end], vectors[start:end])
+                start = end
+        return manifest, cache
+    except Exception as e:
+        print(f"[Build] Unreadable manifest, doing a full build: {e}")
+        return None, {}
+
+
+def save_manifest(entries, cache, mapping_digest):
+    """Write manifest + embedding cache (temp files, then rename)"""
+    MANIFEST_FILE.parent.mkdir(parents=True, exist_ok=True)
+    keys, pids, vectors = [], [], []
+    for key in entries:
+        sample_pids, sample_vectors = cache.get(key, ([], None))
+        keys.extend([key] * len(sample_pids))
+        pids.extend(sample_pids)
+        if len(sample_pids):
+            vectors.append(sample_vectors)
+
+    tmp_cache = EMBEDDINGS_CACHE_FILE.with_name(EMBEDDINGS_CACHE_FILE.name + '.tmp')
+    with open(tmp_cache, 'wb') as f:
+        np.savez(f, keys=np.array(keys, dtype=str), product_ids=np.array(pids, dtype=str),
+                 vectors=np.concatenate(vectors).astype(np.float32) if vectors
+                 else np.empty((0, 576), dtype=np.float32))
+    os.replace(tmp_cache, EMBEDDINGS_CACHE_FILE)
+
+    tmp_manifest = MANIFEST_FILE.with_name(MANIFEST_FILE.name + '.tmp')
+    with open(tmp_manifest, 'w') as f:
+        json.dump({'embedderVersion': EMBEDDER_VERSION, 'mappingHash': mapping_digest, 'entries': entries}, f)
+    os.replace(tmp_manifest, MANIFEST_FILE)
+
+
+def build_catalog(dry_run=False, build_ann=False, workers=DEFAULT_WORKERS, batch_size=DEFAULT_BATCH_SIZE,
+                  threads=None, prefetch=None, verify=0, full=False):
+    """
+    Build reference catalog from training data.
+
+    Incremental by default: samples whose image and label file are unchanged
+    since the last build (per the manifest) are not embedded again. Products
+    with a changed or deleted sample are rebuilt from cached embeddings in
+    sample order; products that only gained new samples get them appended.
+    A full build (--full, no manifest, new embedder version or class mapping)
+    rebuilds every product that has training samples. A rebuilt product
+    gets its runtime samples (/catalog/add, see runtime_samples) re-added
+    after the training crops. Products that only exist through /catalog/add
+    are never touched.
+    """
+    # Import after path setup
+    import embedding_catalog as catalog
+
+    mapping, inverted = load_class_mapping()
+    if not inverted:
+        print("[Build] No class mapping — cannot map class IDs to product IDs")
+        return
+
+    manifest, cache = load_manifest()
+    mapping_digest = mapping_hash(mapping)
+    old_entries = manifest.get('entries', {}) if manifest else {}
+    old_products = {pid for pids, _ in cache.values() for pid in pids}
+    if full:
+        reason = '--full'
+    elif manifest is None:
+        reason = 'no manifest'
+    elif manifest.get('embedderVersion') != EMBEDDER_VERSION:
+        reason = f"embedder changed ({manifest.get('embedderVersion')} -> {EMBEDDER_VERSION})"
+    elif manifest.get('mappingHash') != mapping_digest:
+        reason = 'class mapping changed'
+    else:
+        reason = None
+    if reason:
+        print(f"[Build] Full build: {reason}")
+        old_entries, cache = {}, {}
+
+    # Classify samples against the manifest
+    entries = {}
+    order = []
+    todo = []
+    new_keys, changed_keys = set(), set()
+    rows = labeled_samples()
+    for row, meta in zip(rows, iter_labeled_images(rows)):
+        key = _sample_key(row['image'])
+        old = old_entries.get(key)
+        # [size, mtime_ns, sha1] — hashed by the training manifest only when a file changed
+        entry = {
+            'image': [row['size'], row['mtime_ns'], row['sha1']],
+            'label': [row['label_size'], row['label_mtime_ns'], row['label_sha1']],
+        }
+        order.append(key)
+        entries[key] = entry
+        if old and key in cache and old['image'][2] == entry['image'][2] and old['label'][2] == entry['label'][2]:
+            continue
+        (changed_keys if key in cache else new_keys).add(key)
+        todo.append(meta)
+
+    seen = set(order)
+    deleted_keys = [key for key in old_entries if key not in seen]
+    skipped = len(order) - len(todo)
+    print(f"[Build] Samples: {len(order)} total, {skipped} unchanged (skipped), {len(new_keys)} new, "
+          f"{len(changed_keys)} changed, {len(deleted_keys)} deleted")
+
+    # Products whose stored samples must be recomputed from scratch
+    if reason:
+        rebuild = set(old_products)
+    else:
+        rebuild = {pid for key in list(changed_keys) + deleted_keys for pid in cache[key][0]}
+    for key in deleted_keys:
+        cache.pop(key, None)
+
+    total_added = 0
+    total_errors = 0
+    report = None
+
+    if todo:
+        # Load embedding model
+        print("[Build] Loading MobileNetV3-Small...")
+        net, transform = load_embedder()
+        if threads:
+            import torch
+            torch.set_num_threads(threads)
+        print("[Build] Model loaded")
+
+        if verify:
+            diff = verify_batched(net, transform, inverted, verify, batch_size)
+            print(f"[Build] Verify: batch {batch_size} vs per-crop embeddings, "
+                  f"max abs diff {diff:.2e} over {verify} crops")
+            if diff > 0:
+                print(f"[Build] Batch {batch_size} is not bit-exact on this backend — aborting, "
+                      f"catalog unchanged (use --batch-size 1)")
+                return False
+        elif batch_size > 1:
+            print(f"[Build] Batch {batch_size} is not verified bit-exact (add --verify N)")
+
+        stats = new_pipeline_stats(workers, batch_size)
+        for _, label_file, img_path, results, error in iter_embedded_images(
+                inverted, net, transform, workers, batch_size, prefetch, stats, todo):
+            key = _sample_key(img_path)
+            if error is not None:
                 total_errors += 1
                 if total_errors <= 5:
-                    print(f"[Build] Error processing {label_file.name}: {e}")
+                    print(f"[Build] Error processing {label_file.name}: {error}")
+                # Not recorded: retried on the next run
+                entries.pop(key, None)
+                if cache.pop(key, None) is not None:
+                    changed_keys.discard(key)
+                new_keys.discard(key)
+                continue
+            pids = [pid for pid, _ in results]
+            vectors = np.array([emb for _, emb in results], dtype=np.float32).reshape(len(results), -1)
+            cache[key] = (pids, vectors)
+            if key in changed_keys or reason:
+                rebuild.update(pids)
+        report = pipeline_report(stats)
+
+    # Load or create catalog
+    catalog.load()
+    stats_before = catalog.get_stats()
+    print(f"[Build] Catalog before: {stats_before['productCount']} products, {stats_before['totalEmbeddings']} embeddings")
+
+    runtime = {}
+    if not dry_run:
+        for pid in rebuild:
+            runtime[pid] = catalog.runtime_samples(pid)
+            catalog.remove_product(pid, rebuild=False)
+
+    # Apply in sample order: every sample of a rebuilt product, plus new samples
+    for key in order:
+        if key not in cache:
+            continue
+        is_new = key in new_keys
+        for pid, emb in zip(*cache[key]):
+            if pid in rebuild or is_new:
+                if not dry_run:
+                    # The builder never searches — skip per-sample index rebuilds;
+                    # a rebuilt product keeps the name set through /catalog/add
+                    name = runtime[pid][0] if pid in runtime else ''
+                    catalog.add_embedding(pid, emb, name=name, rebuild=False, source=catalog.BUILD_SOURCE)
+                total_added += 1
+
+    # Samples added at runtime are not in the training data: put them back
+    restored = 0
+    for pid, (name, samples) in runtime.items():
+        for emb in samples:
+            catalog.add_embedding(pid, emb, name=name, rebuild=False)
+        restored += len(samples)
 
     if not dry_run:
-        catalog.save()
+        if rebuild or total_added or restored or build_ann:
+            catalog.rebuild_index()
+            if build_ann or catalog.has_ann_index():
+                # Rebuild from scratch: evicted samples are dropped, cells re-trained
+                info = catalog.build_ann_index()
+                print(f"[Build] ANN index: {info}")
+            catalog.save()
+        save_manifest({key: entries[key] for key in order if key in entries}, cache, mapping_digest)
 
     stats_after = catalog.get_stats()
     print(f"\n[Build] Done!")
-    print(f"[Build] Processed {total_images} images, added {total_added} embeddings, {total_errors} errors")
+    print(f"[Build] Samples: {skipped} skipped, {len(todo)} processed ({total_errors} errors), "
+          f"{len(deleted_keys)} deleted; {len(rebuild)} products rebuilt, {total_added} embeddings added, "
+          f"{restored} runtime samples restored")
+    if report:
+        print(f"[Build] Pipeline: {report['seconds']} s, {report['imagesPerSec']} images/s, "
+              f"{report['cropsPerSec']} crops/s ({workers} workers, "
+              f"batch {batch_size}, {report['batches']} batches)")
+        print(f"[Build] Utilization: decode workers {report['decodeUtilization']:.0%}, "
+              f"embedder {report['embedUtilization']:.0%}, embedder starved {report['embedStarved']:.0%}")
     print(f"[Build] Catalog after: {stats_after['productCount']} products, {stats_after['totalEmbeddings']} embeddings")
 
     if dry_run:
@@ -191,6 +594,19 @@ def build_catalog(dry_run=False):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Build embedding reference catalog')
     parser.add_argument('--dry-run', action='store_true', help='Do not save catalog')
+    parser.add_argument('--full', action='store_true', help='Ignore the manifest and rebuild every trained product')
+    parser.add_argument('--ann', action='store_true', help='Also build the IVF index (search mode "ann")')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='Decode/crop worker threads')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='Crops per embedder forward pass (1 = bit-exact; verify larger ones with --verify)')
+    parser.add_argument('--threads', type=int, help='torch intra-op threads for the embedder')
+    parser.add_argument('--prefetch', type=int, help='Max images decoded ahead (default 4 x workers)')
+    parser.add_argument('--verify', type=int, default=0, metavar='N',
+                        help='Compare batched vs per-crop embeddings on the first N crops; abort on any difference')
     args = parser.parse_args()
 
-    build_catalog(dry_run=args.dry_run)
+    ok = build_catalog(dry_run=args.dry_run, build_ann=args.ann, workers=max(1, args.workers),
+                       batch_size=max(1, args.batch_size), threads=args.threads, prefetch=args.prefetch,
+                       verify=args.verify, full=args.full)
+    if ok is False:
+        sys.exit(1)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Binary change records for catalog replication.
+
+Every catalog mutation bumps the catalog revision by one and is recorded
+as a change: ('add', revision, product_id, name, vector) or
+('remove', revision, product_id, '', None). Changes are appended to a
+change log next to the catalog on save() and shipped between nodes as a
+delta covering (base, target].
+
+Record:  op u8 | dtype u8 | revision u64 | id_len u16 | name_len u16 | id | name | vector
+         (vector only for 'add': 576 x float32 or float16, per dtype)
+Delta:   b'LCDELTA1' | catalog id (16 bytes) | base u64 | target u64 | count u32 | records
+Log:     b'LCCLOG01' | catalog id (16 bytes) | records
+"""
+import os
+import struct
+import tempfile
+from collections import namedtuple
+
+import numpy as np
+
+DELTA_MAGIC = b'LCDELTA1'
+LOG_MAGIC = b'LCCLOG01'
+
+_RECORD = struct.Struct('<BBQHH')
+_DELTA_HEADER = struct.Struct('<8s16sQQI')
+_LOG_HEADER = struct.Struct('<8s16s')
+
+_OPS = {'add': 1, 'remove': 2}
+_OP_NAMES = {v: k for k, v in _OPS.items()}
+_DTYPES = {0: np.dtype('<f4'), 1: np.dtype('<f2')}
+_DTYPE_CODES = {np.dtype(np.float32): 0, np.dtype(np.float16): 1}
+
+Change = namedtuple('Change', 'op revision product_id name vector')
+
+
+def encode_records(changes):
+    """Serialize changes (any order) to bytes"""
+    parts = []
+    for ch in changes:
+        pid = ch.product_id.encode('utf-8')
+        name = (ch.name or '').encode('utf-8')
+        vector = b''
+        dtype_code = 0
+        if ch.op == 'add':
+            vec = np.asarray(ch.vector)
+            dtype_code = _DTYPE_CODES.get(vec.dtype, 0)
+            vector = np.ascontiguousarray(vec, dtype=_DTYPES[dtype_code]).tobytes()
+        parts.append(_RECORD.pack(_OPS[ch.op], dtype_code, ch.revision, len(pid), len(name)))
+        parts.append(pid)
+        parts.append(name)
+        parts.append(vector)
+    return b''.join(parts)
+
+
+def iter_records(buf, offset, dim, count=None):
+    """
+    Parse records from buf starting at offset.
+
+    Raises:
+        ValueError on truncated or malformed data
+    """
+    n = 0
+    end = len(buf)
+    while offset < end and (count is None or n < count):
+        if offset + _RECORD.size > end:
+            raise ValueError('Truncated change record')
+        op, dtype_code, revision, id_len, name_len = _RECORD.unpack_from(buf, offset)
+        offset += _RECORD.size
+        if op not in _OP_NAMES or dtype_code not in _DTYPES:
+            raise ValueError(f'Unknown change record (op={op}, dtype={dtype_code})')
+
+        pid = bytes(buf[offset:offset + id_len]).decode('utf-8')
+        offset += id_len
+        name = bytes(buf[offset:offset + name_len]).decode('utf-8')
+        offset += name_len
+
+        vector = None
+        if _OP_NAMES[op] == 'add':
+            size = dim * _DTYPES[dtype_code].itemsize
+            if offset + size > end:
+                raise ValueError('Truncated change record')
+            vector = np.frombuffer(buf, dtype=_DTYPES[dtype_code], count=dim, offset=offset)
+            offset += size
+
+        yield Change(_OP_NAMES[op], revision, pid, name, vector)
+        n += 1
+
+    if count is not None and n != count:
+        raise ValueError(f'Delta declares {count} changes, found {n}')
+
+
+def encode_delta(catalog_id, base, target, changes):
+    """Delta covering revisions (base, target]"""
+    header = _DELTA_HEADER.pack(DELTA_MAGIC, bytes.fromhex(catalog_id), base, target, len(changes))
+    return header + encode_records(changes)
+
+
+def decode_delta(data, dim):
+    """
+    Returns:
+        (catalog_id, base, target, changes)
+
+    Raises:
+        ValueError if the data is not a well-formed delta
+    """
+    if len(data) < _DELTA_HEADER.size:
+        raise ValueError('Delta too short')
+    magic, raw_id, base, target, count = _DELTA_HEADER.unpack_from(data, 0)
+    if magic != DELTA_MAGIC:
+        raise ValueError('Not a catalog delta')
+    changes = list(iter_records(data, _DELTA_HEADER.size, dim, count))
+    return raw_id.hex(), base, target, changes
+
+
+def append_log(path, catalog_id, changes):
+    """
+    Append changes to the log. A log written for another catalog id
+    (catalog rebuilt from scratch) is started over.
+    """
+    if not changes:
+        return
+    header = _LOG_HEADER.pack(LOG_MAGIC, bytes.fromhex(catalog_id))
+    fresh = True
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            fresh = f.read(_LOG_HEADER.size) != header
+    with open(path, 'wb' if fresh else 'ab') as f:
+        if fresh:
+            f.write(header)
+        f.write(encode_records(changes))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def read_log(path, catalog_id, dim, since=0):
+    """
+    Changes with revision > since from the log of this catalog id.
+
+    Returns:
+        (changes, first_revision) — first_revision is the oldest revision
+        still in the log (None if the log is empty or belongs to another catalog)
+    """
+    if not os.path.exists(path):
+        return [], None
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < _LOG_HEADER.size:
+        return [], None
+    magic, raw_id = _LOG_HEADER.unpack_from(data, 0)
+    if magic != LOG_MAGIC or raw_id.hex() != catalog_id:
+        return [], None
+
+    changes = []
+    first = None
+    for ch in iter_records(data, _LOG_HEADER.size, dim):
+        if first is None:
+            first = ch.revision
+        if ch.revision > since:
+            changes.append(ch)
+    return changes, first
+
+
+def first_revision(path, catalog_id):
+    """Oldest revision in the log (reads only the first record header), or None"""
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        data = f.read(_LOG_HEADER.size + _RECORD.size)
+    if len(data) < _LOG_HEADER.size + _RECORD.size:
+        return None
+    magic, raw_id = _LOG_HEADER.unpack_from(data, 0)
+    if magic != LOG_MAGIC or raw_id.hex() != catalog_id:
+        return None
+    return _RECORD.unpack_from(data, _LOG_HEADER.size)[2]
+
+
+def trim_log(path, catalog_id, dim, keep):
+    """Rewrite the log with only its newest `keep` changes (atomic replace)"""
+    changes, _ = read_log(path, catalog_id, dim)
+    if len(changes) <= keep:
+        return
+    fd, tmp_path = tempfile.mkstemp(prefix='.changes_', dir=os.path.dirname(str(path)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_LOG_HEADER.pack(LOG_MAGIC, bytes.fromhex(catalog_id)))
+            f.write(encode_records(changes[-keep:]))
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Sync the embedding catalog between server nodes with binary deltas.
+
+  export  — write changes after a revision from the local catalog files
+  import  — apply a delta file to the local catalog files (server stopped)
+  pull    — fetch the delta a node is missing from another node's
+            yolo_server and apply it (to a running server with --to,
+            otherwise to the local catalog files)
+
+Usage:
+  python3 catalog_sync.py export --since 120 -o delta.bin
+  python3 catalog_sync.py import delta.bin
+  python3 catalog_sync.py pull --from http://central:5002 --to http://127.0.0.1:5002
+"""
+import sys
+import json
+import argparse
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+SCRIPT_DIR = Path(__file__).parent
+sys.path.insert(0, str(SCRIPT_DIR))
+
+import embedding_catalog as catalog
+
+
+def _get(url, timeout=60):
+    with urllib.request.urlopen(url, timeout=timeout) as resp:
+        return resp.read()
+
+
+def _post_delta(url, delta, timeout=300):
+    req = urllib.request.Request(url, data=delta, method='POST',
+                                 headers={'Content-Type': 'application/octet-stream'})
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            return json.loads(resp.read())
+    except urllib.error.HTTPError as e:
+        return json.loads(e.read() or b'{}')
+
+
+def export_file(since, output):
+    catalog.load()
+    delta = catalog.export_delta(since)
+    if delta is None:
+        print(f"[Sync] Change log does not reach back to revision {since} — copy the full catalog instead")
+        return False
+    with open(output, 'wb') as f:
+        f.write(delta)
+    print(f"[Sync] Revisions {since}..{catalog.get_revision()['revision']} -> {output} ({len(delta)} bytes)")
+    return True
+
+
+def apply_local(delta):
+    """Apply a delta to the local catalog files"""
+    catalog.load()
+    try:
+        result = catalog.import_delta(delta)
+    except ValueError as e:
+        print(f"[Sync] Rejected: {e}")
+        return False
+    if result['applied']:
+        catalog.save()
+    print(f"[Sync] Applied {result['applied']} changes (skipped {result['skipped']}), "
+          f"now at revision {result['revision']}")
+    return True
+
+
+def pull(source, target=None):
+    """Fetch the missing delta from source and apply it to target (URL) or local files"""
+    source = source.rstrip('/')
+    if target:
+        target = target.rstrip('/')
+        since = json.loads(_get(f'{target}/catalog/version'))['revision']
+    else:
+        catalog.load()
+        since = catalog.get_revision()['revision']
+
+    try:
+        delta = _get(f'{source}/catalog/delta?since={since}')
+    except urllib.error.HTTPError as e:
+        if e.code == 410:
+            print(f"[Sync] {source} no longer has changes after revision {since} — full sync required")
+            return False
+        raise
+    print(f"[Sync] Fetched delta after revision {since} from {source} ({len(delta)} bytes)")
+
+    if not target:
+        return apply_local(delta)
+    result = _post_delta(f'{target}/catalog/apply-delta', delta)
+    if not result.get('success'):
+        print(f"[Sync] {target} rejected delta: {result.get('error')}")
+        return False
+    print(f"[Sync] {target}: applied {result['applied']} changes, now at revision {result['revision']}")
+    return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sync embedding catalog with binary deltas')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_export = sub.add_parser('export', help='Write changes after a revision to a file')
+    p_export.add_argument('--since', type=int, default=0, help='Revision the receiver already has')
+    p_export.add_argument('-o', '--output', required=True, help='Delta file')
+
+    p_import = sub.add_parser('import', help='Apply a delta file to the local catalog (server stopped)')
+    p_import.add_argument('delta', help='Delta file')
+
+    p_pull = sub.add_parser('pull', help='Fetch and apply missing changes from another node')
+    p_pull.add_argument('--from', dest='source', required=True, help='Source yolo_server URL')
+    p_pull.add_argument('--to', dest='target', help='Target yolo_server URL (default: local catalog files)')
+
+    args = parser.parse_args()
+    if args.command == 'export':
+        ok = export_file(args.since, args.output)
+    elif args.command == 'import':
+        ok = apply_local(Path(args.delta).read_bytes())
+    else:
+        ok = pull(args.source, args.target)
+    sys.exit(0 if ok else 1)
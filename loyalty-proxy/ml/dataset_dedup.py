@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Near-duplicate clustering of training images by perceptual hash.
+
+Each image gets a 64-bit pHash (DCT of a 32x32 grayscale thumbnail, 8x8
+low-frequency block thresholded at its median). Images are clustered around
+leaders looked up in a BK-tree (Hamming distance): an image joins the nearest
+leader within `distance` bits or becomes a leader itself, so no cluster
+spans more than 2 * distance bits (no transitive chaining through
+near-identical steps). export_training_data always puts a whole cluster on
+one side of the train/val split and, when filtering is enabled, keeps at
+most N images per cluster.
+
+Hashes are stored in the training manifest (training_manifest.py), which
+clears a hash when its file changes, so re-indexing only decodes new or
+changed files.
+
+Usage:
+  python3 dataset_dedup.py [--distance 6] [--per-cluster 2]
+"""
+import os
+import sys
+import time
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+SCRIPT_DIR = Path(__file__).parent
+sys.path.insert(0, str(SCRIPT_DIR))
+
+import training_manifest
+
+HASH_SIZE = 32          # thumbnail side
+HASH_BLOCK = 8          # low-frequency DCT block -> 64 bits
+DEFAULT_DISTANCE = int(os.environ.get('YOLO_DEDUP_DISTANCE', '6'))
+
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, None]
+    x = np.arange(n)[None, :]
+    mat = np.cos(np.pi * (2 * x + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    mat[0] /= np.sqrt(2)
+    return mat.astype(np.float32)
+
+
+_DCT = _dct_matrix(HASH_SIZE)[:HASH_BLOCK]
+
+
+def phash_pixels(gray):
+    """64-bit pHash of a (HASH_SIZE, HASH_SIZE) grayscale array"""
+    coeffs = (_DCT @ np.asarray(gray, dtype=np.float32) @ _DCT.T).flatten()
+    bits = coeffs > np.median(coeffs[1:])    # DC term left out of the median
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def phash_file(path):
+    """pHash of an image file (EXIF orientation applied)"""
+    from PIL import Image, ImageOps
+
+    with Image.open(path) as img:
+        img.draft('L', (HASH_SIZE * 4, HASH_SIZE * 4))    # JPEG: decode at reduced scale
+        img = ImageOps.exif_transpose(img).convert('L').resize((HASH_SIZE, HASH_SIZE), Image.LANCZOS)
+        return phash_pixels(np.asarray(img))
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+class BKTree:
+    """Burkhard-Keller tree over 64-bit hashes for Hamming radius queries"""
+
+    def __init__(self):
+        self.root = None    # [hash, [items], {distance: child}]
+        self.size = 0
+
+    def add(self, value, item):
+        self.size += 1
+        if self.root is None:
+            self.root = [value, [item], {}]
+            return
+        node = self.root
+        while True:
+            d = hamming(value, node[0])
+            if d == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [value, [item], {}]
+                return
+            node = child
+
+    def search(self, value, radius):
+        """Items whose hash is within radius bits of value"""
+        found = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            d = hamming(value, node[0])
+            if d <= radius:
+                found.extend(node[1])
+            for dist, child in node[2].items():
+                if d - radius <= dist <= d + radius:
+                    stack.append(child)
+        return found
+
+
+def hash_images(paths):
+    """
+    pHash per image, reusing the hashes stored in the training manifest for
+    unchanged files and storing the new ones.
+
+    Returns:
+        (hashes list aligned with paths — None for unreadable images, stats dict)
+    """
+    stored = training_manifest.get_phashes(paths)
+    computed = {}
+    hashes = []
+    failed = 0
+    start = time.perf_counter()
+    for path in paths:
+        key = str(Path(path).absolute())
+        if key in stored:
+            hashes.append(int(stored[key], 16))
+            continue
+        try:
+            value = phash_file(path)
+        except Exception as e:
+            print(f"[Dedup] Cannot hash {path}: {e}", file=sys.stderr)
+            failed += 1
+            hashes.append(None)
+            continue
+        computed[key] = f'{value:016x}'
+        hashes.append(value)
+
+    if computed:
+        training_manifest.set_phashes(computed)
+    return hashes, {'hashed': len(computed), 'cached': len(paths) - len(computed) - failed, 'failed': failed,
+                    'seconds': round(time.perf_counter() - start, 2)}
+
+
+def cluster_hashes(hashes, distance=DEFAULT_DISTANCE):
+    """
+    Group indices around leader hashes: in index order, each hash joins the
+    nearest leader within `distance` bits (lowest index on ties) or becomes
+    a new leader. Every member is within `distance` of its leader, so a
+    chain of small steps cannot pull far-apart images into one cluster.
+
+    Returns:
+        list of clusters (lists of indices, ascending, leader first);
+        None hashes are singletons
+    """
+    leader_of = list(range(len(hashes)))
+    tree = BKTree()
+    for i, value in enumerate(hashes):
+        if value is None:
+            continue
+        near = tree.search(value, distance)
+        if near:
+            leader_of[i] = min(near, key=lambda j: (hamming(value, hashes[j]), j))
+        else:
+            tree.add(value, i)
+
+    clusters = {}
+    for i in range(len(hashes)):
+        clusters.setdefault(leader_of[i], []).append(i)
+    return list(clusters.values())
+
+
+def select_from_cluster(members, max_per_cluster, label_counts):
+    """Members to keep: most annotated boxes first, then original order"""
+    if not max_per_cluster or len(members) <= max_per_cluster:
+        return list(members)
+    ranked = sorted(members, key=lambda i: (-label_counts[i], i))
+    return sorted(ranked[:max_per_cluster])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Report near-duplicate clusters in the YOLO training data')
+    parser.add_argument('--distance', type=int, default=DEFAULT_DISTANCE, help='Max Hamming distance (bits of 64)')
+    parser.add_argument('--per-cluster', type=int, default=2, help='Images kept per cluster (report only)')
+    args = parser.parse_args()
+
+    from yolo_inference import _collect_training_samples
+
+    samples = _collect_training_samples()
+    hashes, stats = hash_images([s[0] for s in samples])
+    clusters = cluster_hashes(hashes, args.distance)
+    kept = sum(min(len(c), args.per_cluster) if args.per_cluster else len(c) for c in clusters)
+    print(f"[Dedup] {len(samples)} images, {len(clusters)} clusters, "
+          f"{sum(1 for c in clusters if len(c) > 1)} with duplicates, largest {max(map(len, clusters), default=0)}; "
+          f"keeping {kept} "
+          f"(hashed {stats['hashed']}, cached {stats['cached']}, {stats['seconds']}s)")
+    for c in sorted(clusters, key=len, reverse=True)[:10]:
+        if len(c) > 1:
+            print(f"[Dedup]   {len(c)}: " + ', '.join(samples[i][0].name for i in c[:5]))
@@ -5,22 +5,155 @@ Embedding Catalog — reference embeddings for product identification.
 Stores MobileNetV3-Small feature vectors (576-dim) for each product.
 Search by cosine similarity via numpy matrix multiplication.
 
+Search modes:
+  centroid — one mean vector per product (fastest)
+  multi    — centroid shortlist, then exact k-NN voting over the
+             shortlisted products' stored per-sample embeddings
+  ann      — approximate search over all per-sample embeddings through an
+             optional IVF index (see ann_index.py), for 100k+ vectors
+  pq       — asymmetric-distance scan over product-quantized per-sample
+             codes (see pq.py), exact re-rank of the shortlist only
+
+Stored samples (EMBEDDING_SAMPLE_POLICY env var or set_sample_policy()):
+  prototypes — up to MAX_EMBEDDINGS weighted prototypes per product, updated
+               online; near-duplicates merge instead of evicting a distinct
+               variant (see prototypes.py); centroid is their weighted mean
+  recent     — the MAX_EMBEDDINGS most recent samples; centroid is their mean
+
+Storage modes (EMBEDDING_STORAGE env var or set_storage_mode()):
+  float32  — per-sample vectors in RAM as float32; JSON keeps float lists
+  float16  — per-sample vectors in RAM as float16; JSON stores base64 float16
+  pq       — 48-byte PQ codes in RAM; exact float16 vectors are memory-mapped
+             from an append-only file and only the re-ranked shortlist is
+             read; a change appends just the changed products' rows
+
+Sample sources: add_embedding(..., source='build') marks samples of the
+reference builder (build_reference_catalog.py). Samples from any other
+source (/catalog/add, deltas) are also kept raw per product
+('runtimeSamples', the MAX_EMBEDDINGS most recent), so the builder can
+rebuild a product from its training crops without losing them (see
+runtime_samples).
+
 Storage: data/embedding-catalog/reference_embeddings.json
+         data/embedding-catalog/reference_embeddings.ann.npz (optional IVF index)
+         data/embedding-catalog/reference_embeddings.pq.npz  (PQ codebook + codes)
+         data/embedding-catalog/reference_embeddings.changes.bin (change log)
+
+Replication: every add/remove bumps the catalog revision and is appended to
+a change log on save(); export_delta(since) / import_delta(data) ship only
+the changes between nodes (see catalog_delta.py).
+
+Multi-process: one writer calls publish_shared() after each change; reader
+processes attach_shared() once and refresh_shared() per request, mapping the
+current generation read-only (see shared_catalog.py).
 """
+import gc
 import json
 import os
+import time
+import atexit
+import uuid
+import base64
+import tempfile
 import numpy as np
+from collections import namedtuple
 from pathlib import Path
 
+import shared_catalog
+import catalog_delta
+import prototypes
+from ann_index import IVFIndex, DEFAULT_NPROBE
+from pq import ProductQuantizer, CODEBOOK_SIZE, DEFAULT_SUBSPACES
+
 SCRIPT_DIR = Path(__file__).parent
 DATA_DIR = SCRIPT_DIR.parent / 'data'
 CATALOG_DIR = DATA_DIR / 'embedding-catalog'
 CATALOG_FILE = CATALOG_DIR / 'reference_embeddings.json'
+ANN_INDEX_FILE = CATALOG_DIR / 'reference_embeddings.ann.npz'
+PQ_FILE = CATALOG_DIR / 'reference_embeddings.pq.npz'
+CHANGELOG_FILE = CATALOG_DIR / 'reference_embeddings.changes.bin'
+
+SEARCH_MODES = ('centroid', 'multi', 'ann', 'pq')
+SHORTLIST_SIZE = 32   # multi mode: products kept from the centroid stage
+KNN_VOTES = 5         # multi mode: nearest samples that vote for a product
+PQ_RERANK = 256       # pq mode: samples re-ranked with exact vectors
+EXPECTED_MARGIN = 0.75  # expected-first: min expected similarity to skip the full search
+
+SAMPLE_POLICIES = ('prototypes', 'recent')
+MAX_EMBEDDINGS = int(os.environ.get('EMBEDDING_PROTOTYPES', '20'))  # stored vectors per product
+# prototypes policy: cosine at which a new sample merges into an existing prototype
+MERGE_SIMILARITY = float(os.environ.get('EMBEDDING_MERGE_SIMILARITY', '0.95'))
+_sample_policy = os.environ.get('EMBEDDING_SAMPLE_POLICY', 'prototypes').lower()
+if _sample_policy not in SAMPLE_POLICIES:
+    _sample_policy = 'prototypes'
+MAX_LOG_CHANGES = 20000  # change log entries kept for delta export
+EMBEDDING_DIM = 576
+BUILD_SOURCE = 'build'   # add_embedding source of the reference builder
+
+STORAGE_MODES = ('float32', 'float16', 'pq')
+_STORAGE_DTYPES = {'float32': np.float32, 'float16': np.float16, 'pq': np.float16}
+_storage_mode = os.environ.get('EMBEDDING_STORAGE', 'float32').lower()
+if _storage_mode not in STORAGE_MODES:
+    _storage_mode = 'float32'
+# Mode chosen by env / set_storage_mode(); attach_shared() follows the writer's, load() restores this
+_configured_storage_mode = _storage_mode
 
 # In-memory catalog
 _catalog = None
-_matrix = None      # (N, 576) numpy array for fast batch search
-_product_ids = []   # parallel array: _product_ids[i] -> product_id for _matrix[i]
+
+# Search generation: everything a search reads, built completely and then
+# swapped in with a single assignment, so a search that takes the current
+# generation once never mixes rows of two catalog versions.
+#   matrix         (N, 576) float32 centroids for fast batch search
+#   product_ids    product_ids[i] -> product_id for matrix[i]
+#   row_of         product_id -> row in matrix
+#   sample_matrix  (M, 576) per-sample vectors in storage dtype, grouped by
+#                  product row (CSR layout): samples of row i are
+#                  sample_matrix[sample_offsets[i]:sample_offsets[i + 1]];
+#                  in pq mode the read-only sample file mapping instead,
+#                  read through sample_rows. Product entries' 'embeddings'
+#                  are views into it (no second copy).
+#   sample_offsets (N + 1,) int64
+#   sample_rows    (M,) int64 row of sample_matrix holding each sample (pq
+#                  mode; None when sample_matrix is in CSR order)
+#   sample_owner   (M,) int32 product row of each sample
+#   sample_codes   (M, 48) uint8 PQ codes parallel to sample_matrix, or None
+#   pq             product quantizer of sample_codes, or None
+#   ann            optional IVF index over per-sample vectors (mode 'ann')
+Generation = namedtuple('Generation', 'matrix product_ids row_of sample_matrix sample_offsets '
+                                      'sample_rows sample_owner sample_codes pq ann')
+_EMPTY = Generation(None, [], {}, None, None, None, None, None, None, None)
+_state = _EMPTY
+
+# Writer's working IVF index and product quantizer; published to searches
+# through the generation
+_ann = None
+_pq = None
+_codes_cache = {}       # product_id -> codes of its current embeddings
+
+# Sample file (pq storage): exact vectors appended per changed product and
+# mapped read-only. _store_blocks: product_id -> (start, end, source) rows of
+# its current samples; source is the array (or centroid) they were written
+# from, so an unchanged product is recognized by identity and not rewritten.
+_store_file = None
+_store_rows = 0
+_store_blocks = {}
+STORE_MIN_GARBAGE = 4096      # replaced rows tolerated before the file is rewritten compacted
+
+# Sample files that could not be deleted yet: on Windows a file cannot be
+# removed while open or mapped, so it is retried once the mapping is replaced
+# and at exit
+_mapped_files = []
+STALE_SAMPLES_SECONDS = 3600  # leftover sample files of dead processes older than this are removed
+
+# Changes since the last save(), not yet in the change log
+_pending_changes = []
+
+# Shared generation this process is attached to (readers only)
+_shared_dir = None
+_shared_signature = None
+_shared_meta = None
+_read_only = False
 
 
 def _ensure_dir():
@@ -28,106 +161,955 @@ def _ensure_dir():
     CATALOG_DIR.mkdir(parents=True, exist_ok=True)
 
 
+def _storage_dtype():
+    return _STORAGE_DTYPES[_storage_mode]
+
+
+def _decode_vectors(value, dtype):
+    """JSON value (float list(s) or base64 float16) -> L2-normalized 2-D array"""
+    if isinstance(value, str):
+        arr = np.frombuffer(base64.b64decode(value), dtype=np.float16).reshape(-1, EMBEDDING_DIM)
+    else:
+        arr = np.array(value, dtype=np.float32).reshape(-1, EMBEDDING_DIM) if len(value) else \
+            np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+    return _normalize_rows(arr.astype(np.float32)).astype(dtype)
+
+
+def _encode_vectors(arr, single=False):
+    """2-D array -> JSON value: float lists in float32 storage, base64 float16 otherwise"""
+    if _storage_mode == 'float32':
+        arr = np.asarray(arr, dtype=np.float32)
+        return arr[0].tolist() if single else arr.tolist()
+    return base64.b64encode(np.ascontiguousarray(arr, dtype=np.float16).tobytes()).decode('ascii')
+
+
+def _check_writable():
+    if _read_only:
+        raise RuntimeError("Catalog is attached read-only to a shared generation; "
+                           "changes must go through the writer process")
+
+
 def load():
     """Load catalog from disk into memory"""
-    global _catalog, _matrix, _product_ids
+    global _catalog, _state, _ann, _pq, _codes_cache, _read_only, _shared_meta, _shared_dir, _storage_mode
 
+    _storage_mode = _configured_storage_mode
+    _close_sample_store()
+    _read_only = False
+    _shared_meta = None
+    _shared_dir = None
+    _state = _EMPTY
+    _ann = None
+    _pq = None
+    _codes_cache = {}
+    _pending_changes.clear()
     if not CATALOG_FILE.exists():
         _catalog = {'version': 1, 'products': {}}
-        _matrix = None
-        _product_ids = []
+        _rebuild_matrix()
         return False
 
     with open(CATALOG_FILE) as f:
         _catalog = json.load(f)
 
+    dtype = _storage_dtype()
+    for info in _catalog.get('products', {}).values():
+        if info.get('centroid') is not None:
+            info['centroid'] = _decode_vectors(info['centroid'], np.float32)[0]
+        if info.get('embeddings') is not None:
+            info['embeddings'] = _decode_vectors(info['embeddings'], dtype)
+        if info.get('runtimeSamples') is not None:
+            info['runtimeSamples'] = _decode_vectors(info['runtimeSamples'], dtype)
+    _catalog.pop('vectorEncoding', None)
+
+    if PQ_FILE.exists():
+        try:
+            _load_pq()
+        except Exception as e:
+            print(f"[Catalog] Failed to load PQ codebook, ignoring: {e}")
+            _pq = None
+            _codes_cache = {}
+
+    if ANN_INDEX_FILE.exists():
+        try:
+            _ann = IVFIndex.load(ANN_INDEX_FILE)
+        except Exception as e:
+            print(f"[Catalog] Failed to load ANN index, ignoring: {e}")
+            _ann = None
+
     _rebuild_matrix()
     return True
 
 
+def _load_pq():
+    """Load PQ codebook and seed the per-product code cache"""
+    global _pq, _codes_cache
+
+    data = np.load(PQ_FILE)
+    _pq = ProductQuantizer.from_arrays(data)
+    codes, offsets = data['codes'], data['offsets']
+    products = _catalog.get('products', {})
+    for i, pid in enumerate(data['product_ids'].tolist()):
+        info = products.get(pid)
+        count = int(offsets[i + 1] - offsets[i])
+        if info is not None and info.get('embeddings') is not None and len(info['embeddings']) == count:
+            _codes_cache[pid] = codes[offsets[i]:offsets[i + 1]]
+
+
+def _normalize_rows(matrix):
+    """L2-normalize rows of a 2-D float32 array (zero rows stay zero)"""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def _open_sample_store():
+    """
+    Start a new, empty sample file (pq storage). The file is deleted as soon
+    as the OS allows: right away on POSIX, where the open descriptor and the
+    mappings keep it alive; on Windows, where an open or mapped file cannot
+    be deleted, once it was closed and unmapped (see _remove_mapped_files).
+    """
+    global _store_file, _store_rows, _store_blocks
+
+    _close_sample_store()
+    _ensure_dir()
+    if not _mapped_files:
+        _remove_stale_samples()
+    fd, path = tempfile.mkstemp(prefix='.samples_', suffix='.bin', dir=str(CATALOG_DIR))
+    _store_file = os.fdopen(fd, 'r+b')
+    _store_rows = 0
+    _store_blocks = {}
+    _mapped_files.append(path)
+    _remove_mapped_files()
+
+
+def _close_sample_store():
+    """Close the sample file; existing mappings stay valid until released"""
+    global _store_file, _store_rows, _store_blocks
+
+    if _store_file is not None:
+        _store_file.close()
+    _store_file = None
+    _store_rows = 0
+    _store_blocks = {}
+    _remove_mapped_files()
+
+
+def _store_samples(ids, samples, sources):
+    """
+    Exact sample vectors of a pq generation, kept in the sample file.
+
+    Rows of products whose samples did not change since they were written
+    are reused; only changed and new products are appended, so adding one
+    vector writes one product's rows rather than the whole catalog. Replaced
+    rows stay in the file until they outnumber the live ones (and
+    STORE_MIN_GARBAGE), then the file is rewritten once, compacted.
+
+    Args:
+        ids: product ids in generation row order
+        samples: per product, its sample vectors
+        sources: per product, the object its samples came from (embeddings
+            array or centroid)
+
+    Returns:
+        (read-only mapping of the file, (start, end) rows per product)
+    """
+    global _store_rows, _store_blocks
+
+    reused = [(_store_blocks.get(pid) or (0, 0, None))[2] is source for pid, source in zip(ids, sources)]
+    kept = sum(_store_blocks[pid][1] - _store_blocks[pid][0] for pid, r in zip(ids, reused) if r)
+    if _store_file is None or _store_rows - kept > max(kept, STORE_MIN_GARBAGE):
+        _open_sample_store()
+        reused = [False] * len(ids)
+
+    dtype = _storage_dtype()
+    blocks = {}
+    _store_file.seek(0, os.SEEK_END)
+    for pid, vecs, source, keep in zip(ids, samples, sources, reused):
+        if keep:
+            blocks[pid] = _store_blocks[pid]
+            continue
+        vecs = np.ascontiguousarray(vecs, dtype=dtype)
+        _store_file.write(vecs.tobytes())
+        blocks[pid] = (_store_rows, _store_rows + len(vecs), source)
+        _store_rows += len(vecs)
+    _store_file.flush()
+    _store_blocks = blocks
+
+    mapped = np.memmap(_store_file, dtype=dtype, mode='r', shape=(_store_rows, EMBEDDING_DIM))
+    return mapped, [blocks[pid][:2] for pid in ids]
+
+
+def _remove_mapped_files():
+    """Delete sample memmap files whose mapping is gone (all of them on POSIX)"""
+    for path in list(_mapped_files):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        except PermissionError:
+            continue    # still mapped (Windows)
+        _mapped_files.remove(path)
+
+
+def _remove_stale_samples():
+    """Delete memmap files left behind by processes that did not exit cleanly"""
+    cutoff = time.time() - STALE_SAMPLES_SECONDS
+    for path in CATALOG_DIR.glob('.samples_*'):
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+        except OSError:
+            pass
+
+
+@atexit.register
+def _release_mapped_files():
+    """At exit: drop the mappings so Windows lets the files be deleted"""
+    global _catalog, _state
+    if _mapped_files:
+        _catalog, _state = None, _EMPTY
+        gc.collect()
+        _close_sample_store()
+
+
 def _rebuild_matrix():
-    """Rebuild search matrix from catalog centroids"""
-    global _matrix, _product_ids
+    """Rebuild search matrices from catalog centroids and stored embeddings as a new generation"""
+    global _state
 
     products = _catalog.get('products', {})
-    if not products:
-        _matrix = None
-        _product_ids = []
-        return
+    dtype = _storage_dtype()
 
     ids = []
     vectors = []
+    samples = []
+    sources = []
+    has_samples = []
+    offsets = [0]
     for pid, info in products.items():
         centroid = info.get('centroid')
-        if centroid and len(centroid) > 0:
+        if centroid is not None and len(centroid) > 0:
             ids.append(pid)
             vectors.append(centroid)
+            embeddings = info.get('embeddings')
+            has_samples.append(embeddings is not None and len(embeddings) > 0)
+            # Products without stored samples are represented by their centroid
+            sources.append(embeddings if has_samples[-1] else centroid)
+            samples.append(embeddings if has_samples[-1] else np.asarray(centroid, dtype=dtype)[None])
+            offsets.append(offsets[-1] + len(samples[-1]))
 
-    if vectors:
-        _matrix = np.array(vectors, dtype=np.float32)
-        # Ensure L2-normalized
-        norms = np.linalg.norm(_matrix, axis=1, keepdims=True)
-        norms[norms == 0] = 1
-        _matrix = _matrix / norms
-        _product_ids = ids
+    if not vectors:
+        _close_sample_store()
+        _state = Generation(None, [], {}, None, None, None, None, None, _pq, _ann)
+        return
+
+    # Ensure L2-normalized
+    matrix = _normalize_rows(np.array(vectors, dtype=np.float32))
+    sample_offsets = np.array(offsets, dtype=np.int64)
+
+    if _storage_mode == 'pq':
+        sample_codes = _encode_samples(ids, samples, has_samples)
+        sample_matrix, blocks = _store_samples(ids, samples, sources)
+        starts = np.array([start for start, _ in blocks], dtype=np.int64)
+        lengths = np.diff(sample_offsets)
+        sample_rows = np.repeat(starts - sample_offsets[:-1], lengths) + np.arange(sample_offsets[-1])
     else:
-        _matrix = None
-        _product_ids = []
+        _close_sample_store()
+        sample_codes = sample_rows = None
+        sample_matrix = np.concatenate(samples).astype(dtype, copy=False)
+        blocks = list(zip(offsets[:-1], offsets[1:]))
+
+    # Point product entries at their rows of the shared sample matrix
+    for pid, has, (start, end) in zip(ids, has_samples, blocks):
+        if has:
+            products[pid]['embeddings'] = sample_matrix[start:end]
+            if sample_rows is not None:
+                _store_blocks[pid] = (start, end, products[pid]['embeddings'])
+
+    _state = Generation(
+        matrix=matrix,
+        product_ids=ids,
+        row_of={pid: i for i, pid in enumerate(ids)},
+        sample_matrix=sample_matrix,
+        sample_offsets=sample_offsets,
+        sample_rows=sample_rows,
+        sample_owner=np.repeat(np.arange(len(ids), dtype=np.int32), np.diff(sample_offsets)),
+        sample_codes=sample_codes,
+        pq=_pq,
+        ann=_ann,
+    )
+
+
+def _encode_samples(ids, samples, has_samples):
+    """PQ codes for all samples, re-encoding only products that changed"""
+    global _pq
+
+    if _pq is None:
+        if sum(len(vecs) for vecs in samples) < CODEBOOK_SIZE:
+            return None
+        _pq = ProductQuantizer.train(np.concatenate(samples), DEFAULT_SUBSPACES)
+        _codes_cache.clear()
+
+    codes = []
+    for pid, vecs, has in zip(ids, samples, has_samples):
+        cached = _codes_cache.get(pid) if has else None
+        if cached is None or len(cached) != len(vecs):
+            cached = _pq.encode(vecs)
+            if has:
+                _codes_cache[pid] = cached
+        codes.append(cached)
+    return np.concatenate(codes)
+
+
+def rebuild_index():
+    """Rebuild search matrices after add_embedding(..., rebuild=False) calls"""
+    if _catalog is not None:
+        _rebuild_matrix()
+
+
+def set_storage_mode(mode):
+    """
+    Switch storage mode ('float32', 'float16' or 'pq') and convert in place.
+    The JSON encoding follows the mode on the next save().
+    """
+    global _storage_mode, _configured_storage_mode, _pq
+
+    if mode not in STORAGE_MODES:
+        raise ValueError(f"Unknown storage mode: {mode}")
+    _storage_mode = _configured_storage_mode = mode
+    if mode != 'pq':
+        _pq = None
+        _codes_cache.clear()
+
+    if _catalog is not None:
+        dtype = _storage_dtype()
+        for info in _catalog.get('products', {}).values():
+            for field in ('embeddings', 'runtimeSamples'):
+                if info.get(field) is not None:
+                    info[field] = np.array(info[field], dtype=dtype)
+        _rebuild_matrix()
+
+
+def set_sample_policy(policy, max_vectors=None, merge_similarity=None):
+    """
+    Choose how stored samples are maintained for future add_embedding calls
+    ('prototypes' or 'recent'), optionally with a different per-product
+    budget or merge similarity. Existing entries are not rewritten.
+    """
+    global _sample_policy, MAX_EMBEDDINGS, MERGE_SIMILARITY
+
+    if policy not in SAMPLE_POLICIES:
+        raise ValueError(f"Unknown sample policy: {policy}")
+    _sample_policy = policy
+    if max_vectors is not None:
+        MAX_EMBEDDINGS = max(1, int(max_vectors))
+    if merge_similarity is not None:
+        MERGE_SIMILARITY = float(merge_similarity)
+
+
+def train_pq(num_subspaces=DEFAULT_SUBSPACES):
+    """
+    (Re)train the PQ codebook on all stored samples (pq storage mode).
+
+    Returns:
+        dict with codebook shape, or None if there are too few samples
+    """
+    global _pq
+
+    _check_writable()
+    if _storage_mode != 'pq':
+        raise ValueError("PQ codebook requires storage mode 'pq'")
+    state = _state
+    if state.sample_matrix is None or len(state.sample_owner) < CODEBOOK_SIZE:
+        return None
+    _pq = ProductQuantizer.train(_exact_samples(state), num_subspaces)
+    _codes_cache.clear()
+    _rebuild_matrix()
+    return {'subspaces': _pq.num_subspaces, 'bytesPerVector': _pq.bytes_per_vector}
 
 
 def save():
     """Save catalog to disk"""
     if _catalog is None:
         return
+    _check_writable()
     _ensure_dir()
-    with open(CATALOG_FILE, 'w') as f:
-        json.dump(_catalog, f, ensure_ascii=False)
 
+    products = {}
+    for pid, info in _catalog.get('products', {}).items():
+        entry = dict(info)
+        if entry.get('centroid') is not None:
+            entry['centroid'] = _encode_vectors(np.asarray(entry['centroid'])[None], single=True)
+        for field in ('embeddings', 'runtimeSamples'):
+            if entry.get(field) is not None:
+                entry[field] = _encode_vectors(entry[field])
+        products[pid] = entry
+
+    data = dict(_catalog, products=products)
+    if _storage_mode != 'float32':
+        data['vectorEncoding'] = 'float16-base64'
+
+    # Write to a temp file and rename, so readers never see a half-written catalog
+    fd, tmp_path = tempfile.mkstemp(prefix='.reference_embeddings.', suffix='.json', dir=str(CATALOG_DIR))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, CATALOG_FILE)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+    if _pending_changes:
+        catalog_delta.append_log(CHANGELOG_FILE, _catalog_id(), _pending_changes)
+        _pending_changes.clear()
+        # Trim with some slack so the log is not rewritten on every save
+        first = catalog_delta.first_revision(CHANGELOG_FILE, _catalog_id())
+        if first is not None and _catalog['revision'] - first + 1 > MAX_LOG_CHANGES * 5 // 4:
+            catalog_delta.trim_log(CHANGELOG_FILE, _catalog_id(), EMBEDDING_DIM, MAX_LOG_CHANGES)
+
+    state = _state
+    if _ann is not None:
+        _ann.save(ANN_INDEX_FILE)
+    if state.pq is not None and state.sample_codes is not None:
+        with open(PQ_FILE, 'wb') as f:
+            np.savez(f, codes=state.sample_codes, offsets=state.sample_offsets,
+                     product_ids=np.array(state.product_ids, dtype=str), **state.pq.to_arrays())
 
-def search(query_vector, top_k=5, threshold=0.6):
+
+def build_ann_index(nlist=None, nprobe=DEFAULT_NPROBE):
     """
-    Search catalog for closest products by cosine similarity.
+    Build the IVF index from all stored per-sample embeddings.
+    Persisted next to the catalog file on the next save().
 
     Args:
-        query_vector: 576-dim numpy array (L2-normalized)
-        top_k: max results
+        nlist: number of k-means cells (default ~4 * sqrt(vectors))
+        nprobe: default cells scanned per query (recall/speed knob)
+
+    Returns:
+        dict with index size, or None if the catalog is empty
+    """
+    global _ann, _state
+
+    _check_writable()
+    state = _state
+    if state.sample_matrix is None or len(state.product_ids) == 0:
+        _ann = None
+        _state = state._replace(ann=None)
+        return None
+
+    vectors = np.asarray(_exact_samples(state), dtype=np.float32)
+    index = IVFIndex.train(vectors, nlist=nlist, nprobe=nprobe, dtype=_storage_dtype())
+    index.add(vectors, [state.product_ids[i] for i in state.sample_owner])
+    index.compact()
+    _ann = index
+    _state = state._replace(ann=index)
+    return {'vectors': len(index), 'nlist': index.nlist, 'nprobe': index.nprobe}
+
+
+def publish_shared(shared_dir=None):
+    """
+    Publish the in-memory catalog as a new shared generation (writer only).
+    Readers pick it up on their next refresh_shared().
+
+    Returns:
+        the new generation number
+    """
+    _check_writable()
+    products = _catalog.get('products', {}) if _catalog else {}
+    state = _state
+
+    arrays = {}
+    if state.matrix is not None:
+        arrays.update(matrix=state.matrix, samples=_exact_samples(state),
+                      offsets=state.sample_offsets, owner=state.sample_owner)
+    if state.pq is not None and state.sample_codes is not None:
+        arrays.update(codes=state.sample_codes, **state.pq.to_arrays())
+
+    ann_meta = None
+    if _ann is not None:
+        _ann.compact()
+        arrays.update(ann_centroids=_ann.centroids, ann_vectors=_ann.vectors,
+                      ann_codes=_ann.codes, ann_offsets=_ann.offsets)
+        ann_meta = {'labels': _ann.labels, 'nprobe': _ann.nprobe}
+
+    meta = {
+        'catalog': {k: v for k, v in (_catalog or {}).items() if k != 'products'},
+        'storageMode': _storage_mode,
+        'productIds': state.product_ids,
+        # Products in insertion order; vectors come from the arrays
+        'products': {pid: {k: v for k, v in info.items() if k not in ('centroid', 'embeddings', 'runtimeSamples')}
+                     for pid, info in products.items()},
+        'hasSamples': [products[pid].get('embeddings') is not None and len(products[pid]['embeddings']) > 0
+                       for pid in state.product_ids],
+        'ann': ann_meta,
+    }
+    return shared_catalog.publish(shared_dir or shared_catalog.DEFAULT_SHARED_DIR, arrays, meta)
+
+
+def attach_shared(shared_dir=None):
+    """
+    Map the current shared generation read-only, replacing the in-memory
+    catalog. Writes are rejected until load() is called again.
+
+    Returns:
+        True if a generation was attached, False if none is published yet
+    """
+    global _shared_dir, _shared_signature
+
+    _shared_dir = Path(shared_dir or shared_catalog.DEFAULT_SHARED_DIR)
+    signature = shared_catalog.pointer_signature(_shared_dir)
+    opened = shared_catalog.open_current(_shared_dir)
+    if opened is None:
+        return False
+    _install_shared(*opened)
+    _shared_signature = signature
+    return True
+
+
+def refresh_shared():
+    """
+    Re-attach if the writer published a new generation (one stat() call
+    when nothing changed). No-op unless attach_shared() was called.
+
+    Returns:
+        True if a new generation was attached
+    """
+    if _shared_dir is None:
+        return False
+    if shared_catalog.pointer_signature(_shared_dir) == _shared_signature:
+        return False
+    return attach_shared(_shared_dir)
+
+
+def shared_generation():
+    """Generation number this process is attached to, or None"""
+    return _shared_meta.get('generation') if _shared_meta else None
+
+
+def _install_shared(arrays, meta):
+    """Point module state at memory-mapped generation arrays"""
+    global _catalog, _state, _ann, _pq, _codes_cache, _storage_mode, _shared_meta, _read_only
+
+    _close_sample_store()
+    ids = meta['productIds']
+    matrix = arrays.get('matrix')
+    samples = arrays.get('samples')
+    offsets = arrays.get('offsets')
+
+    products = {}
+    row_of = {pid: i for i, pid in enumerate(ids)}
+    for pid, info in meta['products'].items():
+        entry = dict(info)
+        row = row_of.get(pid)
+        if row is not None:
+            entry['centroid'] = matrix[row]
+            entry['embeddings'] = samples[offsets[row]:offsets[row + 1]] if meta['hasSamples'][row] else None
+        products[pid] = entry
+
+    ann = None
+    if meta.get('ann'):
+        ann = IVFIndex.from_arrays(arrays['ann_centroids'], arrays['ann_vectors'], arrays['ann_codes'],
+                                   arrays['ann_offsets'], meta['ann']['labels'], meta['ann']['nprobe'])
+
+    pq = ProductQuantizer.from_arrays(arrays) if 'pq_codebooks' in arrays else None
+    _catalog = dict(meta['catalog'], products=products)
+    _state = Generation(
+        matrix=matrix if ids else None,
+        product_ids=ids,
+        row_of=row_of,
+        sample_matrix=samples,
+        sample_offsets=offsets,
+        sample_rows=None,
+        sample_owner=arrays.get('owner'),
+        sample_codes=arrays.get('codes'),
+        pq=pq,
+        ann=ann,
+    )
+    _pq = pq
+    _ann = ann
+    _codes_cache = {}
+    _storage_mode = meta['storageMode']
+    _shared_meta = meta
+    _read_only = True
+
+
+def snapshot():
+    """Current search generation (see Generation); pass it to searches that must agree"""
+    return _state
+
+
+def has_ann_index():
+    return _state.ann is not None
+
+
+def available_search_modes():
+    """Search modes usable right now (ann needs an index, pq needs codes)"""
+    state = _state
+    modes = ['centroid', 'multi']
+    if state.ann is not None:
+        modes.append('ann')
+    if state.sample_codes is not None:
+        modes.append('pq')
+    return modes
+
+
+def _prepare_queries(queries):
+    """
+    Coerce queries to a (Q, D) float32 matrix with L2-normalized rows.
+
+    Returns:
+        (matrix, valid) — valid[i] is False for zero-norm query rows
+    """
+    q = np.asarray(queries, dtype=np.float32)
+    if q.ndim == 1:
+        q = q.reshape(1, -1)
+    norms = np.linalg.norm(q, axis=1, keepdims=True)
+    valid = norms[:, 0] > 0
+    norms[~valid] = 1
+    return q / norms, valid
+
+
+def _top_k(similarities, top_k):
+    """
+    Partial top-k selection per row of a (Q, N) similarity matrix.
+
+    argpartition finds the k best in O(N), then only those k are sorted,
+    instead of a full O(N log N) argsort over the whole catalog.
+
+    Returns:
+        (indices, scores) — both (Q, k), best first
+    """
+    n = similarities.shape[1]
+    k = min(top_k, n)
+    if k < n:
+        part = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+    else:
+        part = np.broadcast_to(np.arange(n), similarities.shape)
+    part_scores = np.take_along_axis(similarities, part, axis=1)
+    order = np.argsort(-part_scores, axis=1, kind='stable')
+    return (np.take_along_axis(part, order, axis=1),
+            np.take_along_axis(part_scores, order, axis=1))
+
+
+def _exact_samples(state, idx=None):
+    """Exact sample vectors (storage dtype) at CSR positions idx, all of them when None"""
+    if state.sample_rows is None:
+        return state.sample_matrix if idx is None else state.sample_matrix[idx]
+    return state.sample_matrix[state.sample_rows if idx is None else state.sample_rows[idx]]
+
+
+def _gather_samples(state, rows):
+    """
+    Sample indices of the given product rows, grouped contiguously by row.
+
+    Returns:
+        (sample_idx, local, group_starts) — local[j] is the position in rows
+        that owns sample_idx[j]; group_starts[i] is where row i's samples begin
+    """
+    starts = state.sample_offsets[rows]
+    lengths = state.sample_offsets[rows + 1] - starts
+    group_starts = np.cumsum(lengths) - lengths
+    local = np.repeat(np.arange(len(rows)), lengths)
+    sample_idx = np.repeat(starts - group_starts, lengths) + np.arange(int(lengths.sum()))
+    return sample_idx, local, group_starts
+
+
+def _centroid_top_k(state, q, top_k, rows=None):
+    """Top-k product rows by centroid similarity, optionally among `rows` only"""
+    if rows is None:
+        # Cosine similarity = dot product of L2-normalized vectors
+        return _top_k(q @ state.matrix.T, top_k)
+    local, scores = _top_k(q @ state.matrix[rows].T, top_k)
+    return rows[local], scores
+
+
+def _search_multi(state, q, top_k, shortlist, knn, rows=None):
+    """
+    Two-stage multi-vector search.
+
+    Stage 1 keeps the `shortlist` best products by centroid similarity.
+    Stage 2 scores each query exactly against the shortlisted products'
+    per-sample vectors; the `knn` nearest samples vote for their product
+    (weighted by similarity). Products are ranked by votes, then by their
+    best sample similarity, which is also the reported similarity.
+    """
+    cand_rows, _ = _centroid_top_k(state, q, max(shortlist, top_k), rows)
+    k_out = min(top_k, cand_rows.shape[1])
+
+    indices = np.empty((q.shape[0], k_out), dtype=np.int64)
+    scores = np.empty((q.shape[0], k_out), dtype=np.float32)
+
+    for i, rows in enumerate(cand_rows):
+        sample_idx, local, group_starts = _gather_samples(state, rows)
+        sims = _exact_samples(state, sample_idx).astype(np.float32, copy=False) @ q[i]
+
+        # Every product has at least one sample, so groups are non-empty
+        best = np.maximum.reduceat(sims, group_starts)
+
+        k = min(knn, len(sims))
+        nearest = np.argpartition(-sims, k - 1)[:k]
+        votes = np.bincount(local[nearest], weights=np.maximum(sims[nearest], 0), minlength=len(rows))
+
+        order = np.lexsort((-best, -votes))[:k_out]
+        indices[i] = rows[order]
+        scores[i] = best[order]
+
+    return indices, scores
+
+
+def _search_ann(state, q, top_k, knn, nprobe):
+    """
+    Approximate search through the IVF index over per-sample vectors.
+    Each product is scored by its best (nearest) sample.
+    """
+    ann = state.ann
+    codes, sims = ann.search(q, k=max(top_k, 1) * knn, nprobe=nprobe)
+
+    indices = np.full((q.shape[0], top_k), -1, dtype=np.int64)
+    scores = np.zeros((q.shape[0], top_k), dtype=np.float32)
+    for i in range(q.shape[0]):
+        found = 0
+        seen = set()
+        for code, sim in zip(codes[i].tolist(), sims[i].tolist()):
+            if code < 0 or found >= top_k:
+                break
+            row = state.row_of.get(ann.labels[code])
+            if row is None or row in seen:
+                continue
+            seen.add(row)
+            indices[i, found] = row
+            scores[i, found] = sim
+            found += 1
+        # Rows never filled stay below any sensible threshold
+        scores[i, found:] = -np.inf
+
+    return indices, scores
+
+
+def _search_pq(state, q, top_k, rerank):
+    """
+    ADC scan over all PQ codes, then exact re-rank of the `rerank` best
+    samples (the only exact vectors read). Each product is scored by its
+    best re-ranked sample.
+    """
+    approx = state.pq.adc_scores(q, state.sample_codes)
+    candidates, _ = _top_k(approx, max(rerank, top_k))
+
+    indices = np.full((q.shape[0], top_k), -1, dtype=np.int64)
+    scores = np.full((q.shape[0], top_k), -np.inf, dtype=np.float32)
+    for i, cand in enumerate(candidates):
+        # Sequential reads from the memmap
+        cand = cand[np.argsort(cand if state.sample_rows is None else state.sample_rows[cand])]
+        exact = _exact_samples(state, cand).astype(np.float32) @ q[i]
+        order = np.argsort(-exact, kind='stable')
+        owners = state.sample_owner[cand][order]
+        _, first = np.unique(owners, return_index=True)
+        best = order[np.sort(first)][:top_k]
+        indices[i, :len(best)] = state.sample_owner[cand][best]
+        scores[i, :len(best)] = exact[best]
+
+    return indices, scores
+
+
+def search_batch(queries, top_k=5, threshold=0.6, mode='centroid',
+                 shortlist=SHORTLIST_SIZE, knn=KNN_VOTES, nprobe=None, rerank=PQ_RERANK,
+                 rows=None, state=None):
+    """
+    Search catalog for many query vectors at once.
+
+    Args:
+        queries: (Q, 576) float32 array (or a single 576-dim vector)
+        top_k: max results per query
         threshold: minimum similarity score
+        mode: 'centroid', 'multi', 'ann' or 'pq' (see SEARCH_MODES)
+        shortlist: multi mode — products kept from the centroid stage
+        knn: multi/ann mode — nearest samples considered per result
+        nprobe: ann mode — IVF cells scanned (higher = better recall, slower)
+        rerank: pq mode — samples re-ranked with exact vectors
+        rows: optional int array of product rows to search among
+            (centroid/multi modes only; see rows_for)
+        state: generation to search (default: the current one, see snapshot)
 
     Returns:
-        list of {'productId', 'similarity', 'name'}
+        (indices, similarities) — (Q, top_k) int64 / float32 arrays, best first.
+        indices[i, j] is a row of the searched generation's matrix (map it
+        through that generation's product_ids, or use match_products),
+        -1 where the match is below threshold or the catalog is too small.
     """
-    if _matrix is None or len(_product_ids) == 0:
-        return []
+    if state is None:
+        state = _state
+    if mode not in SEARCH_MODES:
+        raise ValueError(f"Unknown search mode: {mode}")
+    if mode == 'ann' and state.ann is None:
+        raise ValueError("ANN index not built — call build_ann_index() first")
+    if mode == 'pq' and state.sample_codes is None:
+        raise ValueError("PQ codes not available — use storage mode 'pq' with enough samples")
+    if rows is not None and mode not in ('centroid', 'multi'):
+        raise ValueError("Row restriction is only supported in centroid and multi modes")
 
-    # Ensure query is L2-normalized
-    query = np.array(query_vector, dtype=np.float32).reshape(1, -1)
-    norm = np.linalg.norm(query)
-    if norm == 0:
-        return []
-    query = query / norm
+    q, valid = _prepare_queries(queries)
+    num_queries = q.shape[0]
 
-    # Cosine similarity = dot product of L2-normalized vectors
-    similarities = (_matrix @ query.T).flatten()
+    if state.matrix is None or len(state.product_ids) == 0 or top_k <= 0 or (rows is not None and len(rows) == 0):
+        return (np.full((num_queries, max(top_k, 0)), -1, dtype=np.int64),
+                np.zeros((num_queries, max(top_k, 0)), dtype=np.float32))
 
-    # Get top-k above threshold
-    indices = np.argsort(similarities)[::-1][:top_k]
-    results = []
-    for idx in indices:
-        sim = float(similarities[idx])
-        if sim < threshold:
-            break
-        pid = _product_ids[idx]
-        product_info = _catalog['products'].get(pid, {})
-        results.append({
-            'productId': pid,
-            'similarity': round(sim, 4),
-            'name': product_info.get('name', ''),
-        })
+    if mode == 'multi':
+        indices, scores = _search_multi(state, q, top_k, shortlist, knn, rows)
+    elif mode == 'ann':
+        indices, scores = _search_ann(state, q, top_k, knn, nprobe)
+    elif mode == 'pq':
+        indices, scores = _search_pq(state, q, top_k, rerank)
+    else:
+        indices, scores = _centroid_top_k(state, q, top_k, rows)
 
+    indices = indices.astype(np.int64)
+    keep = (scores >= threshold) & valid[:, None]
+    indices[~keep] = -1
+    scores = np.where(keep, scores, 0).astype(np.float32)
+
+    # Pad to top_k columns when the catalog has fewer rows than top_k
+    if indices.shape[1] < top_k:
+        pad = top_k - indices.shape[1]
+        indices = np.pad(indices, ((0, 0), (0, pad)), constant_values=-1)
+        scores = np.pad(scores, ((0, 0), (0, pad)))
+
+    return indices, scores
+
+
+def search_expected_first(queries, expected_ids, top_k=1, threshold=0.6, margin=EXPECTED_MARGIN,
+                          mode='centroid', state=None, **kwargs):
+    """
+    Two-tier search for display checks.
+
+    Tier 1 scores every query against the expected products only (a small
+    sub-matrix; multi-vector exact search unless mode is 'centroid').
+    Queries whose best expected similarity reaches `margin` are resolved
+    there; the rest fall through to the full catalog in `mode`, so a wrong
+    product on the shelf is still identified.
+
+    Args:
+        queries: (Q, 576) float32 array
+        expected_ids: product ids expected on the display
+        margin: min expected similarity to accept tier 1 (never below threshold)
+        state: generation to search (default: the current one); both tiers use it
+        kwargs: passed to search_batch (shortlist, knn, nprobe, rerank)
+
+    Returns:
+        (indices, similarities, resolved) — as search_batch, plus a (Q,) bool
+        array that is True where the query was resolved in tier 1
+    """
+    if state is None:
+        state = _state
+    q, valid = _prepare_queries(queries)
+    rows = rows_for(expected_ids, state)
+    margin = max(margin, threshold)
+
+    resolved = np.zeros(q.shape[0], dtype=bool)
+    if len(rows):
+        tier1_mode = 'centroid' if mode == 'centroid' else 'multi'
+        indices, scores = search_batch(q, top_k, -2.0, tier1_mode, rows=rows, state=state,
+                                       shortlist=kwargs.get('shortlist', SHORTLIST_SIZE),
+                                       knn=kwargs.get('knn', KNN_VOTES))
+        resolved = (scores[:, 0] >= margin) & valid
+        keep = scores >= threshold
+        indices[~keep] = -1
+        scores = np.where(keep, scores, 0).astype(np.float32)
+    else:
+        indices = np.full((q.shape[0], top_k), -1, dtype=np.int64)
+        scores = np.zeros((q.shape[0], top_k), dtype=np.float32)
+
+    fall_through = ~resolved
+    if fall_through.any():
+        full_idx, full_sims = search_batch(q[fall_through], top_k, threshold, mode, state=state, **kwargs)
+        indices[fall_through] = full_idx
+        scores[fall_through] = full_sims
+
+    return indices, scores, resolved
+
+
+def rows_for(product_ids, state=None):
+    """Search matrix rows of the given product ids (unknown ids are skipped)"""
+    row_of = (state or _state).row_of
+    return np.array([row_of[pid] for pid in dict.fromkeys(product_ids) if pid in row_of], dtype=np.int64)
+
+
+def match_products(queries, top_k=1, threshold=0.6, mode='centroid', expected_ids=None,
+                   margin=EXPECTED_MARGIN, **kwargs):
+    """
+    Search and resolve matches to product ids against one generation, so a
+    concurrent catalog change can never map a row to the wrong product.
+
+    Args:
+        queries: (Q, 576) float32 array
+        expected_ids: optional product ids expected on the display; when
+            given, search expected-first (see search_expected_first)
+        margin: expected-first tier 1 acceptance similarity
+        kwargs: passed to search_batch (shortlist, knn, nprobe, rerank)
+
+    Returns:
+        (product_ids, similarities, resolved) — product_ids is a list (one
+        per query) of top_k product ids, None where there is no match;
+        resolved is the (Q,) tier 1 mask (all False without expected_ids)
+    """
+    state = _state
+    if expected_ids:
+        indices, similarities, resolved = search_expected_first(
+            queries, expected_ids, top_k, threshold, margin, mode, state=state, **kwargs)
+    else:
+        indices, similarities = search_batch(queries, top_k, threshold, mode, state=state, **kwargs)
+        resolved = np.zeros(len(indices), dtype=bool)
+    ids = state.product_ids
+    return [[ids[i] if i >= 0 else None for i in row] for row in indices.tolist()], similarities, resolved
+
+
+def batch_to_dicts(indices, similarities, state=None):
+    """
+    Dict view of search_batch output for the HTTP layer.
+
+    Args:
+        state: the generation that was searched (default: the current one)
+
+    Returns:
+        list (one per query) of lists of {'productId', 'similarity', 'name'}
+    """
+    ids = (state or _state).product_ids
+    products = _catalog.get('products', {}) if _catalog else {}
+    results = []
+    for row_idx, row_sim in zip(indices.tolist(), similarities.tolist()):
+        matches = []
+        for idx, sim in zip(row_idx, row_sim):
+            if idx < 0:
+                break
+            pid = ids[idx]
+            matches.append({
+                'productId': pid,
+                'similarity': round(sim, 4),
+                'name': products.get(pid, {}).get('name', ''),
+            })
+        results.append(matches)
     return results
 
 
-def add_embedding(product_id, embedding, name=''):
+def search(query_vector, top_k=5, threshold=0.6, mode='centroid'):
+    """
+    Search catalog for closest products by cosine similarity.
+
+    Args:
+        query_vector: 576-dim numpy array (L2-normalized)
+        top_k: max results
+        threshold: minimum similarity score
+        mode: 'centroid', 'multi', 'ann' or 'pq' (see SEARCH_MODES)
+
+    Returns:
+        list of {'productId', 'similarity', 'name'}
+    """
+    state = _state
+    indices, similarities = search_batch(query_vector, top_k, threshold, mode, state=state)
+    return batch_to_dicts(indices, similarities, state)[0]
+
+
+def add_embedding(product_id, embedding, name='', rebuild=True, source=None):
     """
     Add an embedding to the catalog for a product.
     Updates centroid incrementally.
@@ -136,9 +1118,14 @@ def add_embedding(product_id, embedding, name=''):
         product_id: product identifier
         embedding: 576-dim list or numpy array
         name: human-readable product name
+        rebuild: rebuild search matrices now; pass False when adding many
+            embeddings and call rebuild_index() once at the end
+        source: BUILD_SOURCE for reference builder samples; any other
+            sample is also kept in the product's runtime samples
     """
     global _catalog
 
+    _check_writable()
     if _catalog is None:
         _catalog = {'version': 1, 'products': {}}
 
@@ -146,29 +1133,84 @@ def add_embedding(product_id, embedding, name=''):
     norm = np.linalg.norm(emb)
     if norm == 0:
         return False
-    emb = (emb / norm).tolist()
+    _insert_normalized(product_id, emb / norm, name, rebuild, source)
+    return True
+
+
+def add_embeddings_bulk(items):
+    """
+    Add many embeddings with a single search-matrix rebuild.
+    Call save() once afterwards for a single durable write.
+
+    Args:
+        items: iterable of (product_id, embedding, name) — embedding is a
+            576-dim list or numpy array
+
+    Returns:
+        list of bools, one per item (False for a missing id or an
+        empty, zero or wrong-sized embedding)
+    """
+    global _catalog
+
+    _check_writable()
+    if _catalog is None:
+        _catalog = {'version': 1, 'products': {}}
+
+    results = []
+    for product_id, embedding, name in items:
+        emb = np.asarray(embedding if embedding is not None else [], dtype=np.float32).reshape(-1)
+        norm = np.linalg.norm(emb) if emb.size == EMBEDDING_DIM else 0
+        if not product_id or norm == 0 or not np.isfinite(norm):
+            results.append(False)
+            continue
+        _insert_normalized(product_id, emb / norm, name or '', rebuild=False)
+        results.append(True)
+
+    if any(results):
+        _rebuild_matrix()
+    return results
+
+
+def _insert_normalized(product_id, emb, name, rebuild, source=None):
+    """add_embedding for an already L2-normalized float32 vector"""
+    # Incremental insert of the raw sample; it stays in the ANN index as valid
+    # evidence for the product until the index is rebuilt from stored vectors
+    if _ann is not None:
+        _ann.add(emb, [product_id])
 
     products = _catalog['products']
+    dtype = _storage_dtype()
+    _record_change('add', product_id, name, emb.astype(dtype))
+    _codes_cache.pop(product_id, None)
 
     if product_id in products:
         info = products[product_id]
-        embeddings = info.get('embeddings', [])
+        embeddings = info.get('embeddings')
+        if embeddings is None:
+            embeddings = np.empty((0, len(emb)), dtype=dtype)
 
-        # Limit stored embeddings to 20 per product (keep most recent)
-        if len(embeddings) >= 20:
-            embeddings = embeddings[-19:]
+        if _sample_policy == 'prototypes':
+            protos, weights = prototypes.add_sample(embeddings, info.get('weights'), emb,
+                                                    MAX_EMBEDDINGS, MERGE_SIMILARITY)
+            info['embeddings'] = protos.astype(dtype)
+            info['weights'] = weights
+            info['centroid'] = prototypes.weighted_centroid(protos, weights)
+        else:
+            # Limit stored embeddings per product (keep most recent)
+            if len(embeddings) >= MAX_EMBEDDINGS:
+                embeddings = embeddings[-(MAX_EMBEDDINGS - 1):]
 
-        embeddings.append(emb)
-        info['embeddings'] = embeddings
-        info['count'] = len(embeddings)
+            embeddings = np.concatenate([embeddings, emb[None].astype(dtype)])
+            info['embeddings'] = embeddings
+            info.pop('weights', None)
 
-        # Recalculate centroid
-        arr = np.array(embeddings, dtype=np.float32)
-        centroid = arr.mean(axis=0)
-        centroid_norm = np.linalg.norm(centroid)
-        if centroid_norm > 0:
-            centroid = centroid / centroid_norm
-        info['centroid'] = centroid.tolist()
+            # Recalculate centroid
+            centroid = embeddings.astype(np.float32).mean(axis=0)
+            centroid_norm = np.linalg.norm(centroid)
+            if centroid_norm > 0:
+                centroid = centroid / centroid_norm
+            info['centroid'] = centroid
+        info['count'] = len(info['embeddings'])
 
         if name:
             info['name'] = name
@@ -176,23 +1218,144 @@ def add_embedding(product_id, embedding, name=''):
         products[product_id] = {
             'name': name,
             'centroid': emb,
-            'embeddings': [emb],
+            'embeddings': emb[None].astype(dtype),
             'count': 1,
         }
+        if _sample_policy == 'prototypes':
+            products[product_id]['weights'] = [1]
 
-    _rebuild_matrix()
-    return True
+    if source != BUILD_SOURCE:
+        info = products[product_id]
+        kept = info.get('runtimeSamples')
+        if kept is None:
+            kept = np.empty((0, len(emb)), dtype=dtype)
+        info['runtimeSamples'] = np.concatenate([kept[-(MAX_EMBEDDINGS - 1):] if MAX_EMBEDDINGS > 1 else kept[:0],
+                                                 emb[None].astype(dtype)])
+
+    if rebuild:
+        _rebuild_matrix()
+
+
+def runtime_samples(product_id):
+    """
+    Samples of a product that did not come from the reference builder.
+
+    Returns:
+        (name, (n, 576) float32 array) — n is 0 for unknown products or
+        products built only from training crops
+    """
+    info = (_catalog or {}).get('products', {}).get(product_id, {})
+    samples = info.get('runtimeSamples')
+    if samples is None:
+        samples = np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+    return info.get('name', ''), np.asarray(samples, dtype=np.float32)
 
 
-def remove_product(product_id):
+def remove_product(product_id, rebuild=True):
     """Remove a product from catalog"""
+    _check_writable()
     if _catalog and product_id in _catalog.get('products', {}):
         del _catalog['products'][product_id]
-        _rebuild_matrix()
+        _codes_cache.pop(product_id, None)
+        _record_change('remove', product_id)
+        if _ann is not None:
+            _ann.remove_label(product_id)
+        if rebuild:
+            _rebuild_matrix()
         return True
     return False
 
 
+def _catalog_id():
+    """Random id of this catalog lineage (revisions are only comparable within one id)"""
+    return _catalog.setdefault('catalogId', uuid.uuid4().hex)
+
+
+def _record_change(op, product_id, name='', vector=None):
+    _catalog['revision'] = _catalog.get('revision', 0) + 1
+    _catalog_id()
+    _pending_changes.append(catalog_delta.Change(op, _catalog['revision'], product_id, name, vector))
+
+
+def get_revision():
+    """Catalog revision (number of add/remove operations applied) and lineage id"""
+    if _catalog is None:
+        return {'revision': 0, 'catalogId': None}
+    return {'revision': _catalog.get('revision', 0), 'catalogId': _catalog.get('catalogId')}
+
+
+def export_delta(since):
+    """
+    Binary delta with all changes after revision `since`.
+
+    Returns:
+        bytes, or None if the change log no longer reaches back to `since`
+        (trimmed, or the catalog was rebuilt) — the peer needs a full copy
+    """
+    if _catalog is None:
+        return None
+    revision = _catalog.get('revision', 0)
+    if since > revision:
+        return None
+    catalog_id = _catalog_id()
+
+    changes, _ = catalog_delta.read_log(CHANGELOG_FILE, catalog_id, EMBEDDING_DIM, since)
+    logged = {ch.revision for ch in changes}
+    changes += [ch for ch in _pending_changes if ch.revision > since and ch.revision not in logged]
+    if [ch.revision for ch in changes] != list(range(since + 1, revision + 1)):
+        return None
+    return catalog_delta.encode_delta(catalog_id, since, revision, changes)
+
+
+def import_delta(data):
+    """
+    Apply a delta from another node. Validated completely before anything
+    is changed, then applied in one go with a single index rebuild; call
+    save() afterwards to persist. Changes already applied are skipped, so
+    overlapping deltas are harmless.
+
+    Returns:
+        dict with applied change count and the new revision
+
+    Raises:
+        ValueError if the delta is malformed, belongs to another catalog
+        lineage or does not connect to the local revision
+    """
+    global _catalog
+
+    _check_writable()
+    if _catalog is None:
+        _catalog = {'version': 1, 'products': {}}
+
+    catalog_id, base, target, changes = catalog_delta.decode_delta(data, EMBEDDING_DIM)
+    local = _catalog.get('revision', 0)
+    local_id = _catalog.get('catalogId')
+
+    if local_id is not None and local_id != catalog_id and local > 0:
+        raise ValueError(f"Delta is for catalog {catalog_id}, local catalog is {local_id}")
+    if base > local:
+        raise ValueError(f"Delta starts at revision {base}, local catalog is at {local} — fetch an older delta")
+    if [ch.revision for ch in changes] != list(range(base + 1, target + 1)):
+        raise ValueError("Delta revisions are not contiguous")
+    for ch in changes:
+        if ch.op == 'add' and not np.any(ch.vector):
+            raise ValueError(f"Zero embedding for {ch.product_id} at revision {ch.revision}")
+
+    todo = [ch for ch in changes if ch.revision > local]
+    _catalog['catalogId'] = catalog_id
+    for ch in todo:
+        if ch.op == 'add':
+            # Stored vectors are already normalized; re-normalizing would drift by an ulp
+            _insert_normalized(ch.product_id, ch.vector.astype(np.float32), ch.name, rebuild=False)
+        elif not remove_product(ch.product_id, rebuild=False):
+            # Unknown product: still record it so revisions stay aligned with the source
+            _record_change('remove', ch.product_id)
+
+    if todo:
+        _rebuild_matrix()
+    return {'applied': len(todo), 'skipped': len(changes) - len(todo), 'revision': _catalog.get('revision', 0)}
+
+
 def get_stats():
     """Get catalog statistics"""
     if _catalog is None:
@@ -200,13 +1363,67 @@ def get_stats():
 
     products = _catalog.get('products', {})
     total_emb = sum(p.get('count', 0) for p in products.values())
+    ann = _state.ann
 
     return {
         'loaded': True,
         'productCount': len(products),
         'totalEmbeddings': total_emb,
+        **get_revision(),
+        'samplePolicy': {'policy': _sample_policy, 'maxVectors': MAX_EMBEDDINGS, 'mergeSimilarity': MERGE_SIMILARITY},
         'catalogFile': str(CATALOG_FILE),
         'catalogExists': CATALOG_FILE.exists(),
+        'annIndex': {'vectors': len(ann), 'nlist': ann.nlist, 'nprobe': ann.nprobe} if ann else None,
+        'storage': _storage_stats(),
+        'shared': {'dir': str(_shared_dir), 'generation': shared_generation(), 'readOnly': _read_only}
+        if _shared_dir is not None else None,
+    }
+
+
+def _storage_stats():
+    """
+    Bytes per stored sample vector and resident size. bytesPerVector is what
+    is actually searched per sample now: PQ codes only once trained (pq mode
+    with too few samples still scans the float16 vectors); 'modes' projects
+    the same samples onto each storage mode.
+    """
+    state = _state
+    pq = state.pq
+    vectors = 0 if state.sample_owner is None else len(state.sample_owner)
+    pq_bytes = pq.bytes_per_vector if pq else DEFAULT_SUBSPACES
+    codebook_bytes = pq.nbytes if pq else DEFAULT_SUBSPACES * CODEBOOK_SIZE * (EMBEDDING_DIM // DEFAULT_SUBSPACES) * 4
+
+    modes = {
+        'float32': {'bytesPerVector': EMBEDDING_DIM * 4, 'totalBytes': vectors * EMBEDDING_DIM * 4},
+        'float16': {'bytesPerVector': EMBEDDING_DIM * 2, 'totalBytes': vectors * EMBEDDING_DIM * 2},
+        'pq': {'bytesPerVector': pq_bytes, 'totalBytes': vectors * pq_bytes + codebook_bytes},
+    }
+
+    # Private (per-process) arrays; memory-mapped ones are shared or paged on demand
+    arrays = [state.matrix, state.sample_matrix, state.sample_offsets, state.sample_rows, state.sample_owner,
+              state.sample_codes]
+    if pq is not None:
+        arrays.append(pq.codebooks)
+    resident = sum(arr.nbytes for arr in arrays if arr is not None and not isinstance(arr, np.memmap))
+    mapped = sum(arr.nbytes for arr in arrays if isinstance(arr, np.memmap))
+    ann_bytes = state.ann.nbytes if state.ann is not None else 0
+
+    if state.sample_codes is not None:
+        bytes_per_vector = state.sample_codes.shape[1] * state.sample_codes.itemsize
+    elif state.sample_matrix is not None:
+        bytes_per_vector = EMBEDDING_DIM * state.sample_matrix.itemsize
+    else:
+        bytes_per_vector = EMBEDDING_DIM * np.dtype(_storage_dtype()).itemsize
+
+    return {
+        'mode': _storage_mode,
+        'vectors': vectors,
+        'bytesPerVector': bytes_per_vector,
+        'pqCodes': state.sample_codes is not None,
+        'residentBytes': resident,
+        'mappedBytes': mapped,
+        'annIndexBytes': ann_bytes,
+        'modes': modes,
     }
 
 
@@ -0,0 +1,486 @@
+#!/usr/bin/env python3
+"""
+Evaluate embedding catalog search modes on training crops.
+
+Embeds every labeled crop from the training directories (same crops as
+build_reference_catalog), holds out a deterministic subset of source images
+per product as queries, builds an in-memory catalog from the rest and
+compares accuracy and latency of each available search mode (pq needs
+EMBEDDING_STORAGE=pq). The real catalog file is never touched.
+
+A fraction of products (--unknown) is left out of the reference catalog
+entirely; their crops are open-set queries for the similarity-threshold
+ROC (the similarityThreshold of /display-embed): per threshold, the share
+of known crops accepted with the right / wrong product and the share of
+unknown crops falsely accepted.
+
+The JSON report (--output) also has search latency percentiles, catalog
+memory, embedding throughput (when crops were embedded in this run, or
+--embed-bench N on synthetic inputs) and run metadata (time, git commit,
+config). --compare old.json prints the changes against an earlier report;
+--history runs.jsonl appends a one-line summary per run.
+
+With --policies prototypes recent [--budget K], the reference catalog is
+built once per sample policy at the same per-product budget, so accuracy
+can be compared at equal memory and search cost.
+
+With --expected-first, also validates the two-tier display search: simulated
+displays (10-40 expected products, some crops of unexpected products) are
+searched with search_expected_first and compared against the full search
+for each margin, reporting top-1 agreement and the cheap-tier fraction.
+yolo_server keeps expected-first off (EMBEDDING_EXPECTED_FIRST=false) until
+this shows full agreement at the chosen EMBEDDING_EXPECTED_MARGIN.
+
+Usage:
+  python3 evaluate_catalog.py [--holdout 0.2] [--unknown 0.1] [--cache crops.npz] [--output report.json]
+  python3 evaluate_catalog.py --cache crops.npz --output new.json --compare old.json --history runs.jsonl
+  python3 evaluate_catalog.py --expected-first [--margins 0.6 0.7 0.75 0.8]
+  python3 evaluate_catalog.py --policies prototypes recent --budget 8
+"""
+import sys
+import json
+import time
+import hashlib
+import argparse
+import subprocess
+from pathlib import Path
+
+import numpy as np
+
+SCRIPT_DIR = Path(__file__).parent
+sys.path.insert(0, str(SCRIPT_DIR))
+
+import embedding_catalog as catalog
+from build_reference_catalog import (
+    load_class_mapping, load_embedder, embed_batch, iter_embedded_images,
+    new_pipeline_stats, pipeline_report, EMBEDDER_VERSION,
+)
+
+# Top-1 similarity thresholds swept for the ROC (/display-embed defaults to 0.6)
+ROC_THRESHOLDS = [round(t, 2) for t in np.arange(0.05, 0.96, 0.05)]
+
+
+def collect_crops(cache_path=None):
+    """
+    Embed all labeled crops.
+
+    Returns:
+        (embeddings (M, 576) float32, product_ids list, source keys list,
+         embedding pipeline report — None when loaded from the cache)
+    """
+    if cache_path and Path(cache_path).exists():
+        data = np.load(cache_path)
+        print(f"[Eval] Loaded {len(data['product_ids'])} crops from cache {cache_path}")
+        return data['embeddings'], data['product_ids'].tolist(), data['sources'].tolist(), None
+
+    _, inverted = load_class_mapping()
+    if not inverted:
+        raise RuntimeError('No class mapping — cannot map class IDs to product IDs')
+
+    print("[Eval] Loading MobileNetV3-Small...")
+    net, transform = load_embedder()
+
+    embeddings, product_ids, sources = [], [], []
+    stats = new_pipeline_stats(1, 32)
+    for train_dir, label_file, img_path, results, error in iter_embedded_images(
+            inverted, net, transform, stats=stats):
+        if error is not None:
+            print(f"[Eval] Error processing {label_file.name}: {error}")
+            continue
+        for product_id, emb in results:
+            embeddings.append(emb)
+            product_ids.append(product_id)
+            sources.append(f'{train_dir.name}/{img_path.stem}')
+
+    embeddings = np.array(embeddings, dtype=np.float32).reshape(len(product_ids), -1)
+    if cache_path:
+        np.savez(cache_path, embeddings=embeddings,
+                 product_ids=np.array(product_ids), sources=np.array(sources))
+        print(f"[Eval] Cached {len(product_ids)} crops to {cache_path}")
+    return embeddings, product_ids, sources, pipeline_report(stats)
+
+
+def embed_throughput(count, batch_sizes=(1, 32)):
+    """Embedder-only crops/sec on random 224x224 inputs (no image decoding)"""
+    import torch
+
+    net, _ = load_embedder()
+    tensors = list(torch.rand(count, 3, 224, 224))
+    result = {}
+    for batch_size in batch_sizes:
+        embed_batch(net, tensors[:batch_size])    # warm-up
+        start = time.perf_counter()
+        for i in range(0, count, batch_size):
+            embed_batch(net, tensors[i:i + batch_size])
+        result[f'batch{batch_size}CropsPerSec'] = round(count / (time.perf_counter() - start), 1)
+    return result
+
+
+def _source_rank(source):
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+
+def split_holdout(product_ids, sources, holdout):
+    """
+    Deterministic held-out split per product, by source image.
+
+    Each product with 2+ source images gets round(n * holdout) of them
+    (at least 1, at most n - 1) held out as queries, picked by hash order.
+    All crops of a held-out image are queries for that product.
+
+    Returns:
+        boolean mask — True for query crops
+    """
+    images_by_product = {}
+    for pid, src in zip(product_ids, sources):
+        images_by_product.setdefault(pid, set()).add(src)
+
+    held_out = set()
+    for pid, images in images_by_product.items():
+        if len(images) < 2:
+            continue
+        n_hold = min(len(images) - 1, max(1, round(len(images) * holdout)))
+        for src in sorted(images, key=_source_rank)[:n_hold]:
+            held_out.add((pid, src))
+
+    return np.array([(pid, src) in held_out for pid, src in zip(product_ids, sources)], dtype=bool)
+
+
+def split_unknown(product_ids, fraction):
+    """
+    Deterministic set of products (by id hash) left out of the reference
+    catalog entirely, so their crops act as unknown-product queries.
+    """
+    products = sorted(set(product_ids), key=_source_rank)
+    return set(products[:round(len(products) * fraction)]) if fraction > 0 else set()
+
+
+def build_memory_catalog(embeddings, product_ids, policy=None, budget=None):
+    """Replace the in-memory catalog with the given reference crops (never saved)"""
+    if policy or budget:
+        catalog.set_sample_policy(policy or catalog._sample_policy, budget)
+    catalog._catalog = {'version': 1, 'products': {}}
+    for pid, emb in zip(product_ids, embeddings):
+        catalog.add_embedding(pid, emb, rebuild=False, source=catalog.BUILD_SOURCE)
+    catalog.rebuild_index()
+    catalog.build_ann_index()
+
+
+def percentile_ms(samples, q):
+    return round(float(np.percentile(samples, q)) * 1000, 3) if samples else 0.0
+
+
+def _search_all(mode, queries, batch_size, top_k=5):
+    """Search in batches; returns (indices, similarities, per-batch seconds)"""
+    indices, sims, times = [], [], []
+    for i in range(0, len(queries), batch_size):
+        start = time.perf_counter()
+        idx, sim = catalog.search_batch(queries[i:i + batch_size], top_k=top_k, threshold=-1.0, mode=mode)
+        times.append(time.perf_counter() - start)
+        indices.append(idx)
+        sims.append(sim)
+    if not indices:
+        return np.empty((0, top_k), dtype=np.int64), np.empty((0, top_k), dtype=np.float32), times
+    return np.concatenate(indices), np.concatenate(sims), times
+
+
+def threshold_roc(known_sims, known_correct, unknown_sims):
+    """
+    Accept/reject trade-off of the top-1 similarity threshold.
+
+    Returns:
+        (points, suggested threshold) — suggested maximizes
+        correct - wrong - falsely accepted unknown
+    """
+    points = []
+    for t in ROC_THRESHOLDS:
+        accepted = known_sims >= t
+        point = {
+            'threshold': t,
+            'correctAccept': round(float(np.mean(accepted & known_correct)), 4) if len(known_sims) else 0.0,
+            'wrongAccept': round(float(np.mean(accepted & ~known_correct)), 4) if len(known_sims) else 0.0,
+            'unknownAccept': round(float(np.mean(unknown_sims >= t)), 4) if len(unknown_sims) else None,
+        }
+        points.append(point)
+    best = max(points, key=lambda p: p['correctAccept'] - p['wrongAccept'] - (p['unknownAccept'] or 0))
+    return points, best['threshold']
+
+
+def evaluate_mode(mode, queries, truth, batch_size, unknown_queries=None):
+    """Top-1/top-5 accuracy, threshold ROC and latency of one search mode"""
+    # Accuracy + batched throughput (one batch ~ the crops of one shelf photo)
+    top_indices, top_sims, batch_times = _search_all(mode, queries, batch_size)
+    batched_s = sum(batch_times)
+
+    row_of = catalog.snapshot().row_of
+    truth_rows = np.array([row_of.get(pid, -2) for pid in truth], dtype=np.int64)
+    top1 = float(np.mean(top_indices[:, 0] == truth_rows)) if len(truth_rows) else 0.0
+    top5 = float(np.mean((top_indices == truth_rows[:, None]).any(axis=1))) if len(truth_rows) else 0.0
+
+    unknown_sims = np.empty(0, dtype=np.float32)
+    if unknown_queries is not None and len(unknown_queries):
+        unknown_sims = _search_all(mode, unknown_queries, batch_size, top_k=1)[1][:, 0]
+    roc, suggested = threshold_roc(top_sims[:, 0], top_indices[:, 0] == truth_rows, unknown_sims)
+
+    # Single-query latency
+    single = []
+    for q in queries[:500]:
+        t0 = time.perf_counter()
+        catalog.search_batch(q, top_k=1, threshold=-1.0, mode=mode)
+        single.append(time.perf_counter() - t0)
+
+    return {
+        'mode': mode,
+        'top1': round(top1, 4),
+        'top5': round(top5, 4),
+        'batchedMsPerQuery': round(batched_s * 1000 / max(len(queries), 1), 4),
+        'batchP50Ms': percentile_ms(batch_times, 50),
+        'batchP95Ms': percentile_ms(batch_times, 95),
+        'batchP99Ms': percentile_ms(batch_times, 99),
+        'singleP50Ms': percentile_ms(single, 50),
+        'singleP95Ms': percentile_ms(single, 95),
+        'singleP99Ms': percentile_ms(single, 99),
+        'roc': roc,
+        'suggestedThreshold': suggested,
+    }
+
+
+def peak_rss_bytes():
+    """Peak RSS of this process, or None where the resource module is missing (Windows)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024    # kilobytes on Linux, bytes on macOS
+
+
+def memory_report():
+    """Catalog memory of the currently built in-memory catalog, plus process peak RSS"""
+    storage = catalog.get_stats()['storage']
+    return {
+        'storageMode': storage['mode'],
+        'vectors': storage['vectors'],
+        'bytesPerVector': storage['bytesPerVector'],
+        'residentBytes': storage['residentBytes'],
+        'annIndexBytes': storage['annIndexBytes'],
+        'processPeakRssBytes': peak_rss_bytes(),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=SCRIPT_DIR,
+                              capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def compare_reports(old, new):
+    """Print top-1 / latency / memory changes per (policy, mode) against an older report"""
+    def key(m):
+        return m.get('policy'), m['mode']
+    old_modes = {key(m): m for m in old.get('modes', [])}
+    print(f"\n[Eval] Compared with {old.get('gitCommit') or '?'} ({old.get('timestamp', '?')})")
+    for m in new['modes']:
+        o = old_modes.get(key(m))
+        if o is None:
+            print(f"[Eval] {m['mode']:>8}: new")
+            continue
+        print(f"[Eval] {m['mode']:>8}: top1 {o['top1']:.4f} -> {m['top1']:.4f} ({m['top1'] - o['top1']:+.4f}), "
+              f"single p95 {o['singleP95Ms']:.3f} -> {m['singleP95Ms']:.3f} ms, "
+              f"threshold {o.get('suggestedThreshold')} -> {m.get('suggestedThreshold')}")
+    if old.get('memory') and new.get('memory'):
+        print(f"[Eval] catalog resident bytes {old['memory']['residentBytes']} -> {new['memory']['residentBytes']}")
+
+
+def simulate_displays(truth, num_displays=200, crops_per_display=32, intruder_rate=0.1, seed=0):
+    """
+    Random display checks over the query crops.
+
+    Each display takes a random batch of query crops; its expected list is
+    the products of those crops minus ~intruder_rate of them (wrong-product
+    placements), padded with random catalog products to 10-40 entries.
+
+    Returns:
+        list of (query index array, expected product ids)
+    """
+    rng = np.random.default_rng(seed)
+    all_products = list(catalog.snapshot().product_ids)
+    displays = []
+    for _ in range(num_displays):
+        picked = rng.choice(len(truth), size=min(crops_per_display, len(truth)), replace=False)
+        present = list(dict.fromkeys(truth[i] for i in picked))
+        expected = [pid for pid in present if rng.random() >= intruder_rate]
+
+        size = int(rng.integers(10, 41))
+        for j in rng.permutation(len(all_products)):
+            if len(expected) >= size:
+                break
+            if all_products[j] not in expected:
+                expected.append(all_products[j])
+        displays.append((picked, expected))
+    return displays
+
+
+def validate_expected_first(mode, queries, truth, margins, threshold=0.6):
+    """Two-tier vs full search top-1 agreement and cheap-tier fraction per margin"""
+    displays = simulate_displays(truth)
+    results = []
+    for margin in margins:
+        crops = agree = resolved_total = 0
+        full_s = two_tier_s = 0.0
+        for picked, expected in displays:
+            batch = queries[picked]
+            t0 = time.perf_counter()
+            full_idx, _ = catalog.search_batch(batch, top_k=1, threshold=threshold, mode=mode)
+            t1 = time.perf_counter()
+            idx, _, resolved = catalog.search_expected_first(batch, expected, top_k=1, threshold=threshold,
+                                                             margin=margin, mode=mode)
+            t2 = time.perf_counter()
+            full_s += t1 - t0
+            two_tier_s += t2 - t1
+            crops += len(picked)
+            agree += int((idx[:, 0] == full_idx[:, 0]).sum())
+            resolved_total += int(resolved.sum())
+
+        results.append({
+            'mode': mode,
+            'margin': margin,
+            'crops': crops,
+            'agreement': round(agree / max(crops, 1), 4),
+            'cheapTierFraction': round(resolved_total / max(crops, 1), 4),
+            'fullMsPerDisplay': round(full_s * 1000 / max(len(displays), 1), 4),
+            'twoTierMsPerDisplay': round(two_tier_s * 1000 / max(len(displays), 1), 4),
+        })
+    return results
+
+
+def run(holdout=0.2, cache_path=None, batch_size=32, output=None, expected_margins=None,
+        policies=None, budget=None, unknown=0.1, embed_bench=0, compare=None, history=None):
+    embeddings, product_ids, sources, pipeline = collect_crops(cache_path)
+    if len(product_ids) == 0:
+        print("[Eval] No labeled crops found")
+        return None
+
+    unknown_products = split_unknown(product_ids, unknown)
+    is_unknown = np.array([pid in unknown_products for pid in product_ids], dtype=bool)
+    is_query = split_holdout(product_ids, sources, holdout) & ~is_unknown
+    is_ref = ~is_query & ~is_unknown
+    ref_ids = [pid for pid, r in zip(product_ids, is_ref) if r]
+    query_ids = [pid for pid, q in zip(product_ids, is_query) if q]
+
+    queries = np.ascontiguousarray(embeddings[is_query])
+    unknown_queries = np.ascontiguousarray(embeddings[is_unknown])
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'gitCommit': git_commit(),
+        'config': {
+            'holdout': holdout,
+            'unknown': unknown,
+            'batch': batch_size,
+            'storage': catalog._storage_mode,
+            'budget': budget or catalog.MAX_EMBEDDINGS,
+            'embedder': EMBEDDER_VERSION,
+            'cache': str(cache_path) if cache_path else None,
+        },
+        'crops': len(product_ids),
+        'referenceCrops': len(ref_ids),
+        'queryCrops': len(query_ids),
+        'unknownProducts': len(unknown_products),
+        'unknownCrops': int(is_unknown.sum()),
+        'modes': [],
+    }
+
+    # The first policy's catalog stays loaded for the expected-first validation
+    for policy in reversed(policies or [catalog._sample_policy]):
+        build_memory_catalog(embeddings[is_ref], ref_ids, policy, budget)
+        owners = catalog.snapshot().sample_owner
+        stored = len(owners) if owners is not None else 0
+        report['products'] = catalog.get_stats()['productCount']
+        report['modes'][:0] = [
+            dict(evaluate_mode(mode, queries, query_ids, batch_size, unknown_queries),
+                 policy=policy, budget=catalog.MAX_EMBEDDINGS, storedVectors=stored)
+            for mode in catalog.available_search_modes()
+        ]
+    report['memory'] = memory_report()
+
+    report['embedding'] = {'pipeline': pipeline}
+    if embed_bench:
+        report['embedding']['model'] = embed_throughput(embed_bench)
+
+    print(f"\n[Eval] {report['products']} products, {report['referenceCrops']} reference crops, "
+          f"{report['queryCrops']} query crops, {report['unknownCrops']} unknown-product crops")
+    for m in report['modes']:
+        print(f"[Eval] {m['policy']:>10} (k={m['budget']}, {m['storedVectors']} stored) {m['mode']:>8}: "
+              f"top1={m['top1']:.4f} top5={m['top5']:.4f} "
+              f"batched={m['batchedMsPerQuery']:.4f} ms/q "
+              f"single p50={m['singleP50Ms']:.3f} p95={m['singleP95Ms']:.3f} p99={m['singleP99Ms']:.3f} ms "
+              f"threshold={m['suggestedThreshold']}")
+    mem = report['memory']
+    peak = mem['processPeakRssBytes']
+    print(f"[Eval] memory: {mem['vectors']} {mem['storageMode']} vectors, "
+          f"{mem['residentBytes'] / 1e6:.1f} MB resident + {mem['annIndexBytes'] / 1e6:.1f} MB ANN, "
+          f"peak RSS {f'{peak / 1e6:.0f} MB' if peak is not None else 'n/a'}")
+    if pipeline:
+        print(f"[Eval] embedding pipeline: {pipeline}")
+    if report['embedding'].get('model'):
+        print(f"[Eval] embedder throughput: {report['embedding']['model']}")
+
+    if expected_margins and len(query_ids):
+        report['expectedFirst'] = [
+            r for mode in catalog.available_search_modes()
+            for r in validate_expected_first(mode, queries, query_ids, expected_margins)
+        ]
+        print()
+        for r in report['expectedFirst']:
+            print(f"[Eval] expected-first {r['mode']:>8} margin={r['margin']:.2f}: "
+                  f"agreement={r['agreement']:.4f} cheap tier={r['cheapTierFraction']:.4f} "
+                  f"full={r['fullMsPerDisplay']:.3f} ms two-tier={r['twoTierMsPerDisplay']:.3f} ms per display")
+
+    if compare:
+        with open(compare) as f:
+            compare_reports(json.load(f), report)
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"[Eval] Report written to {output}")
+    if history:
+        summary = {k: report[k] for k in ('timestamp', 'gitCommit', 'config', 'products', 'queryCrops')}
+        summary['modes'] = [
+            {k: m[k] for k in ('policy', 'mode', 'top1', 'top5', 'singleP95Ms', 'batchedMsPerQuery',
+                               'suggestedThreshold')}
+            for m in report['modes']
+        ]
+        summary['residentBytes'] = report['memory']['residentBytes']
+        with open(history, 'a') as f:
+            f.write(json.dumps(summary) + '\n')
+        print(f"[Eval] Summary appended to {history}")
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Evaluate embedding catalog search modes')
+    parser.add_argument('--holdout', type=float, default=0.2, help='Fraction of source images held out per product')
+    parser.add_argument('--unknown', type=float, default=0.1,
+                        help='Fraction of products left out of the catalog as unknown-product queries')
+    parser.add_argument('--cache', type=str, help='npz file to cache crop embeddings between runs')
+    parser.add_argument('--batch', type=int, default=32, help='Queries per search_batch call')
+    parser.add_argument('--output', type=str, help='Write JSON report to this file')
+    parser.add_argument('--expected-first', action='store_true',
+                        help='Validate two-tier expected-product search against the full search')
+    parser.add_argument('--margins', type=float, nargs='+', default=[0.6, 0.7, 0.75, 0.8],
+                        help='Expected-similarity margins for --expected-first')
+    parser.add_argument('--policies', nargs='+', choices=catalog.SAMPLE_POLICIES,
+                        help='Sample policies to compare (default: current EMBEDDING_SAMPLE_POLICY)')
+    parser.add_argument('--budget', type=int, help='Stored vectors per product (default: EMBEDDING_PROTOTYPES)')
+    parser.add_argument('--embed-bench', type=int, default=0, metavar='N',
+                        help='Also measure embedder throughput on N synthetic crops (batch 1 and 32)')
+    parser.add_argument('--compare', type=str, help='Earlier JSON report to compare against')
+    parser.add_argument('--history', type=str, help='Append a one-line JSON summary to this file')
+    args = parser.parse_args()
+
+    run(args.holdout, args.cache, args.batch, args.output,
+        args.margins if args.expected_first else None, args.policies, args.budget,
+        args.unknown, args.embed_bench, args.compare, args.history)
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+"""
+Low-priority runner for heavy background jobs (YOLO training, catalog builds).
+
+The job command runs as a child process with:
+  - nice JOB_NICE and idle I/O class (ionice -c3, when available)
+  - CPU affinity to JOB_CPUS (e.g. "2-5" or "4,5"; default: all but core 0)
+  - a thread cap (OMP/MKL/torch threads and YOLO dataloader workers = JOB_THREADS)
+
+While it runs, the inference servers' /health "inflight" counters are polled.
+When more than JOB_PAUSE_QUEUE_DEPTH requests are in flight the job is
+paused (SIGSTOP on its process group) and continued once load has stayed at
+or below the threshold for JOB_RESUME_AFTER seconds. A job started with
+--restartable (finetune, build_reference_catalog — both resume from their
+checkpoint / manifest) is terminated instead of kept stopped when a pause
+outlasts JOB_MAX_PAUSE seconds, freeing its memory, and is started again
+when load clears.
+
+Status is written to jobs/<id>.json (state, pid, pauses, CPU seconds, RSS,
+settings) and output to jobs/<id>.log, for the Node side to poll.
+
+Usage:
+  python3 job_runner.py run --name finetune --restartable -- \\
+      python3 yolo_inference.py --mode finetune --data /path/data.yaml
+  python3 job_runner.py run --name catalog --restartable -- python3 build_reference_catalog.py --workers 2
+  python3 job_runner.py status [JOB_ID]
+  python3 job_runner.py cancel JOB_ID
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import signal
+import argparse
+import subprocess
+import urllib.request
+from pathlib import Path
+
+SCRIPT_DIR = Path(__file__).parent
+JOBS_DIR = Path(os.environ.get('JOB_DIR', str(SCRIPT_DIR / 'jobs')))
+
+JOB_NICE = int(os.environ.get('JOB_NICE', '15'))
+JOB_CPUS = os.environ.get('JOB_CPUS', '')
+JOB_THREADS = int(os.environ.get('JOB_THREADS', '0'))
+JOB_PAUSE_QUEUE_DEPTH = int(os.environ.get('JOB_PAUSE_QUEUE_DEPTH', '2'))
+JOB_RESUME_AFTER = float(os.environ.get('JOB_RESUME_AFTER', '15'))
+JOB_MAX_PAUSE = float(os.environ.get('JOB_MAX_PAUSE', '600'))
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', '2'))
+# Inference servers whose /health reports "inflight"
+JOB_HEALTH_URLS = [u for u in os.environ.get(
+    'JOB_HEALTH_URLS', 'http://127.0.0.1:5002/health,http://127.0.0.1:5001/health').split(',') if u]
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+
+def parse_cpus(spec):
+    """'2-5,7' -> [2, 3, 4, 5, 7]; '' -> every available core but the first (left to inference)"""
+    available = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+    if not spec:
+        return available[1:] or available
+    cpus = []
+    for part in spec.split(','):
+        if '-' in part:
+            lo, hi = part.split('-')
+            cpus.extend(range(int(lo), int(hi) + 1))
+        elif part.strip():
+            cpus.append(int(part))
+    return [c for c in cpus if c in available] or available
+
+
+def inference_queue_depth(urls=None):
+    """Sum of in-flight requests reported by the inference servers (unreachable = 0)"""
+    depth = 0
+    for url in urls or JOB_HEALTH_URLS:
+        try:
+            with urllib.request.urlopen(url, timeout=2) as resp:
+                depth += int(json.loads(resp.read()).get('inflight', 0))
+        except Exception:
+            continue
+    return depth
+
+
+def _process_tree(pid):
+    """pid and all its descendants (from /proc)"""
+    children = {}
+    for entry in Path('/proc').iterdir():
+        if not entry.name.isdigit():
+            continue
+        try:
+            stat = (entry / 'stat').read_text()
+        except OSError:
+            continue
+        ppid = int(stat.rsplit(')', 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(entry.name))
+    tree, todo = [], [pid]
+    while todo:
+        p = todo.pop()
+        tree.append(p)
+        todo.extend(children.get(p, []))
+    return tree
+
+
+def resource_usage(pid):
+    """CPU seconds and resident memory of a process tree (Linux /proc; zeros elsewhere)"""
+    cpu_ticks = rss_kb = 0
+    if not Path('/proc').is_dir():
+        return {'cpuSeconds': 0.0, 'rssMb': 0.0, 'processes': 0}
+    tree = _process_tree(pid)
+    for p in tree:
+        try:
+            fields = Path(f'/proc/{p}/stat').read_text().rsplit(')', 1)[1].split()
+            cpu_ticks += int(fields[11]) + int(fields[12])    # utime + stime
+            for line in Path(f'/proc/{p}/status').read_text().splitlines():
+                if line.startswith('VmRSS:'):
+                    rss_kb += int(line.split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+    return {'cpuSeconds': round(cpu_ticks / CLOCK_TICKS, 1), 'rssMb': round(rss_kb / 1024, 1),
+            'processes': len(tree)}
+
+
+def _status_path(job_id):
+    return JOBS_DIR / f'{job_id}.json'
+
+
+def write_status(status):
+    JOBS_DIR.mkdir(parents=True, exist_ok=True)
+    path = _status_path(status['id'])
+    tmp = path.with_name(f'.{path.name}.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(status, f, indent=2, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def read_status(job_id=None):
+    """One job's status, or all jobs (newest first)"""
+    if job_id:
+        try:
+            with open(_status_path(job_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+    jobs = []
+    for path in JOBS_DIR.glob('*.json') if JOBS_DIR.exists() else []:
+        try:
+            with open(path) as f:
+                jobs.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return sorted(jobs, key=lambda j: j.get('createdAt', ''), reverse=True)
+
+
+def _child_env(threads):
+    env = dict(os.environ)
+    for var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+        env[var] = str(threads)
+    env['YOLO_TRAIN_WORKERS'] = str(min(threads, 2))
+    return env
+
+
+def _start(command, cpus, log_file, threads):
+    def lower_priority():
+        os.setsid()    # own process group: pause/cancel reach dataloader workers too
+        os.nice(JOB_NICE)
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cpus)
+
+    proc = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT, cwd=str(SCRIPT_DIR),
+                            env=_child_env(threads), preexec_fn=lower_priority)
+    if shutil.which('ionice'):
+        subprocess.run(['ionice', '-c3', '-p', str(proc.pid)], stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL, check=False)
+    return proc
+
+
+def _signal_group(proc, sig):
+    try:
+        os.killpg(proc.pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+def run_job(name, command, restartable=False, cpus_spec=None, threads=None, job_id=None):
+    """
+    Run a command under the job runner until it finishes.
+
+    Returns:
+        exit code of the job (0 on success)
+    """
+    cpus = parse_cpus(JOB_CPUS if cpus_spec is None else cpus_spec)
+    threads = threads or JOB_THREADS or len(cpus)
+    job_id = job_id or f'{time.strftime("%Y%m%d-%H%M%S")}-{name}-{uuid.uuid4().hex[:6]}'
+    JOBS_DIR.mkdir(parents=True, exist_ok=True)
+    log_path = JOBS_DIR / f'{job_id}.log'
+
+    status = {
+        'id': job_id,
+        'name': name,
+        'command': command,
+        'state': 'running',
+        'createdAt': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'finishedAt': None,
+        'exitCode': None,
+        'pid': None,
+        'runnerPid': os.getpid(),
+        'log': str(log_path),
+        'settings': {'nice': JOB_NICE, 'cpus': cpus, 'threads': threads, 'restartable': restartable,
+                     'pauseQueueDepth': JOB_PAUSE_QUEUE_DEPTH, 'maxPauseSeconds': JOB_MAX_PAUSE},
+        'starts': 0,
+        'pauses': 0,
+        'pausedSeconds': 0.0,
+        'queueDepth': 0,
+        'usage': {'cpuSeconds': 0.0, 'rssMb': 0.0, 'processes': 0},
+        'cpuSecondsTotal': 0.0,
+        'peakRssMb': 0.0,
+    }
+
+    cancelled = {'flag': False}
+
+    def on_cancel(signum, frame):
+        cancelled['flag'] = True
+
+    signal.signal(signal.SIGTERM, on_cancel)
+    signal.signal(signal.SIGINT, on_cancel)
+
+    with open(log_path, 'ab') as log_file:
+        proc = None
+        cpu_before = 0.0    # CPU of earlier (terminated) starts
+        paused_since = None
+        calm_since = None
+
+        while True:
+            if proc is None:
+                proc = _start(command, cpus, log_file, threads)
+                status.update(pid=proc.pid, state='running', starts=status['starts'] + 1)
+                print(f"[Jobs] {job_id}: started pid {proc.pid} on cpus {cpus} ({threads} threads)")
+
+            code = proc.poll()
+            if code is not None:
+                status.update(state='done' if code == 0 else 'failed', exitCode=code)
+                break
+            if cancelled['flag']:
+                _signal_group(proc, signal.SIGCONT)
+                _signal_group(proc, signal.SIGTERM)
+                proc.wait()
+                status.update(state='cancelled', exitCode=proc.returncode)
+                break
+
+            depth = inference_queue_depth()
+            status['queueDepth'] = depth
+            now = time.time()
+
+            if paused_since is None and depth > JOB_PAUSE_QUEUE_DEPTH:
+                _signal_group(proc, signal.SIGSTOP)
+                paused_since, calm_since = now, None
+                status.update(state='paused', pauses=status['pauses'] + 1)
+                print(f"[Jobs] {job_id}: paused (inference queue depth {depth})")
+            elif paused_since is not None:
+                calm_since = (calm_since or now) if depth <= JOB_PAUSE_QUEUE_DEPTH else None
+                if calm_since is not None and now - calm_since >= JOB_RESUME_AFTER:
+                    _signal_group(proc, signal.SIGCONT)
+                    status['pausedSeconds'] = round(status['pausedSeconds'] + now - paused_since, 1)
+                    paused_since = None
+                    status['state'] = 'running'
+                    print(f"[Jobs] {job_id}: resumed")
+                elif restartable and now - paused_since >= JOB_MAX_PAUSE:
+                    # Long pause: free the memory, restart from checkpoint once load clears
+                    cpu_before += resource_usage(proc.pid)['cpuSeconds']
+                    _signal_group(proc, signal.SIGCONT)
+                    _signal_group(proc, signal.SIGTERM)
+                    proc.wait()
+                    status['pausedSeconds'] = round(status['pausedSeconds'] + now - paused_since, 1)
+                    print(f"[Jobs] {job_id}: stopped after {now - paused_since:.0f}s pause, will restart")
+                    while inference_queue_depth() > JOB_PAUSE_QUEUE_DEPTH and not cancelled['flag']:
+                        status.update(state='waiting', pid=None)
+                        write_status(status)
+                        time.sleep(JOB_RESUME_AFTER)
+                    if cancelled['flag']:
+                        # Cancelled while stopped: never start it again
+                        status.update(state='cancelled', exitCode=proc.returncode, pid=None)
+                        break
+                    paused_since = calm_since = None
+                    proc = None
+                    continue
+
+            usage = resource_usage(proc.pid)
+            status['usage'] = usage
+            status['cpuSecondsTotal'] = round(cpu_before + usage['cpuSeconds'], 1)
+            status['peakRssMb'] = max(status['peakRssMb'], usage['rssMb'])
+            write_status(status)
+            time.sleep(JOB_POLL_INTERVAL)
+
+    status['finishedAt'] = time.strftime('%Y-%m-%dT%H:%M:%S%z')
+    write_status(status)
+    print(f"[Jobs] {job_id}: {status['state']} (exit {status['exitCode']})")
+    return status['exitCode'] or 0
+
+
+def cancel_job(job_id):
+    status = read_status(job_id)
+    if not status or status.get('finishedAt'):
+        return False
+    try:
+        os.kill(status['runnerPid'], signal.SIGTERM)
+        return True
+    except ProcessLookupError:
+        return False
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run background jobs at low priority')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_run = sub.add_parser('run', help='Run a command as a job (command after --)')
+    p_run.add_argument('--name', required=True, help='Job name (part of the job id)')
+    p_run.add_argument('--id', help='Job id (default: generated)')
+    p_run.add_argument('--cpus', help='CPU list, e.g. 2-5 (default: JOB_CPUS or all but core 0)')
+    p_run.add_argument('--threads', type=int, help='Thread cap (default: JOB_THREADS or number of cpus)')
+    p_run.add_argument('--restartable', action='store_true',
+                       help='Job resumes from its own checkpoint: terminate on long pauses, restart later')
+    p_run.add_argument('job', nargs=argparse.REMAINDER, help='-- command ...')
+
+    p_status = sub.add_parser('status', help='Print job status as JSON')
+    p_status.add_argument('job_id', nargs='?')
+
+    p_cancel = sub.add_parser('cancel', help='Cancel a running job')
+    p_cancel.add_argument('job_id')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        job = args.job[1:] if args.job[:1] == ['--'] else args.job
+        if not job:
+            parser.error('command required after --')
+        sys.exit(run_job(args.name, job, args.restartable, args.cpus, args.threads, args.id))
+    elif args.command == 'status':
+        print(json.dumps(read_status(args.job_id), ensure_ascii=False))
+    else:
+        sys.exit(0 if cancel_job(args.job_id) else 1)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Product quantization for L2-normalized embeddings.
+
+A D-dim vector is split into M subvectors of D/M dims; each subvector is
+replaced by the index of its nearest centroid in that subspace's 256-entry
+codebook, so a vector costs M bytes (576 dims, M=48 -> 48 bytes instead of
+2304 as float32).
+
+Search uses asymmetric distance computation (ADC): the query stays exact,
+per-subspace inner products with every codebook entry are tabulated once
+per query, and a code's approximate similarity is the sum of M table
+lookups.
+"""
+import numpy as np
+
+DEFAULT_SUBSPACES = 48
+CODEBOOK_SIZE = 256          # 8-bit codes
+MAX_TRAIN_VECTORS = 20000
+
+
+def _kmeans(x, k, iterations=15, seed=0):
+    """Plain (Euclidean) k-means, returns (k, d) float32 centroids"""
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), size=k, replace=False)].copy()
+
+    for _ in range(iterations):
+        assign = _nearest(x, centroids)
+        order = np.argsort(assign, kind='stable')
+        counts = np.bincount(assign, minlength=k)
+        nonempty = np.flatnonzero(counts)
+        starts = (np.cumsum(counts) - counts)[nonempty]
+        sums = np.add.reduceat(x[order], starts, axis=0)
+
+        centroids[nonempty] = sums / counts[nonempty, None]
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            centroids[empty] = x[rng.choice(len(x), size=len(empty), replace=False)]
+
+    return centroids.astype(np.float32)
+
+
+def _nearest(x, centroids, chunk=16384):
+    """Index of the nearest centroid (Euclidean) for each row of x"""
+    # argmin ||x - c||^2 == argmax (x.c - ||c||^2 / 2)
+    half_norms = 0.5 * (centroids ** 2).sum(axis=1)
+    out = np.empty(len(x), dtype=np.int64)
+    for i in range(0, len(x), chunk):
+        out[i:i + chunk] = np.argmax(x[i:i + chunk] @ centroids.T - half_norms, axis=1)
+    return out
+
+
+class ProductQuantizer:
+    """M x 256 codebooks over equal-width subspaces"""
+
+    def __init__(self, codebooks):
+        self.codebooks = np.asarray(codebooks, dtype=np.float32)   # (M, 256, D/M)
+
+    @property
+    def num_subspaces(self):
+        return self.codebooks.shape[0]
+
+    @property
+    def dim(self):
+        return self.codebooks.shape[0] * self.codebooks.shape[2]
+
+    @property
+    def bytes_per_vector(self):
+        return self.num_subspaces
+
+    @property
+    def nbytes(self):
+        return self.codebooks.nbytes
+
+    @classmethod
+    def train(cls, vectors, num_subspaces=DEFAULT_SUBSPACES, seed=0):
+        """
+        Train codebooks on (a sample of) the given vectors.
+        Needs at least CODEBOOK_SIZE vectors; D must be divisible by num_subspaces.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        n, dim = vectors.shape
+        if dim % num_subspaces:
+            raise ValueError(f"dim {dim} is not divisible by {num_subspaces} subspaces")
+        if n < CODEBOOK_SIZE:
+            raise ValueError(f"need at least {CODEBOOK_SIZE} vectors to train, got {n}")
+
+        rng = np.random.default_rng(seed)
+        if n > MAX_TRAIN_VECTORS:
+            vectors = vectors[rng.choice(n, MAX_TRAIN_VECTORS, replace=False)]
+
+        sub = vectors.reshape(len(vectors), num_subspaces, dim // num_subspaces)
+        codebooks = np.stack([
+            _kmeans(np.ascontiguousarray(sub[:, m]), CODEBOOK_SIZE, seed=seed + m)
+            for m in range(num_subspaces)
+        ])
+        return cls(codebooks)
+
+    def encode(self, vectors):
+        """(n, D) float vectors -> (n, M) uint8 codes"""
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        sub = vectors.reshape(len(vectors), self.num_subspaces, -1)
+        codes = np.empty((len(vectors), self.num_subspaces), dtype=np.uint8)
+        for m in range(self.num_subspaces):
+            codes[:, m] = _nearest(np.ascontiguousarray(sub[:, m]), self.codebooks[m])
+        return codes
+
+    def decode(self, codes):
+        """(n, M) codes -> (n, D) approximate vectors"""
+        codes = np.asarray(codes)
+        return np.concatenate([self.codebooks[m][codes[:, m]] for m in range(self.num_subspaces)], axis=1)
+
+    def adc_scores(self, queries, codes):
+        """
+        Approximate inner products between exact queries and coded vectors.
+
+        Args:
+            queries: (Q, D) float32
+            codes: (N, M) uint8
+
+        Returns:
+            (Q, N) float32
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        sub = queries.reshape(len(queries), self.num_subspaces, -1)
+        # tables[q, m, c] = <query subvector m, codebook entry c>
+        tables = np.einsum('qmd,mcd->qmc', sub, self.codebooks)
+
+        scores = np.zeros((len(queries), len(codes)), dtype=np.float32)
+        for m in range(self.num_subspaces):
+            scores += tables[:, m, codes[:, m]]
+        return scores
+
+    def to_arrays(self):
+        return {'pq_codebooks': self.codebooks}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays['pq_codebooks'])
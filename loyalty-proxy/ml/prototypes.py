@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Online multi-prototype summary of one product's embeddings.
+
+A product keeps at most k L2-normalized prototypes, each with a weight (the
+number of samples it stands for). A new sample:
+  - merges into its nearest prototype if they are near-duplicates
+    (cosine >= merge_similarity), e.g. repeated shots from one session;
+  - otherwise becomes a new prototype while there is room;
+  - otherwise the closest pair among the prototypes plus the new sample is
+    merged (weighted spherical mean), so the set keeps covering distinct
+    packaging variants instead of only the most recent shots.
+
+The update is deterministic, so replicas replaying the same samples end up
+with identical prototypes.
+"""
+import numpy as np
+
+
+def _normalize(vec):
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm > 0 else vec
+
+
+def add_sample(prototypes, weights, sample, max_prototypes, merge_similarity):
+    """
+    Fold one sample into a prototype set.
+
+    Args:
+        prototypes: (k, D) array (any float dtype), k may be 0
+        weights: list of k ints
+        sample: (D,) float32, L2-normalized
+        max_prototypes: budget k
+        merge_similarity: cosine at which a sample counts as a near-duplicate
+
+    Returns:
+        (prototypes (k', D) float32, weights list) — new objects
+    """
+    protos = np.asarray(prototypes, dtype=np.float32).reshape(-1, len(sample))
+    weights = list(weights) if weights is not None else [1] * len(protos)
+
+    if len(protos):
+        sims = protos @ sample
+        j = int(np.argmax(sims))
+        if sims[j] >= merge_similarity:
+            protos = protos.copy()
+            protos[j] = _normalize(weights[j] * protos[j] + sample)
+            weights[j] += 1
+            return protos, weights
+
+    protos = np.concatenate([protos, sample[None].astype(np.float32)])
+    weights.append(1)
+    if len(protos) <= max_prototypes:
+        return protos, weights
+
+    # Over budget: merge the most similar pair (new sample included)
+    gram = protos @ protos.T
+    np.fill_diagonal(gram, -np.inf)
+    a, b = sorted(np.unravel_index(int(np.argmax(gram)), gram.shape))
+    protos[a] = _normalize(weights[a] * protos[a] + weights[b] * protos[b])
+    weights[a] += weights[b]
+    del weights[b]
+    return np.delete(protos, b, axis=0), weights
+
+
+def weighted_centroid(prototypes, weights):
+    """L2-normalized weighted mean of the prototypes"""
+    protos = np.asarray(prototypes, dtype=np.float32)
+    return _normalize((np.asarray(weights, dtype=np.float32)[:, None] * protos).sum(axis=0))
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Shared, memory-mapped catalog generations for multi-process yolo_server.
+
+One writer process publishes immutable generations; any number of reader
+processes map the current one read-only, so the search matrices live once
+in the page cache (tmpfs when the directory is under /dev/shm) instead of
+once per worker.
+
+Layout under the shared directory:
+  CURRENT          — name of the live generation (replaced atomically)
+  gen-000042/      — one generation, never modified after publish
+    meta.json      — product ids and metadata, storage mode, ANN labels
+    *.npy          — matrix, samples, offsets, owner[, codes, pq_codebooks][, ann_*]
+
+Old generations are deleted once KEEP_GENERATIONS newer ones exist; a
+reader still mapping a deleted generation keeps valid pages until it
+re-attaches (the files are only unlinked).
+"""
+import os
+import json
+import shutil
+import tempfile
+import numpy as np
+from pathlib import Path
+
+DEFAULT_SHARED_DIR = (Path('/dev/shm') if Path('/dev/shm').is_dir() else Path(tempfile.gettempdir())) \
+    / 'loyalty-embedding-catalog'
+POINTER_FILE = 'CURRENT'
+META_FILE = 'meta.json'
+KEEP_GENERATIONS = 3
+
+
+def _generation_name(generation):
+    return f'gen-{generation:06d}'
+
+
+def _existing_generations(shared_dir):
+    """Generation numbers present on disk, ascending"""
+    generations = []
+    for path in Path(shared_dir).glob('gen-*'):
+        try:
+            generations.append(int(path.name[4:]))
+        except ValueError:
+            continue
+    return sorted(generations)
+
+
+def pointer_signature(shared_dir):
+    """
+    Cheap change check for readers: (inode, mtime) of the CURRENT file,
+    or None if nothing has been published yet. Every publish replaces the
+    file, so the inode changes even within one mtime tick.
+    """
+    try:
+        st = os.stat(Path(shared_dir) / POINTER_FILE)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns)
+
+
+def current_generation(shared_dir):
+    """Name of the live generation, or None"""
+    try:
+        return (Path(shared_dir) / POINTER_FILE).read_text().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def publish(shared_dir, arrays, meta):
+    """
+    Write a new generation and make it current.
+
+    Args:
+        shared_dir: shared directory (created if needed)
+        arrays: name -> numpy array, each stored as <name>.npy
+        meta: JSON-serializable dict
+
+    Returns:
+        the new generation number
+    """
+    shared_dir = Path(shared_dir)
+    shared_dir.mkdir(parents=True, exist_ok=True)
+
+    existing = _existing_generations(shared_dir)
+    generation = (existing[-1] if existing else 0) + 1
+    name = _generation_name(generation)
+
+    tmp_dir = Path(tempfile.mkdtemp(prefix=f'.{name}.', dir=str(shared_dir)))
+    try:
+        for key, arr in arrays.items():
+            np.save(tmp_dir / f'{key}.npy', np.ascontiguousarray(arr))
+        with open(tmp_dir / META_FILE, 'w') as f:
+            json.dump(dict(meta, generation=generation), f, ensure_ascii=False)
+        os.chmod(tmp_dir, 0o755)
+        os.rename(tmp_dir, shared_dir / name)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    fd, tmp_pointer = tempfile.mkstemp(prefix='.CURRENT.', dir=str(shared_dir))
+    with os.fdopen(fd, 'w') as f:
+        f.write(name)
+    os.chmod(tmp_pointer, 0o644)
+    os.replace(tmp_pointer, shared_dir / POINTER_FILE)
+
+    for old in _existing_generations(shared_dir)[:-KEEP_GENERATIONS]:
+        shutil.rmtree(shared_dir / _generation_name(old), ignore_errors=True)
+    return generation
+
+
+def open_current(shared_dir, retries=3):
+    """
+    Map the live generation read-only.
+
+    Returns:
+        (arrays, meta) — arrays maps name -> read-only np.memmap,
+        or None if nothing has been published yet
+    """
+    shared_dir = Path(shared_dir)
+    for _ in range(retries):
+        name = current_generation(shared_dir)
+        if name is None:
+            return None
+        gen_dir = shared_dir / name
+        try:
+            with open(gen_dir / META_FILE) as f:
+                meta = json.load(f)
+            arrays = {path.stem: np.load(path, mmap_mode='r') for path in gen_dir.glob('*.npy')}
+            return arrays, meta
+        except FileNotFoundError:
+            # Generation was pruned between reading CURRENT and opening it
+            continue
+    return None
@@ -0,0 +1,478 @@
+#!/usr/bin/env python3
+"""
+SQLite manifest of the YOLO training data.
+
+One row per image in the training (and pending) directories, with its
+content sha1, pixel dimensions, perceptual hash, label file and parsed label
+boxes, plus the samples.json metadata (product id, barcode, approval state)
+of every source directory.
+
+refresh() brings the manifest up to date: a file is re-hashed / re-parsed
+only when its size or mtime changed, removed files are dropped, and a
+samples.json is re-read only when it changed. Only the first refresh after
+the database is created reads every file. Export, the reference catalog
+build, near-duplicate filtering and the maintenance scripts query it
+instead of walking and hashing the directories themselves.
+
+Usage:
+  python3 training_manifest.py [--stats]
+"""
+import os
+import sys
+import json
+import time
+import struct
+import sqlite3
+import hashlib
+import argparse
+from contextlib import closing
+from pathlib import Path
+
+SCRIPT_DIR = Path(__file__).parent
+DATA_DIR = SCRIPT_DIR.parent / 'data'
+MANIFEST_DB = Path(os.environ.get('TRAINING_MANIFEST_DB', str(DATA_DIR / 'training-manifest.db')))
+
+# (base dir, images subdir, labels subdir); None = legacy flat layout
+TRAINING_SOURCES = [
+    (DATA_DIR / 'display-training', 'images', 'labels'),
+    (DATA_DIR / 'counting-training', 'images', 'labels'),
+    (DATA_DIR / 'cigarette-training-images', None, None),
+]
+# Awaiting admin approval: images and samples.json only
+PENDING_SOURCES = [
+    (DATA_DIR / 'counting-pending', 'images', None),
+]
+LEGACY_LABELS_DIR = DATA_DIR / 'cigarette-training-labels'
+LEGACY_SAMPLES_FILE = DATA_DIR / 'cigarette-training-samples.json'
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,          -- relative to DATA_DIR
+    source TEXT NOT NULL,           -- base dir relative to DATA_DIR
+    name TEXT NOT NULL,
+    legacy INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha1 TEXT NOT NULL,
+    width INTEGER,                  -- as stored (EXIF orientation not applied)
+    height INTEGER,
+    phash TEXT,                     -- filled by dataset_dedup, cleared when the file changes
+    label_path TEXT,
+    label_size INTEGER,
+    label_mtime_ns INTEGER,
+    label_sha1 TEXT,
+    box_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS images_source ON images (source, name);
+CREATE INDEX IF NOT EXISTS images_sha1 ON images (sha1);
+CREATE TABLE IF NOT EXISTS boxes (
+    path TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    class_id INTEGER NOT NULL,
+    cx REAL NOT NULL,
+    cy REAL NOT NULL,
+    w REAL NOT NULL,
+    h REAL NOT NULL,
+    PRIMARY KEY (path, idx)
+);
+CREATE INDEX IF NOT EXISTS boxes_class ON boxes (class_id);
+CREATE TABLE IF NOT EXISTS samples (
+    source TEXT NOT NULL,
+    sample_id TEXT NOT NULL,
+    image_file TEXT,
+    product_id TEXT,
+    barcode TEXT,
+    product_name TEXT,
+    approval TEXT,
+    data TEXT NOT NULL,             -- the samples.json entry
+    PRIMARY KEY (source, sample_id)
+);
+CREATE INDEX IF NOT EXISTS samples_image ON samples (source, image_file);
+CREATE TABLE IF NOT EXISTS sample_files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL
+);
+"""
+
+
+def connect(db_path=None):
+    """Open the manifest database (created on first use)"""
+    db_path = Path(db_path or MANIFEST_DB)
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(db_path), timeout=60, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def _rel(path):
+    return Path(path).relative_to(DATA_DIR).as_posix()
+
+
+def _layout(source):
+    """(name, images dir, labels dir or None, samples file, legacy, default approval)"""
+    base_dir, img_subdir, lbl_subdir = source
+    legacy = img_subdir is None
+    img_dir = base_dir if legacy else base_dir / img_subdir
+    if lbl_subdir:
+        lbl_dir = base_dir / lbl_subdir
+    else:
+        lbl_dir = LEGACY_LABELS_DIR if legacy else None
+    samples_file = LEGACY_SAMPLES_FILE if legacy else base_dir / 'samples.json'
+    approval = 'pending' if source in PENDING_SOURCES else 'approved'
+    return _rel(base_dir), img_dir, lbl_dir, samples_file, legacy, approval
+
+
+def _scan(directory, suffixes):
+    """{name: stat} of the files in a directory with one of the suffixes"""
+    if directory is None or not directory.exists():
+        return {}
+    with os.scandir(directory) as entries:
+        return {e.name: e.stat() for e in entries if e.is_file() and e.name.lower().endswith(suffixes)}
+
+
+def _sha1_bytes(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def image_size(path):
+    """(width, height) from the PNG / JPEG header without decoding, (None, None) if unknown"""
+    with open(path, 'rb') as f:
+        head = f.read(24)
+        if head[:8] == b'\x89PNG\r\n\x1a\n' and len(head) == 24:
+            return struct.unpack('>II', head[16:24])
+        if head[:2] != b'\xff\xd8':
+            return None, None
+        f.seek(2)
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != 0xFF:
+                return None, None
+            code = marker[1]
+            if code == 0xFF:              # fill byte
+                f.seek(-1, 1)
+                continue
+            if code == 0x01 or 0xD0 <= code <= 0xD8:
+                continue
+            length = f.read(2)
+            if len(length) < 2:
+                return None, None
+            if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+                sof = f.read(5)
+                if len(sof) < 5:
+                    return None, None
+                height, width = struct.unpack('>xHH', sof)
+                return width, height
+            f.seek(struct.unpack('>H', length)[0] - 2, 1)
+
+
+def parse_label(path):
+    """YOLO label file -> list of (class_id, cx, cy, w, h), normalized"""
+    boxes = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) < 5:
+                continue
+            try:
+                boxes.append((int(parts[0]), *(float(v) for v in parts[1:5])))
+            except ValueError:
+                continue
+    return boxes
+
+
+def _load_samples_file(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    # Typed dirs: {"samples": [...]}; older files: a bare list
+    return data if isinstance(data, list) else data.get('samples', [])
+
+
+def _refresh_source(conn, source, stats):
+    name, img_dir, lbl_dir, samples_file, legacy, approval = _layout(source)
+    known = {row['name']: row for row in conn.execute(
+        'SELECT name, size, mtime_ns, label_size, label_mtime_ns FROM images WHERE source = ?', (name,))}
+    images = _scan(img_dir, IMAGE_EXTENSIONS)
+    labels = _scan(lbl_dir, ('.txt',))
+
+    for file_name in sorted(images):
+        st = images[file_name]
+        img_path = img_dir / file_name
+        rel = _rel(img_path)
+        row = known.get(file_name)
+        label_name = f'{Path(file_name).stem}.txt'
+        lst = labels.get(label_name)
+
+        if row is None or row['size'] != st.st_size or row['mtime_ns'] != st.st_mtime_ns:
+            try:
+                sha1 = _sha1_bytes(img_path)
+                width, height = image_size(img_path)
+            except OSError as e:
+                print(f"[Manifest] Cannot read {img_path}: {e}", file=sys.stderr)
+                continue
+            conn.execute(
+                'INSERT INTO images (path, source, name, legacy, size, mtime_ns, sha1, width, height) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT(path) DO UPDATE SET size = excluded.size, mtime_ns = excluded.mtime_ns, '
+                'sha1 = excluded.sha1, width = excluded.width, height = excluded.height, phash = NULL',
+                (rel, name, file_name, int(legacy), st.st_size, st.st_mtime_ns, sha1, width, height))
+            stats['added' if row is None else 'changed'] += 1
+
+        label_unchanged = (row is not None and lst is not None and row['label_size'] == lst.st_size
+                           and row['label_mtime_ns'] == lst.st_mtime_ns)
+        if label_unchanged or (row is not None and lst is None and row['label_size'] is None):
+            continue
+        conn.execute('DELETE FROM boxes WHERE path = ?', (rel,))
+        if lst is None:
+            conn.execute('UPDATE images SET label_path = NULL, label_size = NULL, label_mtime_ns = NULL, '
+                         'label_sha1 = NULL, box_count = 0 WHERE path = ?', (rel,))
+            continue
+        label_path = lbl_dir / label_name
+        try:
+            boxes = parse_label(label_path)
+            label_sha1 = _sha1_bytes(label_path)
+        except (OSError, UnicodeDecodeError) as e:
+            print(f"[Manifest] Cannot read {label_path}: {e}", file=sys.stderr)
+            continue
+        conn.executemany('INSERT INTO boxes (path, idx, class_id, cx, cy, w, h) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         [(rel, i, *box) for i, box in enumerate(boxes)])
+        conn.execute('UPDATE images SET label_path = ?, label_size = ?, label_mtime_ns = ?, label_sha1 = ?, '
+                     'box_count = ? WHERE path = ?',
+                     (_rel(label_path), lst.st_size, lst.st_mtime_ns, label_sha1, len(boxes), rel))
+        stats['labels'] += 1
+
+    removed = [file_name for file_name in known if file_name not in images]
+    for file_name in removed:
+        rel = _rel(img_dir / file_name)
+        conn.execute('DELETE FROM boxes WHERE path = ?', (rel,))
+        conn.execute('DELETE FROM images WHERE path = ?', (rel,))
+    stats['removed'] += len(removed)
+    stats['images'] += len(images)
+
+    # samples.json: re-read only when it changed
+    key = _rel(samples_file)
+    try:
+        st = os.stat(samples_file)
+    except OSError:
+        st = None
+    row = conn.execute('SELECT size, mtime_ns FROM sample_files WHERE path = ?', (key,)).fetchone()
+    if st is None:
+        if row is not None:
+            conn.execute('DELETE FROM samples WHERE source = ?', (name,))
+            conn.execute('DELETE FROM sample_files WHERE path = ?', (key,))
+        return
+    if row is not None and row['size'] == st.st_size and row['mtime_ns'] == st.st_mtime_ns:
+        return
+    try:
+        entries = _load_samples_file(samples_file)
+    except (OSError, ValueError) as e:
+        print(f"[Manifest] Cannot read {samples_file}: {e}", file=sys.stderr)
+        return
+    conn.execute('DELETE FROM samples WHERE source = ?', (name,))
+    rows = []
+    for i, s in enumerate(entries):
+        if not isinstance(s, dict):
+            continue
+        state = s.get('status') or ('approved' if s.get('approvedAt') else approval)
+        rows.append((name, str(s.get('id') or f'#{i}'), s.get('imageFileName'), s.get('productId'),
+                     s.get('barcode'), s.get('productName'), state, json.dumps(s, ensure_ascii=False)))
+    conn.executemany('INSERT OR REPLACE INTO samples (source, sample_id, image_file, product_id, barcode, '
+                     'product_name, approval, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    conn.execute('INSERT OR REPLACE INTO sample_files (path, size, mtime_ns) VALUES (?, ?, ?)',
+                 (key, st.st_size, st.st_mtime_ns))
+    stats['samplesFiles'] += 1
+
+
+def refresh(sources=None, conn=None):
+    """
+    Bring the manifest up to date with the source directories.
+
+    Args:
+        sources: list of (base dir, images subdir, labels subdir)
+                 (default: TRAINING_SOURCES + PENDING_SOURCES)
+        conn: open connection (default: a new one on MANIFEST_DB)
+
+    Returns:
+        stats dict (images, added, changed, removed, labels, samplesFiles, seconds)
+    """
+    if conn is None:
+        with closing(connect()) as conn:
+            return refresh(sources, conn)
+
+    sources = TRAINING_SOURCES + PENDING_SOURCES if sources is None else sources
+    stats = {'images': 0, 'added': 0, 'changed': 0, 'removed': 0, 'labels': 0, 'samplesFiles': 0}
+    start = time.perf_counter()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        for source in sources:
+            _refresh_source(conn, source, stats)
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    stats['seconds'] = round(time.perf_counter() - start, 2)
+    if stats['added'] or stats['changed'] or stats['removed'] or stats['labels'] or stats['samplesFiles']:
+        print(f"[Manifest] {stats['images']} images: {stats['added']} added, {stats['changed']} changed, "
+              f"{stats['removed']} removed, {stats['labels']} labels parsed, "
+              f"{stats['samplesFiles']} samples files re-read ({stats['seconds']}s)", file=sys.stderr)
+    return stats
+
+
+def _source_names(sources):
+    return [_layout(source)[0] for source in sources]
+
+
+def training_images(sources=None, labeled_only=False):
+    """
+    Refresh, then list the images of the given sources.
+
+    Returns:
+        list of dicts (images columns, plus `image` and `label` as absolute
+        Paths, label None if the image has no label file), in source order,
+        then by file name
+    """
+    sources = TRAINING_SOURCES if sources is None else sources
+    with closing(connect()) as conn:
+        refresh(sources, conn)
+        rows = []
+        for name in _source_names(sources):
+            query = 'SELECT * FROM images WHERE source = ?'
+            if labeled_only:
+                query += ' AND label_path IS NOT NULL'
+            rows.extend(conn.execute(query + ' ORDER BY name', (name,)))
+    return [_with_paths(row) for row in rows]
+
+
+def _with_paths(row):
+    entry = dict(row)
+    entry['image'] = DATA_DIR / row['path']
+    entry['label'] = DATA_DIR / row['label_path'] if row['label_path'] else None
+    return entry
+
+
+def training_samples(sources=None):
+    """(img_path, label_path_or_none, legacy) for every image of the sources"""
+    return [(row['image'], row['label'], bool(row['legacy'])) for row in training_images(sources)]
+
+
+def content_hashes(paths):
+    """{absolute path str: sha1} for the given image paths known to the manifest"""
+    return _lookup(paths, 'sha1')
+
+
+def box_counts(paths):
+    """{absolute path str: number of label boxes} for the given image paths"""
+    return _lookup(paths, 'box_count')
+
+
+def get_phashes(paths):
+    """{absolute path str: pHash hex} for images whose pHash is stored and still current"""
+    return {k: v for k, v in _lookup(paths, 'phash').items() if v is not None}
+
+
+def set_phashes(values):
+    """Store pHashes ({path: hex}) for images present in the manifest"""
+    rows = []
+    for path, value in values.items():
+        try:
+            rows.append((value, _rel(Path(path).absolute())))
+        except ValueError:
+            continue
+    with closing(connect()) as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.executemany('UPDATE images SET phash = ? WHERE path = ?', rows)
+        conn.execute('COMMIT')
+
+
+def _lookup(paths, column):
+    keys = {}
+    for p in paths:
+        try:
+            keys[_rel(Path(p).absolute())] = str(Path(p).absolute())
+        except ValueError:
+            continue
+    found = {}
+    with closing(connect()) as conn:
+        rel = list(keys)
+        for i in range(0, len(rel), 500):
+            chunk = rel[i:i + 500]
+            marks = ','.join('?' * len(chunk))
+            for row in conn.execute(f'SELECT path, {column} FROM images WHERE path IN ({marks})', chunk):
+                found[keys[row['path']]] = row[column]
+    return found
+
+
+def label_boxes(img_path):
+    """Parsed label of one image: list of (class_id, cx, cy, w, h)"""
+    with closing(connect()) as conn:
+        return [tuple(row) for row in conn.execute(
+            'SELECT class_id, cx, cy, w, h FROM boxes WHERE path = ? ORDER BY idx', (_rel(img_path),))]
+
+
+def samples(source_dir, refresh_first=True):
+    """
+    samples.json entries of one source directory (e.g. 'counting-training').
+
+    Returns:
+        list of sample dicts, each with `_approval` and `_sha1` (content hash
+        of its image, None if the image file is missing) added
+    """
+    source = next((s for s in TRAINING_SOURCES + PENDING_SOURCES if _layout(s)[0] == source_dir), None)
+    if source is None:
+        raise ValueError(f'Unknown source directory: {source_dir}')
+    with closing(connect()) as conn:
+        if refresh_first:
+            refresh([source], conn)
+        rows = conn.execute(
+            'SELECT s.data, s.approval, i.sha1 FROM samples s '
+            'LEFT JOIN images i ON i.source = s.source AND i.name = s.image_file '
+            'WHERE s.source = ? ORDER BY s.rowid', (source_dir,)).fetchall()
+    result = []
+    for row in rows:
+        sample = json.loads(row['data'])
+        sample['_approval'] = row['approval']
+        sample['_sha1'] = row['sha1']
+        result.append(sample)
+    return result
+
+
+def product_ids(approval='approved'):
+    """Product ids of the samples with the given approval state (None: any)"""
+    query = 'SELECT DISTINCT product_id FROM samples WHERE product_id IS NOT NULL'
+    args = ()
+    if approval:
+        query += ' AND approval = ?'
+        args = (approval,)
+    with closing(connect()) as conn:
+        return sorted(row[0] for row in conn.execute(query, args))
+
+
+def summary():
+    """Per-source counts of images, labeled images, boxes and samples"""
+    with closing(connect()) as conn:
+        out = {}
+        for row in conn.execute('SELECT source, COUNT(*) AS images, SUM(label_path IS NOT NULL) AS labeled, '
+                                'SUM(box_count) AS boxes FROM images GROUP BY source'):
+            out[row['source']] = {'images': row['images'], 'labeled': row['labeled'], 'boxes': row['boxes']}
+        for row in conn.execute('SELECT source, approval, COUNT(*) AS n FROM samples GROUP BY source, approval'):
+            out.setdefault(row['source'], {}).setdefault('samples', {})[row['approval']] = row['n']
+        return out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Update the training data manifest')
+    parser.add_argument('--stats', action='store_true', help='Print per-source counts')
+    args = parser.parse_args()
+
+    result = refresh()
+    print(f"[Manifest] {MANIFEST_DB}: {result['images']} images, {result['added']} added, "
+          f"{result['changed']} changed, {result['removed']} removed ({result['seconds']}s)")
+    if args.stats:
+        print(json.dumps(summary(), indent=2, ensure_ascii=False))
@@ -3,16 +3,22 @@
  *
  * Provides async interface to call Python YOLO detection.
  * CIG-8: Tries persistent HTTP server (port 5002) first, falls back to spawn.
+ * The spawn fallback keeps one long-lived `yolo_inference.py --mode serve-stdio`
+ * child (model loaded once) instead of one Python process per photo.
  */
 
 const { spawn } = require('child_process');
 const path = require('path');
 const fs = require('fs');
 const http = require('http');
+const readline = require('readline');
 
 // Paths
 const SCRIPT_DIR = __dirname;
 const PYTHON_SCRIPT = path.join(SCRIPT_DIR, 'yolo_inference.py');
+const JOB_RUNNER_SCRIPT = path.join(SCRIPT_DIR, 'job_runner.py');
+const JOBS_DIR = process.env.JOB_DIR || path.join(SCRIPT_DIR, 'jobs');
+const JOB_TIMEOUT_MS = 6 * 60 * 60 * 1000;
 const MODELS_DIR = path.join(SCRIPT_DIR, 'models');
 const DEFAULT_MODEL = path.join(MODELS_DIR, 'cigarette_detector.pt');
 
@@ -75,7 +81,7 @@ async function reloadModel() {
 /**
  * Send request to YOLO persistent server
  */
-async function callYoloServer(endpoint, payload) {
+async function callYoloServer(endpoint, payload, timeout = 30000) {
   return new Promise((resolve, reject) => {
     const body = JSON.stringify(payload);
     const options = {
@@ -87,7 +93,7 @@ async function callYoloServer(endpoint, payload) {
         'Content-Type': 'application/json',
         'Content-Length': Buffer.byteLength(body),
       },
-      timeout: 30000,
+      timeout,
     };
 
     const req = http.request(options, (res) => {
@@ -139,11 +145,11 @@ async function findPython() {
 /**
  * Run a command and return result
  */
-function runCommand(command, args) {
+function runCommand(command, args, timeout = 30 * 60 * 1000) { // 30 min — training can take many minutes
   return new Promise((resolve) => {
     const proc = spawn(command, args, {
       stdio: ['pipe', 'pipe', 'pipe'],
-      timeout: 30 * 60 * 1000 // 30 min — training can take many minutes
+      timeout
     });
 
     let stdout = '';
@@ -177,6 +183,125 @@ function runCommand(command, args) {
   });
 }
 
+// Long-lived serve-stdio worker (spawn fallback when the HTTP server is down)
+const STDIO_WORKER_IDLE_MS = 10 * 60 * 1000; // stop the child after 10 min without requests
+const STDIO_REQUEST_TIMEOUT_MS = 60000;
+const STDIO_READY_TIMEOUT_MS = 120000; // import + model load; a child hung longer is killed
+let stdioWorker = null;
+let stdioRequestId = 0;
+
+/**
+ * Idle timer runs only while nothing is pending: started when the last request settles
+ */
+function armStdioIdleTimer(worker) {
+  clearTimeout(worker.idleTimer);
+  if (worker.pending.size > 0) return;
+  worker.idleTimer = setTimeout(() => {
+    if (worker.pending.size === 0) worker.proc.stdin.end();
+  }, STDIO_WORKER_IDLE_MS);
+}
+
+/**
+ * Start (or reuse) the serve-stdio child. Resolves once it reports ready.
+ */
+async function getStdioWorker() {
+  if (stdioWorker) return stdioWorker.ready;
+
+  const python = await findPython();
+  if (stdioWorker) return stdioWorker.ready;
+
+  const proc = spawn(python, [PYTHON_SCRIPT, '--mode', 'serve-stdio'], { stdio: ['pipe', 'pipe', 'pipe'] });
+  const worker = { proc, pending: new Map(), idleTimer: null };
+  stdioWorker = worker;
+
+  worker.ready = new Promise((resolve, reject) => {
+    // Зависший на импорте/загрузке модели процесс не должен блокировать fallback
+    const readyTimer = setTimeout(() => {
+      fail(new Error(`stdio worker not ready after ${STDIO_READY_TIMEOUT_MS} ms`));
+      proc.kill();
+    }, STDIO_READY_TIMEOUT_MS);
+
+    const lines = readline.createInterface({ input: proc.stdout });
+    lines.on('line', (line) => {
+      let msg;
+      try {
+        msg = JSON.parse(line);
+      } catch (e) {
+        console.warn('[YOLO Wrapper] Non-JSON line from stdio worker:', line.slice(0, 100));
+        return;
+      }
+      if (msg.ready) {
+        console.log('[YOLO Wrapper] stdio worker ready');
+        clearTimeout(readyTimer);
+        resolve(worker);
+        return;
+      }
+      const entry = worker.pending.get(msg.id);
+      if (!entry) return;
+      worker.pending.delete(msg.id);
+      clearTimeout(entry.timer);
+      delete msg.id;
+      entry.resolve(msg);
+      armStdioIdleTimer(worker);
+    });
+
+    proc.stderr.on('data', (data) => {
+      console.error('[YOLO Wrapper] stdio worker:', data.toString().trim());
+    });
+
+    const fail = (err) => {
+      if (stdioWorker === worker) stdioWorker = null;
+      clearTimeout(readyTimer);
+      clearTimeout(worker.idleTimer);
+      for (const entry of worker.pending.values()) {
+        clearTimeout(entry.timer);
+        entry.reject(err);
+      }
+      worker.pending.clear();
+      reject(err);
+    };
+    proc.on('error', fail);
+    proc.on('exit', (code) => fail(new Error(`stdio worker exited with code ${code}`)));
+  });
+
+  return worker.ready;
+}
+
+/**
+ * Send one request to the serve-stdio worker
+ *
+ * @param {object} request - { mode: 'detect'|'display'|'status', ... }
+ * @returns {Promise<object>} Result (same shape as the one-shot script output)
+ */
+async function callStdioWorker(request, timeout = STDIO_REQUEST_TIMEOUT_MS) {
+  const worker = await getStdioWorker();
+  const id = ++stdioRequestId;
+
+  clearTimeout(worker.idleTimer);
+
+  return new Promise((resolve, reject) => {
+    const timer = setTimeout(() => {
+      worker.pending.delete(id);
+      reject(new Error('stdio worker timeout'));
+      armStdioIdleTimer(worker);
+    }, timeout);
+    worker.pending.set(id, { resolve, reject, timer });
+    worker.proc.stdin.write(JSON.stringify({ ...request, id }) + '\n');
+  });
+}
+
+/**
+ * Spawn fallback: serve-stdio worker first, one-shot script if that fails
+ */
+async function runYoloFallback(request, args) {
+  try {
+    return await callStdioWorker(request);
+  } catch (e) {
+    console.warn('[YOLO Wrapper] stdio worker failed, spawning one-shot script:', e.message);
+    return runYoloScript(args());
+  }
+}
+
 /**
  * Run Python YOLO script with arguments
  */
@@ -225,6 +350,68 @@ async function runYoloScript(args) {
   }
 }
 
+/**
+ * Run yolo_inference.py through job_runner.py (nice/ionice, CPU subset, thread cap,
+ * pauses while inference requests queue up). Resolves with the script's JSON result.
+ *
+ * @param {string} name - Job name
+ * @param {string[]} args - yolo_inference.py arguments
+ * @param {boolean} restartable - Script resumes from its own checkpoint (finetune)
+ */
+async function runYoloJob(name, args, restartable = false) {
+  try {
+    const python = await findPython();
+    const jobId = `${new Date().toISOString().replace(/[-:]/g, '').slice(0, 15)}-${name}-${Math.random().toString(36).slice(2, 8)}`;
+    const runnerArgs = [JOB_RUNNER_SCRIPT, 'run', '--name', name, '--id', jobId];
+    if (restartable) runnerArgs.push('--restartable');
+    runnerArgs.push('--', python, PYTHON_SCRIPT, ...args);
+
+    // Jobs yield to inference, so allow for pauses on top of the training time
+    const result = await runCommand(python, runnerArgs, JOB_TIMEOUT_MS);
+    const status = getJobStatus(jobId);
+    const log = status && status.log && fs.existsSync(status.log) ? fs.readFileSync(status.log, 'utf8') : '';
+    const lastJson = log.trim().split('\n').reverse().find(line => line.startsWith('{'));
+    if (lastJson) {
+      try {
+        return { ...JSON.parse(lastJson), jobId };
+      } catch (e) { /* fall through */ }
+    }
+    return {
+      success: false,
+      error: result.stderr || `Job ${jobId} finished without a result`,
+      jobId,
+    };
+  } catch (error) {
+    console.error('[YOLO Wrapper] Job error:', error);
+    return { success: false, error: error.message };
+  }
+}
+
+/**
+ * Status of a background job (state, pauses, CPU seconds, RSS, settings) or null
+ *
+ * @param {string} jobId
+ */
+function getJobStatus(jobId) {
+  try {
+    return JSON.parse(fs.readFileSync(path.join(JOBS_DIR, `${jobId}.json`), 'utf8'));
+  } catch (e) {
+    return null;
+  }
+}
+
+/**
+ * All background jobs, newest first
+ */
+function listJobs() {
+  if (!fs.existsSync(JOBS_DIR)) return [];
+  return fs.readdirSync(JOBS_DIR)
+    .filter(f => f.endsWith('.json') && !f.startsWith('.'))
+    .map(f => getJobStatus(f.slice(0, -5)))
+    .filter(Boolean)
+    .sort((a, b) => (b.createdAt || '').localeCompare(a.createdAt || ''));
+}
+
 /**
  * Check if YOLO is available and model exists
  */
@@ -279,7 +466,7 @@ async function detectAndCount(imageBase64, productId = null, confidence = 0.5) {
     }
   }
 
-  // Fallback: spawn Python process
+  // Fallback: local Python process
   const tempDir = path.join(SCRIPT_DIR, 'temp');
   if (!fs.existsSync(tempDir)) {
     fs.mkdirSync(tempDir, { recursive: true });
@@ -291,12 +478,16 @@ async function detectAndCount(imageBase64, productId = null, confidence = 0.5) {
     const imageBuffer = Buffer.from(imageBase64, 'base64');
     fs.writeFileSync(tempFile, imageBuffer);
 
-    const args = ['--mode', 'detect', '--image', tempFile, '--confidence', confidence.toString()];
-    if (productId) {
-      args.push('--product-id', productId);
-    }
-
-    return await runYoloScript(args);
+    return await runYoloFallback(
+      { mode: 'detect', image: tempFile, productId, confidence },
+      () => {
+        const args = ['--mode', 'detect', '--image', tempFile, '--confidence', confidence.toString()];
+        if (productId) {
+          args.push('--product-id', productId);
+        }
+        return args;
+      }
+    );
   } finally {
     try {
       if (fs.existsSync(tempFile)) fs.unlinkSync(tempFile);
@@ -345,7 +536,7 @@ async function checkDisplay(imageBase64, expectedProducts = [], confidence = 0.3
     }
   }
 
-  // Fallback: spawn Python process
+  // Fallback: local Python process
   const tempDir = path.join(SCRIPT_DIR, 'temp');
   if (!fs.existsSync(tempDir)) {
     fs.mkdirSync(tempDir, { recursive: true });
@@ -357,16 +548,20 @@ async function checkDisplay(imageBase64, expectedProducts = [], confidence = 0.3
     const imageBuffer = Buffer.from(imageBase64, 'base64');
     fs.writeFileSync(tempFile, imageBuffer);
 
-    const args = [
-      '--mode', 'display',
-      '--image', tempFile,
-      '--confidence', confidence.toString()
-    ];
-    if (expectedProducts && expectedProducts.length > 0) {
-      args.push('--expected', expectedProducts.join(','));
-    }
-
-    return await runYoloScript(args);
+    return await runYoloFallback(
+      { mode: 'display', image: tempFile, expected: expectedProducts || [], confidence },
+      () => {
+        const args = [
+          '--mode', 'display',
+          '--image', tempFile,
+          '--confidence', confidence.toString()
+        ];
+        if (expectedProducts && expectedProducts.length > 0) {
+          args.push('--expected', expectedProducts.join(','));
+        }
+        return args;
+      }
+    );
   } finally {
     try {
       if (fs.existsSync(tempFile)) fs.unlinkSync(tempFile);
@@ -379,11 +574,15 @@ async function checkDisplay(imageBase64, expectedProducts = [], confidence = 0.3
 /**
  * Export training data to YOLO format
  *
+ * 'lists' (default) writes image lists referencing the original files and
+ * updates incrementally when the same outputDir is reused; 'copy' copies files.
+ *
  * @param {string} outputDir - Output directory path
+ * @param {string} mode - 'lists' or 'copy'
  * @returns {Promise<object>} Export results
  */
-async function exportTrainingData(outputDir) {
-  return await runYoloScript(['--mode', 'export', '--output', outputDir]);
+async function exportTrainingData(outputDir, mode = 'lists') {
+  return await runYoloScript(['--mode', 'export', '--output', outputDir, '--export-mode', mode]);
 }
 
 /**
@@ -394,13 +593,32 @@ async function exportTrainingData(outputDir) {
  * @returns {Promise<object>} Training results
  */
 async function trainModel(dataYaml, epochs = 100) {
-  return await runYoloScript([
+  return await runYoloJob('train', [
     '--mode', 'train',
     '--data', dataYaml,
     '--epochs', epochs.toString()
   ]);
 }
 
+/**
+ * Fine-tune the current production model on collected data
+ *
+ * Short schedule with early stopping; an interrupted run is resumed from its
+ * last checkpoint on the next call with the same dataYaml. Trains from
+ * scratch when there is no production model yet.
+ *
+ * @param {string} dataYaml - Path to data.yaml
+ * @param {number} epochs - Maximum epochs
+ * @returns {Promise<object>} Training results incl. wall_seconds / time_saved_seconds
+ */
+async function fineTuneModel(dataYaml, epochs = 30) {
+  return await runYoloJob('finetune', [
+    '--mode', 'finetune',
+    '--data', dataYaml,
+    '--epochs', epochs.toString()
+  ], true);
+}
+
 /**
  * Check display using embedding-based recognition (1000+ products)
  * Same response format as checkDisplay() — drop-in replacement.
@@ -465,6 +683,47 @@ async function addToCatalog(productId, imageBase64, name = '') {
   }
 }
 
+/**
+ * Add many reference items to the catalog in bulk
+ *
+ * Items are sent in chunks; the server embeds images in batches and applies
+ * each chunk with one catalog rebuild and one save.
+ *
+ * @param {Array<{productId: string, imageBase64?: string, embedding?: number[], name?: string}>} items
+ * @param {number} chunkSize - Items per request (bounds request size)
+ * @returns {Promise<object>} { success, added, failed, results: [{ index, productId, success, error? }] }
+ */
+async function addToCatalogBatch(items, chunkSize = 200) {
+  if (yoloServerAvailable === null) {
+    yoloServerAvailable = await isYoloServerReady();
+  }
+  if (!yoloServerAvailable) {
+    return { success: false, error: 'YOLO server not available' };
+  }
+
+  const results = [];
+  let added = 0;
+  for (let start = 0; start < items.length; start += chunkSize) {
+    const chunk = items.slice(start, start + chunkSize);
+    try {
+      const res = await callYoloServer('/catalog/add-batch', { items: chunk }, 300000);
+      if (!Array.isArray(res.results)) {
+        throw new Error(res.error || 'Invalid response');
+      }
+      for (const r of res.results) {
+        results.push({ ...r, index: r.index + start });
+      }
+      added += res.added || 0;
+    } catch (e) {
+      chunk.forEach((item, i) => results.push({
+        index: start + i, productId: item.productId, success: false, error: e.message,
+      }));
+    }
+  }
+
+  return { success: added > 0, added, failed: results.length - added, results };
+}
+
 /**
  * Get embedding catalog statistics
  *
@@ -522,9 +781,13 @@ module.exports = {
   checkDisplay,
   checkDisplayEmbed,
   addToCatalog,
+  addToCatalogBatch,
   getCatalogStats,
   exportTrainingData,
   trainModel,
+  fineTuneModel,
+  getJobStatus,
+  listJobs,
   reloadModel,
   isModelReady,
   getModelInfo,
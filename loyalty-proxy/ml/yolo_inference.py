@@ -10,6 +10,20 @@ Usage:
     python yolo_inference.py --mode detect --image <base64_or_path> --model <model_path>
     python yolo_inference.py --mode display --image <base64_or_path> --expected <product_ids>
     python yolo_inference.py --mode train --data <data_yaml_path>
+    python yolo_inference.py --mode finetune --data <data_yaml_path> [--epochs 30]
+    python yolo_inference.py --mode bench --data <data_yaml_path> --candidates yolov8n.pt@640 yolov8s.pt@512 \
+        [--formats onnx openvino] [--promote auto --max-latency-ms 150]
+    python yolo_inference.py --mode distill --data <data_yaml_path> --teacher models/teacher_s.pt \
+        [--student yolov8n.pt --imgsz 512 --prune 0.3 --max-map-drop 0.05]
+    python yolo_inference.py --mode serve-stdio [--workers 2]
+
+serve-stdio keeps the model loaded and answers newline-delimited JSON
+requests on stdin, one JSON response line per request on stdout:
+    {"id": 7, "mode": "detect", "image": "<base64 or path>", "productId": null, "confidence": 0.5}
+    {"id": 8, "mode": "display", "image": "...", "expected": ["p1", "p2"], "confidence": 0.3}
+    {"id": 9, "mode": "status"}
+Responses carry the request id and may arrive out of order. The model is
+reloaded when the model file's mtime changes.
 
 Requirements:
     pip install ultralytics opencv-python pillow numpy
@@ -17,23 +31,44 @@ Requirements:
 
 import argparse
 import base64
+import hashlib
 import json
 import os
+import shutil
 import sys
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 from pathlib import Path
 
+import training_manifest
+
 # Suppress ultralytics welcome message
 os.environ['YOLO_VERBOSE'] = 'False'
 
 try:
     from ultralytics import YOLO
     import numpy as np
-    from PIL import Image
+    from PIL import Image, ImageOps
     YOLO_AVAILABLE = True
 except ImportError:
     YOLO_AVAILABLE = False
 
+# Image decoding without ultralytics (near-duplicate hashing in export)
+try:
+    import PIL
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
+# Optional: structured channel pruning for distilled students (pip install torch-pruning)
+try:
+    import torch_pruning
+    PRUNING_AVAILABLE = True
+except ImportError:
+    PRUNING_AVAILABLE = False
+
 
 # Default paths
 SCRIPT_DIR = Path(__file__).parent
@@ -42,6 +77,54 @@ MODELS_DIR = SCRIPT_DIR / 'models'
 DEFAULT_MODEL = MODELS_DIR / 'cigarette_detector.pt'
 CLASS_MAPPING_FILE = DATA_DIR / 'class-mapping.json'
 
+# Training datasets: (base dir, images subdir, labels subdir); None = legacy flat layout
+TRAINING_SOURCE_DIRS = training_manifest.TRAINING_SOURCES
+TRAINING_IMAGE_EXTENSIONS = ('.jpg', '.png')
+VAL_PERCENT = 20
+
+# Training images pre-resized to the training resolution, keyed by content hash
+RESIZE_CACHE_DIR = Path(os.environ.get('YOLO_RESIZE_CACHE_DIR', str(DATA_DIR / 'training-resize-cache')))
+RESIZE_JPEG_QUALITY = 95
+
+# Near-duplicate filtering in export: images kept per pHash cluster (0 = off, opt-in;
+# run dataset_dedup.py first to review the clusters it would thin out). Clusters are
+# always kept on one side of the train/val split, filtering or not
+DEDUP_PER_CLUSTER = int(os.environ.get('YOLO_DEDUP_PER_CLUSTER', '0'))
+
+# Dataloader worker processes for training (job_runner lowers this with its thread cap)
+TRAIN_WORKERS = int(os.environ.get('YOLO_TRAIN_WORKERS', '8'))
+
+# Incremental fine-tuning from the production model
+SCRATCH_EPOCHS = 100
+FINETUNE_EPOCHS = 30
+FINETUNE_PATIENCE = 8
+FINETUNE_SAVE_PERIOD = 5
+FINETUNE_LR0 = 0.002
+FINETUNE_STATE_FILE = MODELS_DIR / 'finetune_state.json'
+TRAINING_HISTORY_FILE = MODELS_DIR / 'training_history.json'
+
+# Metadata of the installed model (imgsz it was trained/benchmarked at, metrics, source)
+DEFAULT_MODEL_META = DEFAULT_MODEL.with_suffix('.meta.json')
+DEFAULT_IMGSZ = 640
+
+# Detector benchmark (--mode bench)
+SMALL_BOX_AREA = 0.01        # normalized box area below which a pack counts as small (~64x64 px at 640)
+BENCH_LATENCY_IMAGES = 50
+BENCH_REPORT_FILE = MODELS_DIR / 'bench_report.json'
+
+# Distillation (--mode distill): teacher detections added as pseudo-labels for the student
+DISTILL_DIR = MODELS_DIR / 'distill'
+DISTILL_CONFIDENCE = 0.35
+DISTILL_EPOCHS = 100
+PRUNE_FINETUNE_EPOCHS = 20
+DISTILL_MAX_MAP_DROP = 0.05
+
+# Loaded models by path: path -> (mtime, YOLO); reused across requests in serve-stdio mode
+_models = {}
+_models_lock = threading.Lock()
+# Ultralytics predictors are not thread-safe; one inference at a time per process
+_inference_lock = threading.Lock()
+
 
 def load_class_mapping(mapping_file=None):
     """Load product ID to class ID mapping"""
@@ -88,6 +171,32 @@ def decode_image(image_input):
         return None
 
 
+def model_imgsz(model_file):
+    """Inference size recorded for a model in its .meta.json (DEFAULT_IMGSZ if none)"""
+    meta = _load_json(Path(model_file).with_suffix('.meta.json'), {})
+    return int(meta.get('imgsz') or DEFAULT_IMGSZ)
+
+
+def get_model(model_file):
+    """
+    Cached YOLO model for a path, reloaded when the file's mtime changes
+
+    Raises:
+        Exception from YOLO() if the model cannot be loaded
+    """
+    key = str(model_file)
+    mtime = os.path.getmtime(key)
+    with _models_lock:
+        cached = _models.get(key)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        model = YOLO(key)
+        _models[key] = (mtime, model)
+        if cached is not None:
+            print(f"[YOLO Inference] Model reloaded: {key}", file=sys.stderr)
+        return model
+
+
 def detect_and_count(image_input, model_path=None, product_id=None, confidence_threshold=0.5):
     """
     Detect and count cigarette packs in image
@@ -124,7 +233,7 @@ def detect_and_count(image_input, model_path=None, product_id=None, confidence_t
         }
 
     try:
-        model = YOLO(str(model_file))
+        model = get_model(model_file)
     except Exception as e:
         return {
             'success': False,
@@ -151,7 +260,8 @@ def detect_and_count(image_input, model_path=None, product_id=None, confidence_t
 
     # Run inference
     try:
-        results = model(image, verbose=False, conf=confidence_threshold)
+        with _inference_lock:
+            results = model(image, verbose=False, conf=confidence_threshold, imgsz=model_imgsz(model_file))
     except Exception as e:
         return {
             'success': False,
@@ -304,83 +414,33 @@ def check_display(image_input, expected_products, model_path=None, confidence_th
     }
 
 
-def export_training_data(output_dir):
+def _collect_training_samples():
     """
-    Export training data in YOLO format with train/val split (80/20)
+    All training images with their label file (or None), from the training
+    manifest (refreshed incrementally first)
 
-    Args:
-        output_dir: Output directory for YOLO dataset
+    Returns:
+        list of (img_path, label_path_or_none, legacy) — legacy samples use the
+        flat layout whose labels YOLO cannot find from the image path
     """
-    import shutil
-    import random
+    return training_manifest.training_samples(TRAINING_SOURCE_DIRS)
 
-    output_path = Path(output_dir)
-    output_path.mkdir(parents=True, exist_ok=True)
-
-    # Создаём train/val структуру
-    train_images_dir = output_path / 'train' / 'images'
-    train_labels_dir = output_path / 'train' / 'labels'
-    val_images_dir = output_path / 'val' / 'images'
-    val_labels_dir = output_path / 'val' / 'labels'
-
-    for d in [train_images_dir, train_labels_dir, val_images_dir, val_labels_dir]:
-        d.mkdir(parents=True, exist_ok=True)
 
-    # CIG-1: Читаем из ВСЕХ dataset-директорий (новые типизированные + legacy)
-    source_dirs = [
-        (DATA_DIR / 'display-training', 'images', 'labels'),
-        (DATA_DIR / 'counting-training', 'images', 'labels'),
-        (DATA_DIR / 'cigarette-training-images', None, None),  # legacy flat structure
-    ]
-
-    all_samples = []  # [(img_path, label_path_or_none)]
-
-    for base_dir, img_subdir, lbl_subdir in source_dirs:
-        img_dir = base_dir / img_subdir if img_subdir else base_dir
-        lbl_dir = base_dir / lbl_subdir if lbl_subdir else DATA_DIR / 'cigarette-training-labels'
-
-        if not img_dir.exists():
-            continue
-
-        for img_file in img_dir.glob('*.jpg'):
-            label_file = lbl_dir / f'{img_file.stem}.txt'
-            all_samples.append((img_file, label_file if label_file.exists() else None))
-
-        # Также PNG файлы
-        for img_file in img_dir.glob('*.png'):
-            label_file = lbl_dir / f'{img_file.stem}.txt'
-            all_samples.append((img_file, label_file if label_file.exists() else None))
-
-    if not all_samples:
-        return {'success': False, 'error': 'No training images found in any dataset directory'}
-
-    # CIG-2: Разделяем 80% train / 20% val
-    random.shuffle(all_samples)
-    split_idx = int(len(all_samples) * 0.8)
-    train_samples = all_samples[:split_idx]
-    val_samples = all_samples[split_idx:]
-
-    copied_train = 0
-    copied_val = 0
-
-    for img_path, lbl_path in train_samples:
-        shutil.copy(img_path, train_images_dir / img_path.name)
-        if lbl_path:
-            shutil.copy(lbl_path, train_labels_dir / lbl_path.name)
-        copied_train += 1
+def _is_val_sample(img_path):
+    """Stable hash-based train/val assignment (does not change as samples are added)"""
+    key = Path(img_path).relative_to(DATA_DIR).as_posix()
+    return int(hashlib.sha1(key.encode('utf-8')).hexdigest()[:8], 16) % 100 < VAL_PERCENT
 
-    for img_path, lbl_path in val_samples:
-        shutil.copy(img_path, val_images_dir / img_path.name)
-        if lbl_path:
-            shutil.copy(lbl_path, val_labels_dir / lbl_path.name)
-        copied_val += 1
 
-    # FIX-4: Строим актуальный class-mapping из трёх источников:
-    # 1. Существующие typed class-mapping.json (сохраняем старые ID)
-    # 2. samples.json — берём productId всех одобренных образцов
-    # 3. Назначаем новые ID продуктам, которых ещё нет в маппинге
+def _build_class_mapping():
+    """
+    FIX-4: Строим актуальный class-mapping из трёх источников:
+    1. Существующие typed class-mapping.json (сохраняем старые ID)
+    2. samples.json — берём productId всех одобренных образцов
+    3. Назначаем новые ID продуктам, которых ещё нет в маппинге
+    """
     class_mapping = {}
-    for base_dir, _, _ in source_dirs:
+    for base_dir, _, _ in TRAINING_SOURCE_DIRS:
         typed_mapping_file = base_dir / 'class-mapping.json'
         if typed_mapping_file.exists():
             typed_mapping = load_class_mapping(str(typed_mapping_file))
@@ -389,20 +449,9 @@ def export_training_data(output_dir):
     if not class_mapping:
         class_mapping = load_class_mapping()
 
-    # Собираем product IDs из samples.json (все одобренные образцы)
-    all_product_ids = set()
-    for base_dir, _, _ in source_dirs:
-        samples_file = base_dir / 'samples.json'
-        if samples_file.exists():
-            try:
-                with open(samples_file, 'r', encoding='utf-8') as f:
-                    samples_data = json.load(f)
-                for s in (samples_data if isinstance(samples_data, list) else []):
-                    pid = s.get('productId')
-                    if pid:
-                        all_product_ids.add(pid)
-            except Exception:
-                pass
+    # Собираем product IDs из samples.json (все одобренные образцы) — через манифест
+    training_manifest.refresh(TRAINING_SOURCE_DIRS)
+    all_product_ids = set(training_manifest.product_ids())
 
     # Назначаем ID новым продуктам (детерминированно по алфавиту)
     for pid in sorted(all_product_ids):
@@ -416,6 +465,304 @@ def export_training_data(output_dir):
                 json.dump(class_mapping, f, indent=2, ensure_ascii=False)
         except Exception:
             pass
+    return class_mapping
+
+
+def _link_file(src, dst):
+    """
+    Hardlink src to dst (symlink across filesystems, copy as last resort).
+    An existing dst that already points at src is kept.
+
+    Returns:
+        True if a new link was created
+    """
+    try:
+        if dst.exists() and os.path.samefile(src, dst):
+            return False
+    except OSError:
+        pass
+    if dst.is_symlink() or dst.exists():
+        dst.unlink()
+    try:
+        os.link(src, dst)
+    except OSError:
+        try:
+            os.symlink(os.path.abspath(src), dst)
+        except OSError:
+            shutil.copy(src, dst)
+    return True
+
+
+def _file_sha1(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _resize_for_training(src, dst, imgsz):
+    """
+    Decode src with EXIF orientation applied (as YOLO's loader does) and
+    write it with its long side at most imgsz. The aspect ratio is kept, so
+    normalized YOLO labels stay valid and YOLO's own letterboxing is unchanged.
+    """
+    with Image.open(src) as img:
+        img.draft('RGB', (imgsz, imgsz))    # JPEG: decode at reduced scale
+        img = ImageOps.exif_transpose(img)
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        if max(img.size) > imgsz:
+            scale = imgsz / max(img.size)
+            img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))),
+                             Image.LANCZOS)
+        tmp = dst.with_name(f'.{dst.name}.tmp')
+        img.save(tmp, format='JPEG', quality=RESIZE_JPEG_QUALITY)
+    os.replace(tmp, dst)
+
+
+def cache_resized_samples(samples, imgsz, cache_dir=None):
+    """
+    Resized copies of training images for one training resolution.
+
+    Layout under <cache_dir>/<imgsz>/:
+      resized/<content sha1>.jpg — the cache proper, shared by identical files
+      images/<path sha1>.jpg     — per-sample hardlink to the resized image
+      labels/<path sha1>.txt     — the sample's label, where YOLO looks for it
+    The content sha1 of each source file comes from the training manifest,
+    so unchanged files are neither re-hashed nor re-decoded. Entries no
+    longer used are removed.
+
+    Args:
+        samples: list of (img_path, label_path_or_none, legacy)
+        imgsz: training image size (long side)
+        cache_dir: cache root (default RESIZE_CACHE_DIR)
+
+    Returns:
+        (cached image paths in sample order, stats dict with hits/misses/hitRate)
+    """
+    root = Path(cache_dir or RESIZE_CACHE_DIR) / str(imgsz)
+    resized_dir = root / 'resized'
+    images_dir = root / 'images'
+    labels_dir = root / 'labels'
+    for d in (resized_dir, images_dir, labels_dir):
+        d.mkdir(parents=True, exist_ok=True)
+
+    digests = training_manifest.content_hashes([s[0] for s in samples])
+    used, used_samples = set(), set()
+    cached_paths = []
+    hits = misses = failed = 0
+    start = time.perf_counter()
+    for img_path, lbl_path, _ in samples:
+        key = str(Path(img_path).absolute())
+        digest = digests.get(key) or _file_sha1(img_path)
+        sample_key = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        used.add(digest)
+        used_samples.add(sample_key)
+
+        resized = resized_dir / f'{digest}.jpg'
+        if resized.exists():
+            hits += 1
+        else:
+            try:
+                _resize_for_training(img_path, resized, imgsz)
+                misses += 1
+            except Exception as e:
+                # Unreadable image: train on the original as before
+                print(f"[YOLO Inference] Resize failed for {img_path}: {e}", file=sys.stderr)
+                failed += 1
+                cached_paths.append(None)
+                continue
+
+        dst = images_dir / f'{sample_key}.jpg'
+        _link_file(resized, dst)
+        label_dst = labels_dir / f'{sample_key}.txt'
+        if lbl_path:
+            _write_if_changed(label_dst, Path(lbl_path).read_text(encoding='utf-8'))
+        elif label_dst.exists():
+            label_dst.unlink()
+        cached_paths.append(dst)
+
+    for stale_dir, keep in ((resized_dir, used), (images_dir, used_samples), (labels_dir, used_samples)):
+        for f in stale_dir.iterdir():
+            if f.stem not in keep:
+                f.unlink()
+
+    total = hits + misses
+    return cached_paths, {
+        'dir': str(root),
+        'imgsz': imgsz,
+        'hits': hits,
+        'misses': misses,
+        'failed': failed,
+        'hitRate': round(hits / total, 4) if total else 0.0,
+        'seconds': round(time.perf_counter() - start, 2),
+    }
+
+
+def _write_if_changed(path, text):
+    if path.exists() and path.read_text(encoding='utf-8') == text:
+        return False
+    tmp = path.with_name(f'.{path.name}.tmp')
+    tmp.write_text(text, encoding='utf-8')
+    os.replace(tmp, path)
+    return True
+
+
+def _dedup_samples(samples, per_cluster, distance):
+    """
+    Near-duplicate clustering (dataset_dedup) for the split and, with
+    per_cluster, filtering: at most per_cluster images per pHash cluster,
+    preferring the most annotated ones (0/None: all are kept).
+
+    Returns:
+        (kept samples, split key per kept sample — the cluster's smallest
+         path, so a whole cluster lands on one side of the split, stats)
+    """
+    import dataset_dedup
+
+    hashes, hash_stats = dataset_dedup.hash_images([s[0] for s in samples])
+    clusters = dataset_dedup.cluster_hashes(hashes, distance)
+    box_counts = training_manifest.box_counts([s[0] for s in samples])
+    label_counts = [box_counts.get(str(Path(s[0]).absolute()), 0) for s in samples]
+
+    kept = []
+    for members in clusters:
+        split_key = min((samples[i][0] for i in members), key=str)
+        kept.extend((i, split_key) for i in dataset_dedup.select_from_cluster(members, per_cluster, label_counts))
+    kept.sort()
+
+    removed = len(samples) - len(kept)
+    stats = dict(hash_stats, before=len(samples), after=len(kept), removed=removed,
+                 clusters=len(clusters), duplicateClusters=sum(1 for c in clusters if len(c) > 1),
+                 largestCluster=max(map(len, clusters), default=0), distance=distance, perCluster=per_cluster)
+    # Epoch time scales with the number of images: estimate from the last recorded run
+    last_run = next((r for r in reversed(_load_json(TRAINING_HISTORY_FILE, [])) if r.get('epochSecondsMean')), None)
+    if last_run and removed:
+        per_epoch = last_run['epochSecondsMean'] * removed / len(samples)
+        stats['estimatedSecondsSavedPerEpoch'] = round(per_epoch, 1)
+        stats['estimatedSecondsSavedPerRun'] = {'finetune': round(per_epoch * FINETUNE_EPOCHS),
+                                                'scratch': round(per_epoch * SCRATCH_EPOCHS)}
+    return [samples[i] for i, _ in kept], [key for _, key in kept], stats
+
+
+def export_training_data(output_dir, mode='lists', imgsz=640, dedup_per_cluster=DEDUP_PER_CLUSTER,
+                         dedup_distance=None):
+    """
+    Export training data in YOLO format with train/val split (80/20)
+
+    mode='lists' writes train.txt / val.txt image lists and a data.yaml that
+    reference the original images; only legacy flat-layout samples (labels in
+    a sibling directory YOLO would not look in) are hardlinked into
+    <output>/legacy/{images,labels}. Re-running on the same output directory
+    only links new samples and drops removed ones. The split is hash-based,
+    so a sample stays in train or val across runs.
+
+    With imgsz set (and PIL available) the lists point at the resize cache
+    (see cache_resized_samples) instead, so training epochs decode images at
+    training resolution rather than full-size photos. data.yaml then records
+    resize_imgsz, and val.source.txt (val_source) lists the original val
+    images for bench_models.
+
+    mode='copy' copies every image and label into train/ and val/.
+
+    Near-duplicate photos (pHash within dedup_distance bits) are clustered
+    and a cluster is split as a unit, so duplicates never straddle train and
+    val; with dedup_per_cluster only that many per cluster are exported.
+
+    Args:
+        output_dir: Output directory for YOLO dataset
+        mode: 'lists' or 'copy'
+        imgsz: training resolution for the resize cache (0/None: use originals)
+        dedup_per_cluster: images kept per near-duplicate cluster (0/None: no filtering)
+        dedup_distance: max pHash Hamming distance (default dataset_dedup.DEFAULT_DISTANCE)
+    """
+    output_path = Path(output_dir)
+    output_path.mkdir(parents=True, exist_ok=True)
+
+    # CIG-1: Читаем из ВСЕХ dataset-директорий (новые типизированные + legacy)
+    all_samples = _collect_training_samples()
+    if not all_samples:
+        return {'success': False, 'error': 'No training images found in any dataset directory'}
+
+    split_keys = [s[0] for s in all_samples]
+    dedup_stats = None
+    if PIL_AVAILABLE:
+        import dataset_dedup
+        all_samples, split_keys, dedup_stats = _dedup_samples(
+            all_samples, dedup_per_cluster,
+            dataset_dedup.DEFAULT_DISTANCE if dedup_distance is None else dedup_distance)
+
+    # CIG-2: Разделяем 80% train / 20% val (стабильно по хешу пути; кластер дублей — целиком)
+    split = {'train': [], 'val': []}
+    for sample, key in zip(all_samples, split_keys):
+        split['val' if _is_val_sample(key) else 'train'].append(sample)
+
+    linked = 0
+    cache_stats = None
+    source_val = split['val']
+    if mode == 'lists' and imgsz and YOLO_AVAILABLE:
+        samples = split['train'] + split['val']
+        cached_paths, cache_stats = cache_resized_samples(samples, imgsz)
+        cached = dict(zip((s[0] for s in samples), cached_paths))
+        # Samples that could not be resized keep their original path
+        for subset in split:
+            split[subset] = [(cached[img], lbl, False) if cached[img] else (img, lbl, legacy)
+                             for img, lbl, legacy in split[subset]]
+
+    if mode == 'copy':
+        for subset, samples in split.items():
+            images_dir = output_path / subset / 'images'
+            labels_dir = output_path / subset / 'labels'
+            images_dir.mkdir(parents=True, exist_ok=True)
+            labels_dir.mkdir(parents=True, exist_ok=True)
+            for img_path, lbl_path, _ in samples:
+                shutil.copy(img_path, images_dir / img_path.name)
+                if lbl_path:
+                    shutil.copy(lbl_path, labels_dir / lbl_path.name)
+        train_ref, val_ref = 'train/images', 'val/images'
+    else:
+        legacy_images = output_path / 'legacy' / 'images'
+        legacy_labels = output_path / 'legacy' / 'labels'
+        legacy_images.mkdir(parents=True, exist_ok=True)
+        legacy_labels.mkdir(parents=True, exist_ok=True)
+
+        wanted = set()
+
+        def listed(samples):
+            nonlocal linked
+            paths = []
+            for img_path, lbl_path, legacy in samples:
+                if legacy:
+                    dst = legacy_images / img_path.name
+                    linked += _link_file(img_path, dst)
+                    wanted.add(dst.name)
+                    if lbl_path:
+                        _link_file(lbl_path, legacy_labels / lbl_path.name)
+                        wanted.add(lbl_path.name)
+                    img_path = dst
+                paths.append(str(Path(img_path).absolute()))
+            return paths
+
+        lists = {subset: listed(samples) for subset, samples in split.items()}
+        # Оригиналы val для bench_models: модели сравниваются на полном разрешении, не на кэше
+        source_list = output_path / 'val.source.txt'
+        if cache_stats:
+            lists['val.source'] = listed(source_val)
+        elif source_list.exists():
+            source_list.unlink()
+
+        # Убираем ссылки на удалённые образцы
+        for stale_dir in (legacy_images, legacy_labels):
+            for f in stale_dir.iterdir():
+                if f.name not in wanted:
+                    f.unlink()
+
+        for subset, paths in lists.items():
+            _write_if_changed(output_path / f'{subset}.txt', ''.join(p + '\n' for p in paths))
+        train_ref, val_ref = 'train.txt', 'val.txt'
+
+    class_mapping = _build_class_mapping()
 
     num_classes = max(len(class_mapping), 1)
     class_names = ['unknown'] * num_classes
@@ -425,28 +772,124 @@ def export_training_data(output_dir):
 
     data_yaml = {
         'path': str(output_path.absolute()),
-        'train': 'train/images',
-        'val': 'val/images',
+        'train': train_ref,
+        'val': val_ref,
         'nc': num_classes,
-        'names': class_names
+        'names': class_names,
+        'resize_imgsz': cache_stats['imgsz'] if cache_stats else 0,
     }
+    if cache_stats:
+        data_yaml['val_source'] = 'val.source.txt'
 
     import yaml
-    with open(output_path / 'data.yaml', 'w') as f:
-        yaml.dump(data_yaml, f, default_flow_style=False, allow_unicode=True)
+    _write_if_changed(output_path / 'data.yaml',
+                      yaml.dump(data_yaml, default_flow_style=False, allow_unicode=True))
 
     return {
         'success': True,
+        'mode': mode,
         'output_dir': str(output_path),
-        'train_images': copied_train,
-        'val_images': copied_val,
+        'train_images': len(split['train']),
+        'val_images': len(split['val']),
         'total_images': len(all_samples),
+        'linked_images': linked,
+        'resize_cache': cache_stats,
+        'dedup': dedup_stats,
         'num_classes': num_classes,
         'class_mapping': class_mapping,
         'data_yaml': str(output_path / 'data.yaml')
     }
 
 
+def _track_epochs(model, on_epoch=None):
+    """
+    Record wall time per epoch (train + val) via ultralytics callbacks.
+
+    Returns:
+        list that fills with seconds per epoch as training runs
+    """
+    epoch_seconds = []
+    epoch_start = {}
+
+    def start(trainer):
+        epoch_start['t'] = time.perf_counter()
+
+    def end(trainer):
+        epoch_seconds.append(round(time.perf_counter() - epoch_start.get('t', time.perf_counter()), 2))
+        if on_epoch:
+            on_epoch(trainer, epoch_seconds[-1])
+
+    model.add_callback('on_train_epoch_start', start)
+    model.add_callback('on_fit_epoch_end', end)
+    return epoch_seconds
+
+
+def _training_metrics(results):
+    """FIX-6: Извлекаем метрики качества модели"""
+    try:
+        rd = results.results_dict if hasattr(results, 'results_dict') else {}
+        return {
+            'mAP50':     round(float(rd.get('metrics/mAP50(B)',     rd.get('metrics/mAP50',     0))), 4),
+            'mAP50_95':  round(float(rd.get('metrics/mAP50-95(B)',  rd.get('metrics/mAP50-95',  0))), 4),
+            'precision': round(float(rd.get('metrics/precision(B)', rd.get('metrics/precision',  0))), 4),
+            'recall':    round(float(rd.get('metrics/recall(B)',    rd.get('metrics/recall',     0))), 4),
+        }
+    except Exception:
+        return {}  # метрики необязательны
+
+
+def install_model(source, imgsz, metrics, **extra):
+    """
+    Copy a model to the default location and record its metadata
+    (DEFAULT_MODEL_META: imgsz used for inference, metrics, source)
+    """
+    MODELS_DIR.mkdir(exist_ok=True)
+    shutil.copy(source, DEFAULT_MODEL)
+    _save_json(DEFAULT_MODEL_META, dict(
+        extra,
+        source=str(source),
+        imgsz=imgsz,
+        metrics=metrics,
+        installedAt=time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    ))
+
+
+def _install_best(save_dir, imgsz, metrics, mode):
+    """Copy best.pt of a run to the default model location"""
+    best_model = Path(save_dir) / 'weights' / 'best.pt'
+    if best_model.exists():
+        install_model(best_model, imgsz, metrics, mode=mode)
+
+
+def _load_json(path, default):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def _save_json(path, data):
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    tmp = Path(path).with_name(f'.{Path(path).name}.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def _record_training_run(mode, seconds, epochs, epoch_seconds_mean):
+    """Append a finished run to TRAINING_HISTORY_FILE (newest last, bounded)"""
+    history = _load_json(TRAINING_HISTORY_FILE, [])
+    history.append({
+        'mode': mode,
+        'finishedAt': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'seconds': round(seconds, 1),
+        'epochs': epochs,
+        'epochSecondsMean': epoch_seconds_mean,
+    })
+    _save_json(TRAINING_HISTORY_FILE, history[-50:])
+
+
 def train_model(data_yaml, epochs=100, imgsz=640, batch=16, output_dir=None):
     """
     Train YOLOv8 model on cigarette detection data
@@ -473,6 +916,8 @@ def train_model(data_yaml, epochs=100, imgsz=640, batch=16, output_dir=None):
     try:
         # Start with pretrained YOLOv8n (nano - fastest)
         model = YOLO('yolov8n.pt')
+        epoch_seconds = _track_epochs(model)
+        started = time.perf_counter()
 
         # Train
         results = model.train(
@@ -480,36 +925,27 @@ def train_model(data_yaml, epochs=100, imgsz=640, batch=16, output_dir=None):
             epochs=epochs,
             imgsz=imgsz,
             batch=batch,
+            workers=TRAIN_WORKERS,
             project=str(output_dir or MODELS_DIR),
             name='cigarette_detector',
             exist_ok=True
         )
 
         # Copy best model to default location
-        best_model = Path(results.save_dir) / 'weights' / 'best.pt'
-        if best_model.exists():
-            import shutil
-            MODELS_DIR.mkdir(exist_ok=True)
-            shutil.copy(best_model, DEFAULT_MODEL)
-
-        # FIX-6: Извлекаем метрики качества модели
-        metrics = {}
-        try:
-            rd = results.results_dict if hasattr(results, 'results_dict') else {}
-            metrics = {
-                'mAP50':     round(float(rd.get('metrics/mAP50(B)',     rd.get('metrics/mAP50',     0))), 4),
-                'mAP50_95':  round(float(rd.get('metrics/mAP50-95(B)',  rd.get('metrics/mAP50-95',  0))), 4),
-                'precision': round(float(rd.get('metrics/precision(B)', rd.get('metrics/precision',  0))), 4),
-                'recall':    round(float(rd.get('metrics/recall(B)',    rd.get('metrics/recall',     0))), 4),
-            }
-        except Exception:
-            pass  # метрики необязательны
+        metrics = _training_metrics(results)
+        _install_best(results.save_dir, imgsz, metrics, 'scratch')
+
+        mean_epoch = round(sum(epoch_seconds) / len(epoch_seconds), 2) if epoch_seconds else None
+        _record_training_run('scratch', time.perf_counter() - started, len(epoch_seconds), mean_epoch)
 
         return {
             'success': True,
             'model_path': str(DEFAULT_MODEL),
             'results_dir': str(results.save_dir),
             'metrics': metrics,
+            'epochs_run': len(epoch_seconds),
+            'epoch_seconds_mean': mean_epoch,
+            'epoch_seconds': epoch_seconds,
         }
     except Exception as e:
         return {
@@ -518,10 +954,781 @@ def train_model(data_yaml, epochs=100, imgsz=640, batch=16, output_dir=None):
         }
 
 
+def _transfer_class_head(trainer, base_model_path):
+    """
+    Copy per-class head weights of the base model into the new model.
+
+    Class IDs only ever get appended to class-mapping.json, so base class k
+    is still class k. When nc grew, ultralytics skips the classification
+    convs (shape mismatch) and starts them from scratch; this restores the
+    rows of the existing classes so only the new ones are learned anew.
+    """
+    import torch
+
+    base_head = YOLO(str(base_model_path)).model.model[-1]
+    targets = [trainer.model]
+    if getattr(trainer, 'ema', None) is not None:
+        targets.append(trainer.ema.ema)
+
+    for target in targets:
+        head = target.model[-1]
+        if head.nc == base_head.nc:
+            continue
+        for base_branch, branch in zip(base_head.cv3, head.cv3):
+            base_conv, conv = base_branch[-1], branch[-1]
+            n = min(base_conv.out_channels, conv.out_channels)
+            with torch.no_grad():
+                conv.weight[:n].copy_(base_conv.weight[:n].to(conv.weight.device))
+                conv.bias[:n].copy_(base_conv.bias[:n].to(conv.bias.device))
+
+
+def _dataset_fingerprint(data_yaml):
+    """
+    What a resumed run must train on: class count and a hash of the train/val
+    lists (file names for image directories). The retrain scheduler
+    re-exports into the same data.yaml, so its path alone does not say
+    whether last.pt was trained on this dataset.
+    """
+    import yaml
+    with open(data_yaml, 'r', encoding='utf-8') as f:
+        data = yaml.safe_load(f)
+    root = Path(data.get('path') or Path(data_yaml).parent)
+    h = hashlib.sha1()
+    for split in ('train', 'val'):
+        target = root / data[split]
+        if target.is_file():
+            h.update(target.read_bytes())
+        elif target.is_dir():
+            h.update('\n'.join(sorted(p.name for p in target.iterdir())).encode('utf-8'))
+        h.update(b'\0')
+    return {'nc': int(data.get('nc') or len(data.get('names') or [])), 'lists': h.hexdigest()}
+
+
+def finetune_model(data_yaml, epochs=FINETUNE_EPOCHS, imgsz=640, batch=16, patience=FINETUNE_PATIENCE,
+                   save_period=FINETUNE_SAVE_PERIOD, output_dir=None):
+    """
+    Incremental training from the current production model.
+
+    Starts from cigarette_detector.pt (class head remapped when the class
+    mapping grew), with a short schedule, low learning rate and early
+    stopping on val fitness (mAP). Checkpoints are written every epoch
+    (last.pt) and every save_period epochs; the run state is kept in
+    FINETUNE_STATE_FILE, so calling this again after an interruption resumes
+    from last.pt instead of starting over — only on the same dataset (class
+    count and train/val lists, see _dataset_fingerprint); a run that failed
+    with an error is started afresh. Falls back to train_model when there is
+    no production model yet.
+
+    Args:
+        data_yaml: Path to data.yaml file
+        epochs: Maximum epochs
+        imgsz: Image size for training
+        batch: Batch size
+        patience: Epochs without val improvement before stopping
+        save_period: Extra checkpoint every N epochs
+        output_dir: Output directory for runs
+
+    Returns:
+        dict like train_model plus resumed, wall_seconds and the
+        estimated time saved against a from-scratch run
+    """
+    if not YOLO_AVAILABLE:
+        return {
+            'success': False,
+            'error': 'YOLOv8 not installed. Run: pip install ultralytics'
+        }
+
+    if not Path(data_yaml).exists():
+        return {
+            'success': False,
+            'error': f'Data YAML not found: {data_yaml}'
+        }
+
+    if not DEFAULT_MODEL.exists():
+        return train_model(data_yaml, imgsz=imgsz, batch=batch, output_dir=output_dir)
+
+    project = Path(output_dir or MODELS_DIR)
+    run_dir = project / 'cigarette_detector_finetune'
+    last_checkpoint = run_dir / 'weights' / 'last.pt'
+
+    dataset = _dataset_fingerprint(data_yaml)
+    state = _load_json(FINETUNE_STATE_FILE, {})
+    resume = (state.get('status') == 'running' and state.get('data_yaml') == str(data_yaml)
+              and state.get('dataset') == dataset and last_checkpoint.exists())
+    if not resume:
+        # Снимок базовой модели: DEFAULT_MODEL перезаписывается в конце обучения
+        # Чекпоинты завершённого прогона нельзя продолжить — начинаем чисто
+        shutil.rmtree(run_dir / 'weights', ignore_errors=True)
+        run_dir.mkdir(parents=True, exist_ok=True)
+        base_model = run_dir / 'base.pt'
+        shutil.copy(DEFAULT_MODEL, base_model)
+        state = {
+            'status': 'running',
+            'data_yaml': str(data_yaml),
+            'dataset': dataset,
+            'base_model': str(base_model),
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'elapsed_seconds': 0.0,
+            'attempts': 0,
+        }
+    state['attempts'] = state.get('attempts', 0) + 1
+    _save_json(FINETUNE_STATE_FILE, state)
+
+    elapsed_before = state.get('elapsed_seconds', 0.0)
+    started = time.perf_counter()
+
+    def checkpoint_state(trainer, seconds):
+        state['elapsed_seconds'] = round(elapsed_before + time.perf_counter() - started, 1)
+        state['epoch'] = int(getattr(trainer, 'epoch', 0)) + 1
+        _save_json(FINETUNE_STATE_FILE, state)
+
+    try:
+        if resume:
+            model = YOLO(str(last_checkpoint))
+            epoch_seconds = _track_epochs(model, checkpoint_state)
+            results = model.train(resume=True)
+        else:
+            model = YOLO(state['base_model'])
+            epoch_seconds = _track_epochs(model, checkpoint_state)
+            model.add_callback('on_pretrain_routine_end',
+                               lambda trainer: _transfer_class_head(trainer, state['base_model']))
+            results = model.train(
+                data=data_yaml,
+                epochs=epochs,
+                imgsz=imgsz,
+                batch=batch,
+                workers=TRAIN_WORKERS,
+                patience=patience,
+                save_period=save_period,
+                lr0=FINETUNE_LR0,
+                warmup_epochs=1,
+                project=str(project),
+                name=run_dir.name,
+                exist_ok=True
+            )
+    except Exception as e:
+        # Ошибка обучения (данные, конфиг) при повторе не исчезнет — прогон не продолжаем.
+        # Прерывание (SIGTERM, Ctrl+C) сюда не попадает: state остаётся 'running',
+        # следующий вызов на том же датасете продолжит с last.pt
+        state.update(status='failed', error=str(e))
+        _save_json(FINETUNE_STATE_FILE, state)
+        return {
+            'success': False,
+            'error': f'Fine-tuning failed: {str(e)}',
+            'resumable': False,
+        }
+
+    metrics = _training_metrics(results)
+    _install_best(results.save_dir, imgsz, metrics, 'finetune')
+
+    wall_seconds = elapsed_before + time.perf_counter() - started
+    mean_epoch = round(sum(epoch_seconds) / len(epoch_seconds), 2) if epoch_seconds else None
+    state.update(status='done', elapsed_seconds=round(wall_seconds, 1))
+    _save_json(FINETUNE_STATE_FILE, state)
+    _record_training_run('finetune', wall_seconds, state.get('epoch', len(epoch_seconds)), mean_epoch)
+
+    # Время обучения с нуля: последний реальный прогон, иначе оценка по текущей эпохе
+    scratch_runs = [r for r in _load_json(TRAINING_HISTORY_FILE, []) if r.get('mode') == 'scratch']
+    if scratch_runs:
+        scratch_seconds, scratch_source = scratch_runs[-1]['seconds'], 'last scratch run'
+    elif mean_epoch:
+        scratch_seconds, scratch_source = mean_epoch * SCRATCH_EPOCHS, f'{SCRATCH_EPOCHS} x mean epoch'
+    else:
+        scratch_seconds, scratch_source = None, None
+
+    return {
+        'success': True,
+        'mode': 'finetune',
+        'resumed': resume,
+        'attempts': state['attempts'],
+        'model_path': str(DEFAULT_MODEL),
+        'results_dir': str(results.save_dir),
+        'metrics': metrics,
+        'epochs_run': state.get('epoch', len(epoch_seconds)),
+        'epoch_seconds_mean': mean_epoch,
+        'epoch_seconds': epoch_seconds,
+        'wall_seconds': round(wall_seconds, 1),
+        'scratch_seconds': round(scratch_seconds, 1) if scratch_seconds else None,
+        'scratch_seconds_source': scratch_source,
+        'time_saved_seconds': round(scratch_seconds - wall_seconds, 1) if scratch_seconds else None,
+    }
+
+
+def _parse_candidate(spec):
+    """'models/x.pt@512' -> (path, 512); imgsz defaults to DEFAULT_IMGSZ"""
+    path, _, size = spec.rpartition('@') if '@' in spec else (spec, '', '')
+    return path, int(size) if size else DEFAULT_IMGSZ
+
+
+def _backend(path):
+    name = str(path).rstrip('/')
+    for suffix, backend in (('.pt', 'pytorch'), ('.onnx', 'onnx'), ('_openvino_model', 'openvino'),
+                            ('.torchscript', 'torchscript'), ('.engine', 'tensorrt')):
+        if name.endswith(suffix):
+            return backend
+    return 'other'
+
+
+def _split_images(data_yaml, split='val'):
+    """Image paths of one split of a YOLO data.yaml (list file or image directory)"""
+    import yaml
+    with open(data_yaml, 'r', encoding='utf-8') as f:
+        data = yaml.safe_load(f)
+    root = Path(data.get('path') or Path(data_yaml).parent)
+    target = root / data[split]
+    if target.suffix == '.txt':
+        return [Path(line.strip()) for line in target.read_text(encoding='utf-8').splitlines() if line.strip()]
+    return sorted(p for p in target.iterdir() if p.name.endswith(TRAINING_IMAGE_EXTENSIONS))
+
+
+def _bench_data_yaml(data_yaml, sizes):
+    """
+    data.yaml to score candidates with: the val split at original resolution.
+
+    An export with a resize cache has val.txt pointing at images already
+    shrunk to resize_imgsz; a candidate at a larger imgsz would be measured
+    on upscaled copies. Such exports also list the original val images
+    (val_source), so a bench-only data.bench.yaml next to data.yaml uses
+    those instead.
+
+    Args:
+        data_yaml: data.yaml given to bench / distill
+        sizes: candidate input sizes
+
+    Returns:
+        path of the data.yaml to evaluate on
+
+    Raises:
+        ValueError: val is cached below a candidate's imgsz and the
+            originals are not listed (export made before val_source)
+    """
+    import yaml
+    with open(data_yaml, 'r', encoding='utf-8') as f:
+        data = yaml.safe_load(f)
+    cache_imgsz = data.get('resize_imgsz')
+    if cache_imgsz is None:
+        # Старый экспорт без resize_imgsz: размер кэша из пути val-изображений
+        cache_root = RESIZE_CACHE_DIR.absolute()
+        first = next(iter(_split_images(data_yaml, 'val')), None)
+        if first is not None and first.absolute().parent.parent.parent == cache_root:
+            cache_imgsz = int(first.parent.parent.name)
+    if not cache_imgsz:
+        return str(data_yaml)
+
+    if data.get('val_source'):
+        bench = dict(data, val=data['val_source'], resize_imgsz=0)
+        del bench['val_source']
+        bench_yaml = Path(data_yaml).with_name('data.bench.yaml')
+        _write_if_changed(bench_yaml, yaml.dump(bench, default_flow_style=False, allow_unicode=True))
+        return str(bench_yaml)
+
+    too_large = sorted({s for s in sizes if s > int(cache_imgsz)})
+    if too_large:
+        raise ValueError(f'Val split is resized to {cache_imgsz}px; cannot score imgsz {too_large} on it. '
+                         f'Re-export with --imgsz 0 or a current export (val.source.txt)')
+    return str(data_yaml)
+
+
+def _label_path(img_path):
+    """YOLO label location for an image: last /images/ -> /labels/, suffix .txt"""
+    parts = str(img_path).rsplit(f'{os.sep}images{os.sep}', 1)
+    return Path(f'{os.sep}labels{os.sep}'.join(parts)).with_suffix('.txt')
+
+
+def _label_boxes(img_path):
+    """Ground truth (classes, xyxy normalized) from the YOLO label next to the image"""
+    label = _label_path(img_path)
+    rows = []
+    if label.exists():
+        for line in label.read_text(encoding='utf-8').splitlines():
+            vals = line.split()
+            if len(vals) >= 5:
+                rows.append([float(v) for v in vals[:5]])
+    rows = np.array(rows, dtype=np.float32).reshape(-1, 5)
+    cls, xc, yc, w, h = rows.T
+    return cls.astype(int), np.stack([xc - w / 2, yc - h / 2, xc + w / 2, yc + h / 2], axis=1)
+
+
+def _box_iou(a, b):
+    """IoU matrix between (n, 4) and (m, 4) xyxy boxes"""
+    tl = np.maximum(a[:, None, :2], b[None, :, :2])
+    br = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    inter = np.clip(br - tl, 0, None).prod(axis=2)
+    area_a = (a[:, 2:] - a[:, :2]).prod(axis=1)
+    area_b = (b[:, 2:] - b[:, :2]).prod(axis=1)
+    return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-9)
+
+
+def _small_pack_recall(model, images, imgsz, confidence=0.25, iou=0.5):
+    """Share of small ground-truth packs (area < SMALL_BOX_AREA) found with the right class"""
+    found = total = 0
+    for img_path, image in images:
+        gt_cls, gt_boxes = _label_boxes(img_path)
+        small = (gt_boxes[:, 2:] - gt_boxes[:, :2]).prod(axis=1) < SMALL_BOX_AREA
+        if not small.any():
+            continue
+        result = model(image, verbose=False, conf=confidence, imgsz=imgsz)[0]
+        pred_boxes = result.boxes.xyxyn.cpu().numpy() if result.boxes is not None else np.empty((0, 4))
+        pred_cls = result.boxes.cls.cpu().numpy().astype(int) if result.boxes is not None else np.empty(0, int)
+
+        gt_cls, gt_boxes = gt_cls[small], gt_boxes[small]
+        total += len(gt_boxes)
+        if not len(pred_boxes):
+            continue
+        ious = _box_iou(gt_boxes, pred_boxes)
+        ious[gt_cls[:, None] != pred_cls[None, :]] = 0
+        used = set()
+        for g in np.argsort(-ious.max(axis=1)):
+            p = int(np.argmax(ious[g]))
+            if ious[g, p] >= iou and p not in used:
+                used.add(p)
+                found += 1
+    return round(found / total, 4) if total else None, total
+
+
+def _latency(model, images, imgsz, batch):
+    """CPU latency percentiles: one image per call, and per image in batches"""
+    pil_images = [image for _, image in images]
+    for image in pil_images[:2]:
+        model(image, verbose=False, imgsz=imgsz)    # warm-up
+
+    single = []
+    for image in pil_images:
+        start = time.perf_counter()
+        model(image, verbose=False, imgsz=imgsz)
+        single.append((time.perf_counter() - start) * 1000)
+
+    batched = []
+    for i in range(0, len(pil_images), batch):
+        chunk = pil_images[i:i + batch]
+        start = time.perf_counter()
+        model(chunk, verbose=False, imgsz=imgsz)
+        batched.append((time.perf_counter() - start) * 1000 / len(chunk))
+
+    def pct(values, q):
+        return round(float(np.percentile(values, q)), 2) if values else None
+
+    return {
+        'singleP50Ms': pct(single, 50),
+        'singleP95Ms': pct(single, 95),
+        'singleP99Ms': pct(single, 99),
+        'batchedP50MsPerImage': pct(batched, 50),
+        'batchedP95MsPerImage': pct(batched, 95),
+    }
+
+
+def _load_eval_images(paths):
+    """Decode evaluation images once (EXIF orientation applied, RGB)"""
+    images = []
+    for img_path in paths:
+        with Image.open(img_path) as img:
+            images.append((img_path, ImageOps.exif_transpose(img).convert('RGB')))
+    return images
+
+
+def _evaluate_candidate(path, imgsz, data_yaml, images, batch):
+    """Accuracy (val split) and CPU latency of one model at one input size"""
+    name = f'{Path(path).name}@{imgsz}'
+    row = {'name': name, 'path': str(path), 'imgsz': imgsz, 'backend': _backend(path)}
+    print(f"[YOLO Bench] {name} ({row['backend']})", file=sys.stderr)
+    try:
+        model = YOLO(str(path), task='detect')
+        val = model.val(data=data_yaml, imgsz=imgsz, batch=1, plots=False, verbose=False)
+        row.update(
+            mAP50=round(float(val.box.map50), 4),
+            mAP50_95=round(float(val.box.map), 4),
+            recall=round(float(val.box.mr), 4),
+        )
+        row['smallRecall'], row['smallPacks'] = _small_pack_recall(model, images, imgsz)
+        row.update(_latency(model, images[:BENCH_LATENCY_IMAGES], imgsz, batch))
+    except Exception as e:
+        row['error'] = str(e)
+    return row
+
+
+def pareto_frontier(rows, cost='singleP50Ms', gain='mAP50'):
+    """Names of candidates not dominated (lower-or-equal cost and higher-or-equal gain, one strictly)"""
+    ok = [r for r in rows if r.get(cost) is not None and r.get(gain) is not None]
+    frontier = []
+    for r in ok:
+        dominated = any(
+            o[cost] <= r[cost] and o[gain] >= r[gain] and (o[cost] < r[cost] or o[gain] > r[gain])
+            for o in ok
+        )
+        if not dominated:
+            frontier.append(r['name'])
+    return frontier
+
+
+def _pick_candidate(rows, frontier, promote, max_latency_ms):
+    """Candidate row to promote: by name, or 'auto' = best mAP50 on the frontier within the latency budget"""
+    promotable = [r for r in rows if r['backend'] == 'pytorch' and 'error' not in r]
+    if promote != 'auto':
+        return next((r for r in promotable if r['name'] == promote), None)
+    choices = [r for r in promotable if r['name'] in frontier
+               and (max_latency_ms is None or r['singleP50Ms'] <= max_latency_ms)]
+    return max(choices, key=lambda r: r['mAP50'], default=None)
+
+
+def bench_models(data_yaml, candidates, formats=(), batch=8, promote=None, max_latency_ms=None, output=None):
+    """
+    Compare detector candidates on the validation split, at the original
+    image resolution (see _bench_data_yaml).
+
+    Each candidate is 'path[@imgsz]'; with formats, every .pt candidate is also
+    exported to those backends (onnx, openvino, ...) at its imgsz and measured
+    as a separate candidate. Per candidate: mAP50 / mAP50-95 / recall from
+    ultralytics val, recall on small packs, and CPU latency percentiles.
+
+    Args:
+        data_yaml: data.yaml whose val split is used
+        candidates: list of 'path[@imgsz]'
+        formats: extra backends to export .pt candidates to
+        batch: images per call for batched latency
+        promote: candidate name or 'auto' to install as cigarette_detector.pt
+        max_latency_ms: 'auto' promotion budget for single-image p50
+        output: JSON report path (default BENCH_REPORT_FILE)
+
+    Returns:
+        dict with candidates, frontier and promoted (or None)
+    """
+    if not YOLO_AVAILABLE:
+        return {'success': False, 'error': 'YOLOv8 not installed. Run: pip install ultralytics'}
+    if not Path(data_yaml).exists():
+        return {'success': False, 'error': f'Data YAML not found: {data_yaml}'}
+
+    specs = [_parse_candidate(c) for c in candidates]
+    for path, imgsz in list(specs):
+        if _backend(path) != 'pytorch':
+            continue
+        for fmt in formats:
+            try:
+                exported = YOLO(path).export(format=fmt, imgsz=imgsz, verbose=False)
+                specs.append((str(exported), imgsz))
+            except Exception as e:
+                print(f"[YOLO Bench] Export of {path} to {fmt} failed: {e}", file=sys.stderr)
+
+    try:
+        eval_yaml = _bench_data_yaml(data_yaml, [imgsz for _, imgsz in specs])
+    except ValueError as e:
+        return {'success': False, 'error': str(e)}
+    val_paths = _split_images(eval_yaml, 'val')
+    if not val_paths:
+        return {'success': False, 'error': 'Validation split is empty'}
+    images = _load_eval_images(val_paths)
+
+    rows = [_evaluate_candidate(path, imgsz, eval_yaml, images, batch) for path, imgsz in specs]
+
+    frontier = pareto_frontier(rows)
+    for r in rows:
+        r['pareto'] = r['name'] in frontier
+
+    print(f"\n[YOLO Bench] {len(val_paths)} val images", file=sys.stderr)
+    for r in sorted(rows, key=lambda r: r.get('singleP50Ms') or float('inf')):
+        if 'error' in r:
+            print(f"[YOLO Bench]   {r['name']:<40} error: {r['error']}", file=sys.stderr)
+            continue
+        print(f"[YOLO Bench] {'*' if r['pareto'] else ' '} {r['name']:<40} {r['backend']:<10} "
+              f"mAP50={r['mAP50']:.4f} smallRecall={r['smallRecall']} "
+              f"p50={r['singleP50Ms']} p95={r['singleP95Ms']} batched={r['batchedP50MsPerImage']} ms",
+              file=sys.stderr)
+    print("[YOLO Bench] * = Pareto frontier (single-image p50 vs mAP50)", file=sys.stderr)
+
+    promoted = None
+    if promote:
+        choice = _pick_candidate(rows, frontier, promote, max_latency_ms)
+        if choice is None:
+            print(f"[YOLO Bench] No promotable (.pt) candidate for '{promote}'", file=sys.stderr)
+        else:
+            if DEFAULT_MODEL.exists():
+                shutil.copy(DEFAULT_MODEL, DEFAULT_MODEL.with_suffix('.pt.backup'))
+            install_model(choice['path'], choice['imgsz'],
+                          {k: choice[k] for k in ('mAP50', 'mAP50_95', 'recall', 'smallRecall',
+                                                  'singleP50Ms', 'singleP95Ms', 'batchedP50MsPerImage')},
+                          mode='bench-promotion', benchReport=str(output or BENCH_REPORT_FILE))
+            promoted = choice['name']
+            print(f"[YOLO Bench] Promoted {promoted} to {DEFAULT_MODEL}", file=sys.stderr)
+
+    report = {
+        'success': True,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'data': str(data_yaml),
+        'evalData': eval_yaml,
+        'valImages': len(val_paths),
+        'candidates': rows,
+        'frontier': frontier,
+        'promoted': promoted,
+    }
+    _save_json(output or BENCH_REPORT_FILE, report)
+    return report
+
+
+def build_distill_dataset(data_yaml, teacher_path, out_dir, imgsz=DEFAULT_IMGSZ, confidence=DISTILL_CONFIDENCE):
+    """
+    Training set for the student: ground-truth labels plus teacher detections.
+
+    Teacher boxes (conf >= confidence) that do not overlap a labeled pack
+    (IoU < 0.5) are added as pseudo-labels, so the student also learns the
+    packs annotators skipped and mimics the teacher's recall. Images are
+    hardlinked into <out_dir>/images; val stays the original, human-labeled
+    split so student and teacher are scored on the same ground truth.
+
+    Returns:
+        (data.yaml path, stats dict)
+    """
+    out_dir = Path(out_dir)
+    images_dir = out_dir / 'images'
+    labels_dir = out_dir / 'labels'
+    for d in (images_dir, labels_dir):
+        shutil.rmtree(d, ignore_errors=True)
+        d.mkdir(parents=True)
+
+    teacher = YOLO(str(teacher_path))
+    train_paths = _split_images(data_yaml, 'train')
+    added = kept = 0
+    train_list = []
+    for img_path in train_paths:
+        key = hashlib.sha1(str(Path(img_path).absolute()).encode('utf-8')).hexdigest()
+        dst = images_dir / f'{key}{Path(img_path).suffix}'
+        _link_file(img_path, dst)
+        train_list.append(str(dst.absolute()))
+
+        gt_cls, gt_boxes = _label_boxes(img_path)
+        lines = []
+        label = _label_path(img_path)
+        if label.exists():
+            lines = [line for line in label.read_text(encoding='utf-8').splitlines() if line.strip()]
+        kept += len(lines)
+
+        result = teacher(str(img_path), verbose=False, conf=confidence, imgsz=imgsz)[0]
+        if result.boxes is not None and len(result.boxes):
+            pred_boxes = result.boxes.xyxyn.cpu().numpy()
+            pred_cls = result.boxes.cls.cpu().numpy().astype(int)
+            overlap = _box_iou(pred_boxes, gt_boxes).max(axis=1) if len(gt_boxes) else np.zeros(len(pred_boxes))
+            for (x1, y1, x2, y2), c in zip(pred_boxes[overlap < 0.5], pred_cls[overlap < 0.5]):
+                lines.append(f'{c} {(x1 + x2) / 2:.6f} {(y1 + y2) / 2:.6f} {x2 - x1:.6f} {y2 - y1:.6f}')
+                added += 1
+        (labels_dir / f'{key}.txt').write_text(''.join(line + '\n' for line in lines), encoding='utf-8')
+
+    import yaml
+    with open(data_yaml, 'r', encoding='utf-8') as f:
+        data = yaml.safe_load(f)
+    (out_dir / 'train.txt').write_text(''.join(p + '\n' for p in train_list), encoding='utf-8')
+    (out_dir / 'val.txt').write_text(
+        ''.join(str(Path(p).absolute()) + '\n' for p in _split_images(data_yaml, 'val')), encoding='utf-8')
+    data.update(path=str(out_dir.absolute()), train='train.txt', val='val.txt')
+    distill_yaml = out_dir / 'data.yaml'
+    with open(distill_yaml, 'w', encoding='utf-8') as f:
+        yaml.dump(data, f, default_flow_style=False, allow_unicode=True)
+
+    return distill_yaml, {'trainImages': len(train_list), 'labeledBoxes': kept, 'pseudoBoxes': added}
+
+
+def _prune_channels(trainer, ratio, imgsz):
+    """
+    Structured L2 channel pruning of the student before fine-tuning
+    (torch-pruning DepGraph keeps Concat/C2f/shortcut shapes consistent;
+    the Detect head is left intact so outputs and class count are unchanged)
+    """
+    import torch
+
+    model = trainer.model
+    example = torch.zeros(1, 3, imgsz, imgsz)
+    head = model.model[-1]
+    for p in model.parameters():
+        p.requires_grad_(True)
+    pruner = torch_pruning.pruner.MagnitudePruner(
+        model, example,
+        importance=torch_pruning.importance.MagnitudeImportance(p=2),
+        pruning_ratio=ratio,
+        ignored_layers=[head],
+    )
+    pruner.step()
+    trainer.model = model
+
+
+def distill_model(data_yaml, teacher_path, student='yolov8n.pt', imgsz=DEFAULT_IMGSZ, epochs=DISTILL_EPOCHS,
+                  prune=0.0, max_map_drop=DISTILL_MAX_MAP_DROP, batch=16, install=True):
+    """
+    Distill a larger teacher detector into a smaller, cheaper student.
+
+    1. Teacher pseudo-labels are merged into the training split
+       (build_distill_dataset).
+    2. The student (default yolov8n.pt, optionally at a smaller imgsz)
+       trains on it.
+    3. Optional: its channels are pruned by `prune` (fraction, needs
+       torch-pruning) and it is fine-tuned again.
+    4. Teacher and student are scored on the val split: mAP and CPU latency.
+
+    The student is installed as cigarette_detector.pt only if its mAP50 is
+    within max_map_drop of the teacher's.
+
+    Args:
+        data_yaml: export_training_data output the teacher was trained on
+        teacher_path: teacher .pt
+        student: student initial weights or model yaml
+        imgsz: student input size
+        epochs: student training epochs
+        prune: channel pruning ratio (0 = off)
+        max_map_drop: largest accepted mAP50 loss vs. the teacher
+        batch: training batch size
+        install: install the student when it is within max_map_drop
+
+    Returns:
+        dict with teacher / student rows, speedup, mapDrop and installed
+    """
+    if not YOLO_AVAILABLE:
+        return {'success': False, 'error': 'YOLOv8 not installed. Run: pip install ultralytics'}
+    for required in (data_yaml, teacher_path):
+        if not Path(required).exists():
+            return {'success': False, 'error': f'Not found: {required}'}
+    if prune and not PRUNING_AVAILABLE:
+        return {'success': False, 'error': 'Pruning requires torch-pruning. Run: pip install torch-pruning'}
+
+    teacher_imgsz = model_imgsz(teacher_path)
+    try:
+        eval_yaml = _bench_data_yaml(data_yaml, [teacher_imgsz, imgsz])
+    except ValueError as e:
+        return {'success': False, 'error': str(e)}
+
+    started = time.perf_counter()
+    try:
+        distill_yaml, dataset_stats = build_distill_dataset(data_yaml, teacher_path, DISTILL_DIR / 'dataset', imgsz)
+
+        model = YOLO(student)
+        results = model.train(data=str(distill_yaml), epochs=epochs, imgsz=imgsz, batch=batch,
+                              workers=TRAIN_WORKERS, project=str(DISTILL_DIR), name='student', exist_ok=True)
+        student_path = Path(results.save_dir) / 'weights' / 'best.pt'
+
+        if prune:
+            model = YOLO(str(student_path))
+            model.add_callback('on_pretrain_routine_start', lambda trainer: _prune_channels(trainer, prune, imgsz))
+            results = model.train(data=str(distill_yaml), epochs=PRUNE_FINETUNE_EPOCHS, imgsz=imgsz, batch=batch,
+                                  lr0=FINETUNE_LR0, warmup_epochs=0, workers=TRAIN_WORKERS,
+                                  project=str(DISTILL_DIR), name='student_pruned', exist_ok=True)
+            student_path = Path(results.save_dir) / 'weights' / 'best.pt'
+    except Exception as e:
+        return {'success': False, 'error': f'Distillation failed: {str(e)}'}
+
+    images = _load_eval_images(_split_images(eval_yaml, 'val'))
+    teacher_row = _evaluate_candidate(teacher_path, teacher_imgsz, eval_yaml, images, 8)
+    student_row = _evaluate_candidate(student_path, imgsz, eval_yaml, images, 8)
+    if 'error' in teacher_row or 'error' in student_row:
+        return {'success': False, 'error': teacher_row.get('error') or student_row.get('error'),
+                'teacher': teacher_row, 'student': student_row}
+
+    map_drop = round(teacher_row['mAP50'] - student_row['mAP50'], 4)
+    speedup = round(teacher_row['singleP50Ms'] / student_row['singleP50Ms'], 2) if student_row['singleP50Ms'] else None
+    print(f"[YOLO Distill] teacher mAP50={teacher_row['mAP50']} p50={teacher_row['singleP50Ms']} ms | "
+          f"student mAP50={student_row['mAP50']} p50={student_row['singleP50Ms']} ms | "
+          f"drop={map_drop} speedup={speedup}x", file=sys.stderr)
+
+    installed = False
+    if install and map_drop <= max_map_drop:
+        if DEFAULT_MODEL.exists():
+            shutil.copy(DEFAULT_MODEL, DEFAULT_MODEL.with_suffix('.pt.backup'))
+        install_model(student_path, imgsz,
+                      {k: student_row[k] for k in ('mAP50', 'mAP50_95', 'recall', 'smallRecall', 'singleP50Ms')},
+                      mode='distill', teacher=str(teacher_path), prune=prune,
+                      teacherMetrics={k: teacher_row[k] for k in ('mAP50', 'mAP50_95', 'singleP50Ms')})
+        installed = True
+
+    return {
+        'success': True,
+        'dataset': dataset_stats,
+        'teacher': teacher_row,
+        'student': student_row,
+        'mapDrop': map_drop,
+        'speedup': speedup,
+        'pruneRatio': prune,
+        'installed': installed,
+        'model_path': str(DEFAULT_MODEL) if installed else str(student_path),
+        'wall_seconds': round(time.perf_counter() - started, 1),
+    }
+
+
+def get_status():
+    return {
+        'yolo_available': YOLO_AVAILABLE,
+        'model_exists': DEFAULT_MODEL.exists(),
+        'model_path': str(DEFAULT_MODEL),
+        'class_mapping_exists': CLASS_MAPPING_FILE.exists(),
+        'num_classes': len(load_class_mapping()) if CLASS_MAPPING_FILE.exists() else 0
+    }
+
+
+def handle_request(request):
+    """Run one serve-stdio request (detect / display / status)"""
+    mode = request.get('mode')
+    if mode == 'status':
+        return dict(get_status(), success=True,
+                    loaded_models=list(_models))
+    if mode not in ('detect', 'display'):
+        return {'success': False, 'error': f'Unknown mode: {mode}'}
+    if not request.get('image'):
+        return {'success': False, 'error': 'Image required'}
+    if mode == 'detect':
+        return detect_and_count(request['image'], request.get('model'),
+                                request.get('productId'), request.get('confidence', 0.5))
+    return check_display(request['image'], request.get('expected') or [],
+                         request.get('model'), request.get('confidence', 0.3))
+
+
+def serve_stdio(workers=2):
+    """
+    Long-lived worker for the yolo-wrapper.js spawn fallback.
+
+    Reads one JSON request per line from stdin until EOF and writes one JSON
+    response per line ({"id": ..., **result}) to stdout. Requests run on a
+    thread pool, so responses may come back out of order. Anything else that
+    would print to stdout (decode errors, library output) goes to stderr.
+    """
+    out = sys.stdout
+    sys.stdout = sys.stderr
+    write_lock = threading.Lock()
+
+    def respond(request_id, result):
+        line = json.dumps(dict(result, id=request_id))
+        with write_lock:
+            out.write(line + '\n')
+            out.flush()
+
+    def run(request):
+        try:
+            result = handle_request(request)
+        except Exception as e:
+            result = {'success': False, 'error': str(e)}
+        respond(request.get('id'), result)
+
+    # Load the default model up front so the first request is not slow
+    if YOLO_AVAILABLE and DEFAULT_MODEL.exists():
+        try:
+            get_model(DEFAULT_MODEL)
+        except Exception as e:
+            print(f"[YOLO Inference] Failed to preload model: {e}", file=sys.stderr)
+    respond(None, {'success': True, 'ready': True, 'yolo_available': YOLO_AVAILABLE})
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for line in sys.stdin:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                respond(None, {'success': False, 'error': f'Invalid JSON: {e}'})
+                continue
+            if not isinstance(request, dict):
+                respond(None, {'success': False, 'error': 'Request must be a JSON object'})
+                continue
+            pool.submit(run, request)
+
+
 def main():
     parser = argparse.ArgumentParser(description='YOLOv8 Cigarette Detection')
     parser.add_argument('--mode', type=str, required=True,
-                       choices=['detect', 'display', 'train', 'export', 'status'],
+                       choices=['detect', 'display', 'train', 'finetune', 'bench', 'distill', 'export',
+                                'status', 'serve-stdio'],
                        help='Operation mode')
     parser.add_argument('--image', type=str, help='Image (base64 or path)')
     parser.add_argument('--model', type=str, help='Model path')
@@ -529,22 +1736,43 @@ def main():
     parser.add_argument('--expected', type=str, help='Expected products (comma-separated)')
     parser.add_argument('--data', type=str, help='Data YAML path for training')
     parser.add_argument('--output', type=str, help='Output directory')
-    parser.add_argument('--epochs', type=int, default=100, help='Training epochs')
+    parser.add_argument('--epochs', type=int, help='Training epochs (default: 100 train, 30 finetune)')
+    parser.add_argument('--patience', type=int, default=FINETUNE_PATIENCE,
+                       help='Finetune: epochs without val mAP improvement before stopping')
     parser.add_argument('--confidence', type=float, default=0.5, help='Confidence threshold')
     parser.add_argument('--class-mapping', type=str, help='Path to class-mapping.json (typed training)')
+    parser.add_argument('--workers', type=int, default=2, help='Concurrent requests in serve-stdio mode')
+    parser.add_argument('--export-mode', type=str, default='lists', choices=['lists', 'copy'],
+                       help='Export image lists referencing the originals, or copy files')
+    parser.add_argument('--candidates', type=str, nargs='+',
+                       help='Bench: candidate models as path[@imgsz]')
+    parser.add_argument('--formats', type=str, nargs='*', default=[],
+                       help='Bench: also export .pt candidates to these backends (onnx, openvino, ...)')
+    parser.add_argument('--batch', type=int, default=8, help='Bench: images per batched call')
+    parser.add_argument('--promote', type=str,
+                       help="Bench: candidate name to install as the default model, or 'auto'")
+    parser.add_argument('--max-latency-ms', type=float, help="Bench: single-image p50 budget for --promote auto")
+    parser.add_argument('--teacher', type=str, help='Distill: teacher model (.pt)')
+    parser.add_argument('--student', type=str, default='yolov8n.pt', help='Distill: student weights or yaml')
+    parser.add_argument('--prune', type=float, default=0.0, help='Distill: channel pruning ratio (0 = off)')
+    parser.add_argument('--max-map-drop', type=float, default=DISTILL_MAX_MAP_DROP,
+                       help='Distill: install the student only within this mAP50 loss vs. the teacher')
+    parser.add_argument('--dedup', type=int, default=DEDUP_PER_CLUSTER,
+                       help='Export: images kept per near-duplicate cluster (0 = keep all)')
+    parser.add_argument('--dedup-distance', type=int, help='Export: max pHash Hamming distance for duplicates')
+    parser.add_argument('--imgsz', type=int, default=640,
+                       help='Training image size (export: resize cache resolution, 0 = originals)')
 
     args = parser.parse_args()
 
+    if args.mode == 'serve-stdio':
+        serve_stdio(args.workers)
+        return
+
     result = {}
 
     if args.mode == 'status':
-        result = {
-            'yolo_available': YOLO_AVAILABLE,
-            'model_exists': DEFAULT_MODEL.exists(),
-            'model_path': str(DEFAULT_MODEL),
-            'class_mapping_exists': CLASS_MAPPING_FILE.exists(),
-            'num_classes': len(load_class_mapping()) if CLASS_MAPPING_FILE.exists() else 0
-        }
+        result = get_status()
 
     elif args.mode == 'detect':
         if not args.image:
@@ -569,11 +1797,40 @@ def main():
                 args.confidence
             )
 
+    elif args.mode == 'bench':
+        if not args.data or not args.candidates:
+            result = {'success': False, 'error': 'Data YAML and --candidates required for bench'}
+        else:
+            result = bench_models(
+                args.data,
+                args.candidates,
+                args.formats,
+                args.batch,
+                args.promote,
+                args.max_latency_ms,
+                args.output
+            )
+
+    elif args.mode == 'distill':
+        if not args.data or not args.teacher:
+            result = {'success': False, 'error': 'Data YAML and --teacher required for distillation'}
+        else:
+            result = distill_model(
+                args.data,
+                args.teacher,
+                args.student,
+                args.imgsz,
+                args.epochs or DISTILL_EPOCHS,
+                args.prune,
+                args.max_map_drop
+            )
+
     elif args.mode == 'export':
         if not args.output:
             result = {'success': False, 'error': 'Output directory required'}
         else:
-            result = export_training_data(args.output)
+            result = export_training_data(args.output, args.export_mode, args.imgsz,
+                                          args.dedup, args.dedup_distance)
 
     elif args.mode == 'train':
         if not args.data:
@@ -581,7 +1838,20 @@ def main():
         else:
             result = train_model(
                 args.data,
-                args.epochs,
+                args.epochs or SCRATCH_EPOCHS,
+                imgsz=args.imgsz,
+                output_dir=args.output
+            )
+
+    elif args.mode == 'finetune':
+        if not args.data:
+            result = {'success': False, 'error': 'Data YAML required for fine-tuning'}
+        else:
+            result = finetune_model(
+                args.data,
+                args.epochs or FINETUNE_EPOCHS,
+                imgsz=args.imgsz,
+                patience=args.patience,
                 output_dir=args.output
             )
 
@@ -11,7 +11,16 @@ Endpoints:
   POST /display-embed  — checkDisplay via embeddings (1000+ products)
   POST /embed          — compute embedding for one image
   POST /catalog/add    — add reference embedding to catalog
+  POST /catalog/add-batch — add many items (images embedded in batches, one rebuild + one save)
+  POST /catalog/build-ann — (re)build IVF index over per-sample embeddings
   GET  /catalog/stats  — catalog statistics
+  GET  /catalog/version — catalog revision and lineage id
+  GET  /catalog/delta?since=N — binary delta of changes after revision N (410 if too old)
+  POST /catalog/apply-delta   — apply a binary delta (application/octet-stream body)
+
+Several server processes can share one catalog: run one with
+EMBEDDING_SHARED=writer and the rest with EMBEDDING_SHARED=reader
+(see shared_catalog.py).
 """
 import os
 import sys
@@ -19,7 +28,9 @@ import json
 import base64
 import threading
 import traceback
+import numpy as np
 from io import BytesIO
+from urllib.parse import urlparse, parse_qs
 from pathlib import Path
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from socketserver import ThreadingMixIn
@@ -41,8 +52,30 @@ CLASS_MAPPING_FILE = DATA_DIR / 'class-mapping.json'
 # Feature flag: embedding-based recognition
 USE_EMBEDDING = os.environ.get('USE_EMBEDDING_RECOGNITION', 'false').lower() == 'true'
 
+# Catalog search mode: 'centroid' (one vector per product), 'multi' (per-sample k-NN),
+# 'ann' (IVF index over per-sample embeddings, for 100k+ vectors) or 'pq' (PQ codes,
+# needs EMBEDDING_STORAGE=pq — storage mode is read by embedding_catalog itself)
+EMBEDDING_SEARCH_MODE = os.environ.get('EMBEDDING_SEARCH_MODE', 'centroid').lower()
+# ann mode: IVF cells scanned per query (higher = better recall, slower); 0 = index default
+EMBEDDING_ANN_NPROBE = int(os.environ.get('EMBEDDING_ANN_NPROBE', '0'))
+# Display checks: score crops against expectedProducts first; only crops whose best
+# expected similarity is below the margin are searched against the full catalog.
+# Off by default: an expected product above the margin is accepted even when another
+# product scores higher, so results can differ from the full search. Enable (per request:
+# expectedFirst) once `evaluate_catalog.py --expected-first` shows agreement on real data
+EMBEDDING_EXPECTED_FIRST = os.environ.get('EMBEDDING_EXPECTED_FIRST', 'false').lower() == 'true'
+EMBEDDING_EXPECTED_MARGIN = float(os.environ.get('EMBEDDING_EXPECTED_MARGIN', '0.75'))
+
+# Multi-process catalog sharing: '' (private copy per process), 'writer' (loads the JSON,
+# applies changes and publishes generations) or 'reader' (maps the current generation
+# read-only and picks up new ones on the next request; catalog writes are rejected)
+EMBEDDING_SHARED = os.environ.get('EMBEDDING_SHARED', '').lower()
+EMBEDDING_SHARED_DIR = os.environ.get('EMBEDDING_SHARED_DIR') or None
+
 # Load model at startup (keeps in memory for fast inference)
 model = None
+# Inference size recorded next to the model (<model>.meta.json, written on install/promotion)
+model_imgsz = 640
 class_mapping = {}
 
 # Embedding model (MobileNetV3-Small)
@@ -55,9 +88,18 @@ embed_catalog = None
 # Lock for catalog writes
 _catalog_lock = threading.Lock()
 
+# POST requests being handled right now (exposed in /health; job_runner pauses
+# background training while inference is queuing up)
+_inflight = {'count': 0}
+_inflight_lock = threading.Lock()
+
+# Cumulative expected-first counters (exposed in /health)
+_search_stats = {'requests': 0, 'crops': 0, 'resolvedExpected': 0}
+_search_stats_lock = threading.Lock()
+
 
 def load_model():
-    global model
+    global model, model_imgsz
     # If embedding mode and single-class model exists, use it
     model_path = DEFAULT_MODEL
     if USE_EMBEDDING and SINGLE_CLASS_MODEL.exists():
@@ -70,7 +112,12 @@ def load_model():
     try:
         from ultralytics import YOLO
         model = YOLO(str(model_path))
-        print(f"[YOLO Server] Model loaded: {model_path}")
+        meta_path = model_path.with_suffix('.meta.json')
+        model_imgsz = 640
+        if meta_path.exists():
+            with open(meta_path) as f:
+                model_imgsz = int(json.load(f).get('imgsz') or 640)
+        print(f"[YOLO Server] Model loaded: {model_path} (imgsz={model_imgsz})")
         return True
     except Exception as e:
         print(f"[YOLO Server] Failed to load model: {e}")
@@ -124,7 +171,23 @@ def load_embedding_catalog():
     try:
         import embedding_catalog as ec
         embed_catalog = ec
+        if EMBEDDING_SHARED == 'reader':
+            if ec.attach_shared(EMBEDDING_SHARED_DIR):
+                print(f"[YOLO Server] Attached shared catalog generation {ec.shared_generation()} (read-only)")
+            else:
+                print("[YOLO Server] No shared catalog published yet — waiting for the writer")
+            stats = ec.get_stats()
+            print(f"[YOLO Server] Embedding catalog: {stats['productCount']} products, {stats['totalEmbeddings']} embeddings")
+            return True
+
         loaded = ec.load()
+        if EMBEDDING_SEARCH_MODE == 'ann' and not ec.has_ann_index():
+            print("[YOLO Server] Building ANN index for search mode 'ann'...")
+            if ec.build_ann_index():
+                ec.save()
+        if EMBEDDING_SHARED == 'writer':
+            generation = ec.publish_shared(EMBEDDING_SHARED_DIR)
+            print(f"[YOLO Server] Published shared catalog generation {generation}")
         stats = ec.get_stats()
         print(f"[YOLO Server] Embedding catalog: {stats['productCount']} products, {stats['totalEmbeddings']} embeddings")
         return True
@@ -134,6 +197,22 @@ def load_embedding_catalog():
         return False
 
 
+def refresh_shared_catalog():
+    """Reader workers: switch to the writer's latest generation if it changed"""
+    if EMBEDDING_SHARED == 'reader' and embed_catalog is not None:
+        try:
+            if embed_catalog.refresh_shared():
+                print(f"[YOLO Server] Switched to shared catalog generation {embed_catalog.shared_generation()}")
+        except Exception as e:
+            print(f"[YOLO Server] Shared catalog refresh failed, keeping current generation: {e}")
+
+
+def publish_catalog():
+    """Writer: make the saved catalog visible to reader workers (caller holds _catalog_lock)"""
+    if EMBEDDING_SHARED == 'writer':
+        embed_catalog.publish_shared(EMBEDDING_SHARED_DIR)
+
+
 def compute_embedding(pil_image):
     """Compute 576-dim embedding from PIL Image"""
     import torch
@@ -154,6 +233,24 @@ def compute_embedding(pil_image):
     return emb.tolist()
 
 
+def compute_embeddings_batch(pil_images):
+    """Compute 576-dim embeddings for several PIL Images in one forward pass"""
+    import torch
+    if embed_model is None or embed_transform is None:
+        return [None] * len(pil_images)
+    if not pil_images:
+        return []
+
+    tensor = torch.stack([embed_transform(img.convert('RGB')) for img in pil_images])
+    with torch.no_grad():
+        features = embed_model(tensor).numpy().reshape(len(pil_images), -1)
+
+    # L2-normalize
+    norms = np.linalg.norm(features, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return (features / norms).tolist()
+
+
 def detect_and_count(image_path, confidence=0.3, product_id=None):
     """Run detection on image, count detected products"""
     if model is None:
@@ -164,6 +261,7 @@ def detect_and_count(image_path, confidence=0.3, product_id=None):
         results = model.predict(
             source=image_path,
             conf=confidence,
+            imgsz=model_imgsz,
             verbose=False,
             save=False,
         )
@@ -245,13 +343,15 @@ def check_display(image_path, expected_products, confidence=0.3):
     }
 
 
-def check_display_embed(image_path, expected_products, confidence=0.3, similarity_threshold=0.6):
+def check_display_embed(image_path, expected_products, confidence=0.3, similarity_threshold=0.6,
+                        search_mode=None, nprobe=None, expected_first=None, expected_margin=None):
     """
     Check display using embedding-based recognition.
     1) YOLO detects all packs (single-class)
     2) Crop each pack, compute embedding
-    3) Search catalog for closest product
-    4) Return same format as check_display()
+    3) Search catalog for closest product — expected products first, full
+       catalog only for crops below the expected margin
+    4) Return same format as check_display() plus searchStats
     """
     if model is None:
         return {'success': False, 'error': 'YOLO model not loaded'}
@@ -267,6 +367,7 @@ def check_display_embed(image_path, expected_products, confidence=0.3, similarit
         results = model.predict(
             source=image_path,
             conf=confidence,
+            imgsz=model_imgsz,
             verbose=False,
             save=False,
         )
@@ -294,9 +395,9 @@ def check_display_embed(image_path, expected_products, confidence=0.3, similarit
         img = Image.open(image_path).convert('RGB')
         img_w, img_h = img.size
 
-        # Step 3: For each detected box, crop and identify
-        detected_counts = {}  # product_id -> {'count': N, 'totalConf': F}
-        total_detections = 0
+        # Step 3: Crop each detected box and compute its embedding
+        crop_embeddings = []
+        crop_confidences = []
 
         for box in result.boxes:
             xyxy = box.xyxy[0].tolist()
@@ -316,14 +417,42 @@ def check_display_embed(image_path, expected_products, confidence=0.3, similarit
             if emb is None:
                 continue
 
-            # Search catalog
-            matches = embed_catalog.search(emb, top_k=1, threshold=similarity_threshold)
-            if not matches:
+            crop_embeddings.append(emb)
+            crop_confidences.append(det_conf)
+
+        # Step 4: Identify all crops with one batched catalog search
+        detected_counts = {}  # product_id -> {'count': N, 'totalConf': F}
+        total_detections = 0
+
+        if expected_first is None:
+            expected_first = EMBEDDING_EXPECTED_FIRST
+        resolved_expected = 0
+
+        if crop_embeddings:
+            # Product ids come from the same catalog generation that was searched
+            matches, similarities, resolved = embed_catalog.match_products(
+                np.asarray(crop_embeddings, dtype=np.float32),
+                top_k=1, threshold=similarity_threshold,
+                mode=search_mode or EMBEDDING_SEARCH_MODE,
+                expected_ids=expected_products if expected_first else None,
+                margin=expected_margin if expected_margin is not None else EMBEDDING_EXPECTED_MARGIN,
+                nprobe=nprobe or EMBEDDING_ANN_NPROBE or None,
+            )
+            resolved_expected = int(resolved.sum())
+        else:
+            matches, similarities = [], np.empty((0, 1), dtype=np.float32)
+
+        with _search_stats_lock:
+            _search_stats['requests'] += 1
+            _search_stats['crops'] += len(crop_embeddings)
+            _search_stats['resolvedExpected'] += resolved_expected
+
+        for det_conf, top, sim in zip(crop_confidences, matches, similarities[:, 0].tolist()):
+            pid = top[0]
+            if pid is None:
                 continue
 
-            match = matches[0]
-            pid = match['productId']
-            sim = match['similarity']
+            sim = round(sim, 4)
 
             if pid not in detected_counts:
                 detected_counts[pid] = {'count': 0, 'totalConfidence': 0}
@@ -332,7 +461,7 @@ def check_display_embed(image_path, expected_products, confidence=0.3, similarit
             detected_counts[pid]['totalConfidence'] += det_conf * sim
             total_detections += 1
 
-        # Step 4: Build response in SAME format as check_display
+        # Step 5: Build response in SAME format as check_display
         detected_products = []
         detected_ids = set()
         for pid, info in detected_counts.items():
@@ -351,14 +480,30 @@ def check_display_embed(image_path, expected_products, confidence=0.3, similarit
             'missingProducts': missing,
             'allPresent': len(missing) == 0,
             'totalDetections': total_detections,
+            'searchStats': {
+                'crops': len(crop_embeddings),
+                'resolvedExpected': resolved_expected,
+                'cheapTierFraction': round(resolved_expected / len(crop_embeddings), 4) if crop_embeddings else 0.0,
+            },
         }
 
     except Exception as e:
         return {'success': False, 'error': str(e), 'traceback': traceback.format_exc()}
 
 
+def search_stats():
+    """Cumulative expected-first counters since server start"""
+    with _search_stats_lock:
+        stats = dict(_search_stats)
+    stats['cheapTierFraction'] = round(stats['resolvedExpected'] / stats['crops'], 4) if stats['crops'] else 0.0
+    stats['expectedFirst'] = EMBEDDING_EXPECTED_FIRST
+    stats['expectedMargin'] = EMBEDDING_EXPECTED_MARGIN
+    return stats
+
+
 class YOLOHandler(BaseHTTPRequestHandler):
     def do_GET(self):
+        refresh_shared_catalog()
         if self.path == '/health':
             status = {
                 'status': 'ok',
@@ -369,6 +514,11 @@ class YOLOHandler(BaseHTTPRequestHandler):
                 'embeddingEnabled': USE_EMBEDDING,
                 'embedModelLoaded': embed_model is not None,
                 'catalogLoaded': embed_catalog is not None,
+                'searchMode': EMBEDDING_SEARCH_MODE,
+                'searchStats': search_stats(),
+                'sharedRole': EMBEDDING_SHARED or None,
+                'sharedGeneration': embed_catalog.shared_generation() if embed_catalog else None,
+                'inflight': _inflight['count'],
             }
             self._send_json(200, status)
         elif self.path == '/catalog/stats':
@@ -377,13 +527,40 @@ class YOLOHandler(BaseHTTPRequestHandler):
                 self._send_json(200, stats)
             else:
                 self._send_json(200, {'loaded': False, 'productCount': 0, 'totalEmbeddings': 0})
+        elif self.path == '/catalog/version':
+            if embed_catalog:
+                self._send_json(200, embed_catalog.get_revision())
+            else:
+                self._send_json(500, {'error': 'Catalog not loaded'})
+        elif self.path.startswith('/catalog/delta'):
+            self._handle_catalog_delta()
         else:
             self._send_json(404, {'error': 'Not found'})
 
     def do_POST(self):
+        with _inflight_lock:
+            _inflight['count'] += 1
+        try:
+            self._handle_post()
+        finally:
+            with _inflight_lock:
+                _inflight['count'] -= 1
+
+    def _handle_post(self):
+        refresh_shared_catalog()
         try:
             content_length = int(self.headers.get('Content-Length', 0))
             body = self.rfile.read(content_length) if content_length > 0 else b'{}'
+
+            # Binary body — handled before JSON parsing
+            if self.path == '/catalog/apply-delta':
+                if EMBEDDING_SHARED == 'reader':
+                    self._send_json(409, {'success': False,
+                                          'error': 'Catalog is read-only in reader workers — send writes to the writer'})
+                else:
+                    self._handle_catalog_apply_delta(body)
+                return
+
             data = json.loads(body) if body else {}
 
             if self.path == '/detect':
@@ -394,8 +571,16 @@ class YOLOHandler(BaseHTTPRequestHandler):
                 self._handle_display_embed(data)
             elif self.path == '/embed':
                 self._handle_embed(data)
+            elif self.path in ('/catalog/add', '/catalog/add-batch', '/catalog/build-ann') \
+                    and EMBEDDING_SHARED == 'reader':
+                self._send_json(409, {'success': False,
+                                      'error': 'Catalog is read-only in reader workers — send writes to the writer'})
             elif self.path == '/catalog/add':
                 self._handle_catalog_add(data)
+            elif self.path == '/catalog/add-batch':
+                self._handle_catalog_add_batch(data)
+            elif self.path == '/catalog/build-ann':
+                self._handle_catalog_build_ann(data)
             elif self.path == '/reload':
                 self._handle_reload()
             else:
@@ -478,7 +663,12 @@ class YOLOHandler(BaseHTTPRequestHandler):
             expected_products = data.get('expectedProducts', [])
             confidence = data.get('confidence', 0.3)
             similarity_threshold = data.get('similarityThreshold', 0.6)
-            result = check_display_embed(image_path, expected_products, confidence, similarity_threshold)
+            search_mode = data.get('searchMode')
+            nprobe = data.get('nprobe')
+            expected_first = data.get('expectedFirst')
+            expected_margin = data.get('expectedMargin')
+            result = check_display_embed(image_path, expected_products, confidence, similarity_threshold,
+                                         search_mode, nprobe, expected_first, expected_margin)
             self._send_json(200, result)
         finally:
             self._cleanup_temp(temp_path)
@@ -544,6 +734,7 @@ class YOLOHandler(BaseHTTPRequestHandler):
             ok = embed_catalog.add_embedding(product_id, embedding, name)
             if ok:
                 embed_catalog.save()
+                publish_catalog()
 
         stats = embed_catalog.get_stats()
         self._send_json(200, {
@@ -553,6 +744,158 @@ class YOLOHandler(BaseHTTPRequestHandler):
             'catalogTotalEmbeddings': stats['totalEmbeddings'],
         })
 
+    def _handle_catalog_add_batch(self, data):
+        """
+        Add many reference items in one call.
+        Body: {'items': [{'productId', 'name', 'embedding' | 'imagePath' | 'imageBase64'}], 'batchSize': 32}
+        Images are embedded batchSize at a time; all items are applied with one
+        matrix rebuild and one catalog save. Returns per-item status.
+        """
+        if embed_catalog is None:
+            self._send_json(500, {'success': False, 'error': 'Catalog not loaded'})
+            return
+
+        items = data.get('items')
+        if not isinstance(items, list) or not items:
+            self._send_json(400, {'error': 'items (non-empty list) required'})
+            return
+        batch_size = max(1, int(data.get('batchSize', 32)))
+
+        results = [{'index': i, 'productId': item.get('productId') if isinstance(item, dict) else None}
+                   for i, item in enumerate(items)]
+        embeddings = [None] * len(items)
+        image_items = []
+
+        for i, item in enumerate(items):
+            if not isinstance(item, dict) or not item.get('productId'):
+                results[i]['error'] = 'productId required'
+            elif item.get('embedding'):
+                embeddings[i] = item['embedding']
+            elif item.get('imagePath') or item.get('imageBase64'):
+                image_items.append(i)
+            else:
+                results[i]['error'] = 'embedding or imagePath/imageBase64 required'
+
+        if image_items and embed_model is None:
+            for i in image_items:
+                results[i]['error'] = 'Embedding model not loaded'
+            image_items = []
+
+        # Decode and embed images one batch at a time to bound memory
+        if image_items:
+            from PIL import Image
+        for start in range(0, len(image_items), batch_size):
+            chunk, images = [], []
+            for i in image_items[start:start + batch_size]:
+                image_path, temp_path = self._get_image_path(items[i], 'catalog_batch')
+                try:
+                    if not image_path or not os.path.exists(image_path):
+                        results[i]['error'] = 'Image not found'
+                        continue
+                    with Image.open(image_path) as img:
+                        images.append(img.convert('RGB'))
+                    chunk.append(i)
+                except Exception as e:
+                    results[i]['error'] = f'Failed to read image: {e}'
+                finally:
+                    self._cleanup_temp(temp_path)
+            try:
+                for i, emb in zip(chunk, compute_embeddings_batch(images)):
+                    embeddings[i] = emb
+            except Exception as e:
+                for i in chunk:
+                    results[i]['error'] = f'Failed to compute embedding: {e}'
+
+        pending = [i for i in range(len(items)) if embeddings[i] is not None and 'error' not in results[i]]
+        with _catalog_lock:
+            statuses = embed_catalog.add_embeddings_bulk(
+                [(items[i]['productId'], embeddings[i], items[i].get('name', '')) for i in pending])
+            if any(statuses):
+                embed_catalog.save()
+                publish_catalog()
+
+        for i, ok in zip(pending, statuses):
+            if not ok:
+                results[i]['error'] = 'Invalid embedding'
+        for r in results:
+            r['success'] = 'error' not in r
+
+        added = sum(1 for r in results if r['success'])
+        stats = embed_catalog.get_stats()
+        self._send_json(200, {
+            'success': added > 0,
+            'added': added,
+            'failed': len(results) - added,
+            'results': results,
+            'catalogProductCount': stats['productCount'],
+            'catalogTotalEmbeddings': stats['totalEmbeddings'],
+        })
+
+    def _handle_catalog_build_ann(self, data):
+        """(Re)build IVF index over all stored per-sample embeddings"""
+        if embed_catalog is None:
+            self._send_json(500, {'success': False, 'error': 'Catalog not loaded'})
+            return
+
+        with _catalog_lock:
+            info = embed_catalog.build_ann_index(
+                nlist=data.get('nlist'),
+                nprobe=data.get('nprobe') or EMBEDDING_ANN_NPROBE or 8,
+            )
+            if info:
+                embed_catalog.save()
+                publish_catalog()
+
+        if not info:
+            self._send_json(400, {'success': False, 'error': 'Catalog is empty'})
+            return
+        self._send_json(200, {'success': True, **info})
+
+    def _handle_catalog_delta(self):
+        """Binary delta of catalog changes after ?since=N"""
+        if embed_catalog is None:
+            self._send_json(500, {'error': 'Catalog not loaded'})
+            return
+        query = parse_qs(urlparse(self.path).query)
+        try:
+            since = int(query.get('since', ['0'])[0])
+        except ValueError:
+            self._send_json(400, {'error': 'since must be an integer revision'})
+            return
+
+        with _catalog_lock:
+            delta = embed_catalog.export_delta(since)
+            version = embed_catalog.get_revision()
+        if delta is None:
+            self._send_json(410, {'error': f'Change log does not reach back to revision {since} — full sync required',
+                                  **version})
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(delta)))
+        self.send_header('X-Catalog-Revision', str(version['revision']))
+        self.end_headers()
+        self.wfile.write(delta)
+
+    def _handle_catalog_apply_delta(self, body):
+        """Apply a binary delta from another node, then save and publish"""
+        if embed_catalog is None:
+            self._send_json(500, {'success': False, 'error': 'Catalog not loaded'})
+            return
+
+        with _catalog_lock:
+            try:
+                result = embed_catalog.import_delta(body)
+            except ValueError as e:
+                self._send_json(409, {'success': False, 'error': str(e), **embed_catalog.get_revision()})
+                return
+            if result['applied']:
+                embed_catalog.save()
+                publish_catalog()
+
+        self._send_json(200, {'success': True, **result})
+
     def _handle_reload(self):
         """Reload model from disk (hot-reload after training)"""
         print("[YOLO Server] Reload requested...")
@@ -585,7 +928,9 @@ if __name__ == '__main__':
 
     print("[YOLO Server] Starting...")
     print(f"[YOLO Server] Model path: {DEFAULT_MODEL}")
-    print(f"[YOLO Server] Embedding mode: {USE_EMBEDDING}")
+    print(f"[YOLO Server] Embedding mode: {USE_EMBEDDING} (search: {EMBEDDING_SEARCH_MODE})")
+    if EMBEDDING_SHARED:
+        print(f"[YOLO Server] Shared catalog role: {EMBEDDING_SHARED}")
 
     load_class_mapping()
 
@@ -612,7 +957,8 @@ if __name__ == '__main__':
     print(f"[YOLO Server] Listening on http://127.0.0.1:{port}")
     endpoints = "POST /detect, POST /display, GET /health"
     if USE_EMBEDDING:
-        endpoints += ", POST /display-embed, POST /embed, POST /catalog/add, GET /catalog/stats"
+        endpoints += ", POST /display-embed, POST /embed, POST /catalog/add, POST /catalog/add-batch, POST /catalog/build-ann, GET /catalog/stats"
+        endpoints += ", GET /catalog/version, GET /catalog/delta, POST /catalog/apply-delta"
     print(f"[YOLO Server] Endpoints: {endpoints}")
     try:
         server.serve_forever()
@@ -160,6 +160,7 @@ async function readCounterNumber(imageBase64, region, preset, expectedRange) {
             error: null,
             method: `easyocr_${easyResult.bestVariant || 'default'}`,
             inExpectedRange,
+            variantsRun: easyResult.variantsRun || [],
           };
         }
       } catch (easyErr) {
@@ -15,7 +15,11 @@ import sys
 import json
 import gc
 import re
+import hashlib
 import math
+import time
+import atexit
+import signal
 import traceback
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from socketserver import ThreadingMixIn
@@ -31,9 +35,37 @@ import numpy as np
 print("[OCR Server] Starting...")
 print("[OCR Server] Loading EasyOCR model (this may take 20-30 seconds)...")
 import easyocr
+from easyocr.config import imgH as RECOGNIZER_HEIGHT
+from easyocr.recognition import get_text
+from easyocr.utils import get_image_list
 reader = easyocr.Reader(['ru', 'en'], gpu=False, verbose=False)
 print("[OCR Server] Model loaded successfully!")
 
+# POST requests being handled right now (reported in /health for the training job runner)
+inflight = {"count": 0}
+inflight_lock = threading.Lock()
+
+# Cascade mode for /ocr: stop reading variants once the best candidate is confident
+# (request field "cascade" overrides OCR_CASCADE)
+CASCADE_DEFAULT = os.environ.get("OCR_CASCADE", "0") == "1"
+CASCADE_MIN_SCORE = float(os.environ.get("OCR_CASCADE_MIN_SCORE", "10"))
+CASCADE_MARGIN = float(os.environ.get("OCR_CASCADE_MARGIN", "5"))
+# Per preset and variant: how often the variant produced the winning number
+VARIANT_STATS_FILE = os.environ.get(
+    "OCR_VARIANT_STATS_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "ocr-variant-stats.json"))
+variant_stats_lock = threading.Lock()
+# Requests only update the stats in memory; a background thread writes them out this often
+VARIANT_STATS_FLUSH_SECONDS = float(os.environ.get("OCR_VARIANT_STATS_FLUSH_SECONDS", "30"))
+# EasyOCR passes per /ocr request (reported in /health)
+pass_stats = {"requests": 0, "passes": 0}
+# Run the text detector once per /ocr request and reuse its regions for the other variants
+SHARED_DETECTION = os.environ.get("OCR_SHARED_DETECTION", "1") == "1"
+# Recognition of all variants / concurrent requests in padded batches (RecognitionBatcher)
+BATCHING = os.environ.get("OCR_BATCHING", "1") == "1"
+BATCH_SIZE = int(os.environ.get("OCR_BATCH_SIZE", "16"))
+BATCH_WINDOW_MS = float(os.environ.get("OCR_BATCH_WINDOW_MS", "10"))
+
 # Keywords that indicate the counter reading line
 COUNTER_KEYWORDS = {
     # BW3/BW4 (English/transliterated)
@@ -99,6 +131,166 @@ def preprocess_image(img, preset="standard"):
     return variants
 
 
+def detect_regions(vimg):
+    """CRAFT text regions of a BGR variant: (horizontal_list, free_list) in its pixel coordinates"""
+    horizontal_list, free_list = reader.detect(cv2.cvtColor(vimg, cv2.COLOR_BGR2RGB))
+    return horizontal_list[0], free_list[0]
+
+
+def detection_variant(variants):
+    """
+    Variant the shared text detection runs on: the highest-resolution one
+    (first in preset order on ties). Its regions are scaled down onto the
+    smaller variants, which keeps small text that an 800px detection pass
+    would miss.
+    """
+    return max(variants, key=lambda v: v[1].shape[0] * v[1].shape[1])
+
+
+def scale_regions(regions, from_shape, to_shape):
+    """Map text regions detected on one variant to another variant of the same image"""
+    if tuple(from_shape[:2]) == tuple(to_shape[:2]):
+        return regions
+    horizontal_list, free_list = regions
+    sy = to_shape[0] / from_shape[0]
+    sx = to_shape[1] / from_shape[1]
+    horizontal = [[int(round(x_min * sx)), int(round(x_max * sx)), int(round(y_min * sy)), int(round(y_max * sy))]
+                  for x_min, x_max, y_min, y_max in horizontal_list]
+    free = [[[int(round(x * sx)), int(round(y * sy))] for x, y in box] for box in free_list]
+    return horizontal, free
+
+
+class RecognitionBatcher:
+    """
+    Runs the EasyOCR recognizer for all request threads in padded batches.
+
+    Callers submit text-line crops (all variants of a request at once); the
+    batcher thread takes every submission queued within a short window
+    (only while other requests are in flight, so a lone request does not
+    wait), groups the crops by padded width — the max_width get_image_list()
+    returns for the crop alone, exactly what reader.recognize() pads it to
+    on CPU — and calls get_text() batch_size crops at a time. Results are
+    routed back to each caller in crop order.
+    """
+
+    def __init__(self, batch_size, window_ms):
+        self.batch_size = batch_size
+        self.window = window_ms / 1000.0
+        self.cond = threading.Condition()
+        self.queue = []
+        self.ignore_char = ''.join(set(reader.character) - set(reader.lang_char))
+        self.stats = {"submissions": 0, "batches": 0, "crops": 0}
+        self.stats_lock = threading.Lock()
+        threading.Thread(target=self._loop, name="ocr-batcher", daemon=True).start()
+
+    def recognize(self, items):
+        """
+        Args:
+            items: list of (grayscale image, (horizontal_list, free_list))
+
+        Returns:
+            list of results per item: [(box, text, confidence), ...]
+        """
+        crops, widths, owners = [], [], []
+        for i, (grey, (horizontal_list, free_list)) in enumerate(items):
+            # Same crops, order and padded widths as reader.recognize() on CPU:
+            # one box at a time, horizontal boxes first, then free-form ones
+            boxes = [([box], []) for box in horizontal_list] + [([], [box]) for box in free_list]
+            for h_list, f_list in boxes:
+                image_list, max_width = get_image_list(h_list, f_list, grey, model_height=RECOGNIZER_HEIGHT,
+                                                       sort_output=False)
+                crops.extend(image_list)
+                widths.extend([int(max_width)] * len(image_list))
+                owners.extend([i] * len(image_list))
+        out = [[] for _ in items]
+        if not crops:
+            return out
+
+        job = {"crops": crops, "widths": widths, "results": [None] * len(crops), "error": None,
+               "done": threading.Event()}
+        with self.cond:
+            self.queue.append(job)
+            self.cond.notify()
+        job["done"].wait()
+        if job["error"] is not None:
+            raise job["error"]
+        for owner, result in zip(owners, job["results"]):
+            out[owner].append(result)
+        return out
+
+    def _loop(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                # Other requests in flight: let their crops join the batch for a moment
+                deadline = time.monotonic() + self.window
+                while inflight["count"] > 1 and sum(len(j["crops"]) for j in self.queue) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                jobs, self.queue = self.queue, []
+            try:
+                self._run(jobs)
+            except Exception as e:
+                for job in jobs:
+                    job["error"] = e
+            for job in jobs:
+                job["done"].set()
+
+    def _run(self, jobs):
+        buckets = {}  # padded width -> [(job index, crop index)]
+        for j, job in enumerate(jobs):
+            for c, width in enumerate(job["widths"]):
+                buckets.setdefault(width, []).append((j, c))
+
+        batches = 0
+        for width, members in buckets.items():
+            for start in range(0, len(members), self.batch_size):
+                chunk = members[start:start + self.batch_size]
+                image_list = [jobs[j]["crops"][c] for j, c in chunk]
+                results = get_text(reader.character, RECOGNIZER_HEIGHT, width, reader.recognizer,
+                                   reader.converter, image_list, self.ignore_char, 'greedy', 5, len(chunk),
+                                   0.1, 0.5, 0.003, 0, reader.device)
+                for (j, c), result in zip(chunk, results):
+                    jobs[j]["results"][c] = result
+                batches += 1
+
+        with self.stats_lock:
+            self.stats["submissions"] += len(jobs)
+            self.stats["batches"] += batches
+            self.stats["crops"] += sum(len(job["crops"]) for job in jobs)
+
+    def stats_snapshot(self):
+        with self.stats_lock:
+            return dict(self.stats)
+
+
+batcher = RecognitionBatcher(BATCH_SIZE, BATCH_WINDOW_MS) if BATCHING else None
+
+
+def recognize_regions(items):
+    """Recognizer only, for a list of (BGR variant, regions); results per item"""
+    greys = [(cv2.cvtColor(vimg, cv2.COLOR_BGR2GRAY), regions) for vimg, regions in items]
+    if batcher is not None:
+        return batcher.recognize(greys)
+    return [reader.recognize(grey, regions[0], regions[1]) for grey, regions in greys]
+
+
+def read_variant(vimg, regions=None):
+    """
+    EasyOCR on an in-memory BGR variant (no temp file, no JPEG re-encode).
+    Feeds the detector and the recognizer the same inputs readtext() derives
+    from an image file: RGB for detection, grayscale for recognition.
+    With regions (see detect_regions) the detector is skipped and only the
+    recognizer runs on those regions.
+    """
+    if regions is None:
+        regions = detect_regions(vimg)
+    return recognize_regions([(vimg, regions)])[0]
+
+
 def bbox_center(bbox):
     """Get center of bounding box [[x1,y1],[x2,y2],[x3,y3],[x4,y4]]"""
     xs = [p[0] for p in bbox]
@@ -182,12 +374,204 @@ def is_date_pattern(val):
     return False
 
 
-def recognize(image_path, preset="standard", expected_range=None):
-    """Main recognition function"""
+def composite_score(val, info, expected_range=None):
+    """Score of one candidate number (higher = more likely the counter reading)"""
+    conf = info["confidence"]
+    digits = len(str(val))
+    count = info["count"]
+    kw_boost = info["keyword_boost"]
+
+    # Base score from confidence
+    score = conf
+
+    # Digit bonus (counter readings are 4-6 digits)
+    if digits >= 6:
+        score *= 3.0
+    elif digits >= 5:
+        score *= 2.5
+    elif digits >= 4:
+        score *= 2.0
+    elif digits >= 3:
+        score *= 1.0
+    else:
+        score *= 0.3
+
+    # Multi-variant consensus bonus
+    if count >= 3:
+        score *= 1.5
+    elif count >= 2:
+        score *= 1.2
+
+    # Keyword proximity bonus (most important signal!)
+    if kw_boost > 0:
+        score += kw_boost * 2.0
+
+    # Expected range bonus (from machine intelligence)
+    if expected_range:
+        range_min = expected_range.get("min", 0)
+        range_max = expected_range.get("max", float("inf"))
+        if range_min <= val <= range_max:
+            score *= 1.5
+
+    return score
+
+
+def load_variant_stats():
+    try:
+        with open(VARIANT_STATS_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+variant_stats = load_variant_stats()
+variant_stats_dirty = {"flag": False}
+variant_stats_flush_lock = threading.Lock()  # one writer of VARIANT_STATS_FILE at a time
+
+
+def record_variant_outcome(preset, variants_read, best_variant):
+    """Count a run for every variant that produced results and a win for the best one (in memory)"""
+    with variant_stats_lock:
+        per_preset = variant_stats.setdefault(preset, {})
+        for vname in variants_read:
+            entry = per_preset.setdefault(vname, {"runs": 0, "wins": 0})
+            entry["runs"] += 1
+            if vname == best_variant:
+                entry["wins"] += 1
+        variant_stats_dirty["flag"] = True
+
+
+def flush_variant_stats():
+    """Write the variant stats if they changed since the last flush; the file is written outside the stats lock"""
+    with variant_stats_flush_lock:
+        with variant_stats_lock:
+            if not variant_stats_dirty["flag"]:
+                return
+            data = json.dumps(variant_stats, indent=2)
+            variant_stats_dirty["flag"] = False
+        try:
+            os.makedirs(os.path.dirname(VARIANT_STATS_FILE), exist_ok=True)
+            tmp = f"{VARIANT_STATS_FILE}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(data)
+            os.replace(tmp, VARIANT_STATS_FILE)
+        except OSError as e:
+            print(f"[OCR Server] Cannot save variant stats: {e}")
+            with variant_stats_lock:
+                variant_stats_dirty["flag"] = True
+
+
+def _flush_variant_stats_loop():
+    while True:
+        time.sleep(VARIANT_STATS_FLUSH_SECONDS)
+        flush_variant_stats()
+
+
+threading.Thread(target=_flush_variant_stats_loop, name="ocr-stats-flush", daemon=True).start()
+atexit.register(flush_variant_stats)
+
+
+def order_variants(preset, variants):
+    """Variants by historical success rate for the preset (Laplace-smoothed), ties keep preset order"""
+    with variant_stats_lock:
+        per_preset = dict(variant_stats.get(preset, {}))
+
+    def rate(item):
+        entry = per_preset.get(item[0], {"runs": 0, "wins": 0})
+        return (entry["wins"] + 1) / (entry["runs"] + 2)
+
+    return sorted(variants, key=rate, reverse=True)
+
+
+def is_confident(all_numbers, expected_range):
+    """Cascade stop rule: best score above the minimum and ahead of the runner-up by the margin"""
+    scores = sorted((composite_score(val, info, expected_range) for val, info in all_numbers.items()),
+                    reverse=True)
+    if not scores or scores[0] < CASCADE_MIN_SCORE:
+        return False
+    return len(scores) == 1 or scores[0] - scores[1] >= CASCADE_MARGIN
+
+
+def read_variants(chunk, state):
+    """
+    Read several (name, BGR variant) of one image with a single recognizer
+    submission.
+
+    state is kept across calls for one request: seen — results by pixel
+    hash, so a byte-identical variant reuses earlier results; detect_on —
+    (name, BGR variant) the shared detection runs on (see
+    detection_variant); shared — its regions and shape once detected;
+    detection, run, skipped — reported in the response.
+
+    Returns:
+        {variant name: results}
+    """
+    jobs = []  # (name, variant, pixel key, regions)
+    duplicates = []
+    keys = set()
+    for vname, vimg in chunk:
+        key = (vimg.shape, hashlib.sha1(vimg.tobytes()).hexdigest())
+        if key in state["seen"] or key in keys:
+            duplicates.append((vname, key))
+            continue
+        keys.add(key)
+        if not SHARED_DETECTION:
+            regions = detect_regions(vimg)
+        else:
+            if state["shared"] is None:
+                det_name, det_img = state["detect_on"]
+                state["shared"] = (detect_regions(det_img), det_img.shape)
+                state["detection"]["variant"] = det_name
+            regions = scale_regions(state["shared"][0], state["shared"][1], vimg.shape)
+        jobs.append((vname, vimg, key, regions))
+
+    results_list = recognize_regions([(vimg, regions) for _, vimg, _, regions in jobs])
+
+    # Shared regions gave no text: detect on the variant itself
+    fallback = [i for i, (vname, _, _, _) in enumerate(jobs)
+                if SHARED_DETECTION and vname != state["detection"]["variant"]
+                and not any(text.strip() for _, text, _ in results_list[i])]
+    if fallback:
+        retried = recognize_regions([(jobs[i][1], detect_regions(jobs[i][1])) for i in fallback])
+        for i, results in zip(fallback, retried):
+            results_list[i] = results
+            state["detection"]["fallbacks"].append(jobs[i][0])
+
+    out = {}
+    for (vname, _, key, _), results in zip(jobs, results_list):
+        state["seen"][key] = (vname, results)
+        state["run"].append(vname)
+        out[vname] = results
+    for vname, key in duplicates:
+        source, results = state["seen"][key]
+        state["skipped"].append({"variant": vname, "reason": f"identical to {source}"})
+        out[vname] = results
+    return out
+
+
+def recognize(image_path, preset="standard", expected_range=None, cascade=None):
+    """
+    Main recognition function
+
+    Variants byte-identical to an earlier one (small images: original ==
+    hires) are not read again; the earlier results are reused, so scoring is
+    the same as reading them. With SHARED_DETECTION the text detector runs
+    once, on the highest-resolution variant (see detection_variant); the
+    other variants (same image, other scale / contrast) get its regions
+    scaled down and run only the recognizer, falling back to their own
+    detection if the shared regions yield no text.
+    All variants go to the recognizer in one submission (batched with other
+    requests, see RecognitionBatcher). In cascade mode variants are read one
+    at a time in order of their historical success rate for the preset and
+    reading stops as soon as the best candidate is confident (see
+    is_confident).
+    """
     img = cv2.imread(image_path)
     if img is None:
         return {"error": f"Cannot read image: {image_path}", "success": False}
 
+    cascade = CASCADE_DEFAULT if cascade is None else bool(cascade)
+
     # Only use keyword detection for standard/standard_resize presets
     # For invert_lcd (WMF), EasyOCR reads text too poorly for keyword matching
     use_keywords = preset != "invert_lcd"
@@ -195,17 +579,37 @@ def recognize(image_path, preset="standard", expected_range=None):
     variants = preprocess_image(img, preset)
     del img
     gc.collect()
+    detect_on = detection_variant(variants)
+    if cascade:
+        variants = order_variants(preset, variants)
 
     all_numbers = {}  # value -> {"confidence": float, "variant": str, "count": int, "keyword_boost": float}
     raw_texts = []
+    state = {
+        "seen": {},  # (shape, sha1 of pixels) -> (variant name, results)
+        "detect_on": detect_on,
+        "shared": None,  # (regions, shape) of the variant detection ran on
+        "detection": {"variant": None, "fallbacks": []} if SHARED_DETECTION else None,
+        "run": [],
+        "skipped": [],
+    }
+    variants_read = []
 
-    for vname, vimg in variants:
-        tmp_path = f"/tmp/counter-ocr/easy_{os.getpid()}_{threading.get_ident()}_{vname}.jpg"
+    # Cascade: one variant per step (stop rule in between); otherwise all variants in one step
+    step = 1 if cascade else max(1, len(variants))
+    for pos in range(0, len(variants), step):
+        chunk = variants[pos:pos + step]
         try:
-            cv2.imwrite(tmp_path, vimg)
-            del vimg
+            chunk_results = read_variants(chunk, state)
+        except Exception as e:
+            chunk_results = {}
+            raw_texts.extend({"variant": vname, "error": str(e)} for vname, _ in chunk)
 
-            results = reader.readtext(tmp_path)
+        for vname, _ in chunk:
+            if vname not in chunk_results:
+                continue
+            results = chunk_results[vname]
+            variants_read.append(vname)
 
             # Extract keyword-boosted numbers (only for readable presets)
             kw_boosted = find_keyword_numbers(results) if use_keywords else {}
@@ -236,61 +640,17 @@ def recognize(image_path, preset="standard", expected_range=None):
 
             texts = [r[1] for r in results if r[2] > 0.2]
             raw_texts.append({"variant": vname, "texts": texts[:10]})
-
-            del results
-        except Exception as e:
-            raw_texts.append({"variant": vname, "error": str(e)})
-        finally:
-            try:
-                os.unlink(tmp_path)
-            except:
-                pass
+        del chunk, chunk_results
         gc.collect()
 
-    # Score each number
-    def composite_score(val, info):
-        conf = info["confidence"]
-        digits = len(str(val))
-        count = info["count"]
-        kw_boost = info["keyword_boost"]
-
-        # Base score from confidence
-        score = conf
-
-        # Digit bonus (counter readings are 4-6 digits)
-        if digits >= 6:
-            score *= 3.0
-        elif digits >= 5:
-            score *= 2.5
-        elif digits >= 4:
-            score *= 2.0
-        elif digits >= 3:
-            score *= 1.0
-        else:
-            score *= 0.3
-
-        # Multi-variant consensus bonus
-        if count >= 3:
-            score *= 1.5
-        elif count >= 2:
-            score *= 1.2
-
-        # Keyword proximity bonus (most important signal!)
-        if kw_boost > 0:
-            score += kw_boost * 2.0
-
-        # Expected range bonus (from machine intelligence)
-        if expected_range:
-            range_min = expected_range.get("min", 0)
-            range_max = expected_range.get("max", float("inf"))
-            if range_min <= val <= range_max:
-                score *= 1.5
-
-        return score
+        if cascade and pos + step < len(variants) and is_confident(all_numbers, expected_range):
+            state["skipped"].extend({"variant": name, "reason": "early exit"} for name, _ in variants[pos + step:])
+            break
+    del state["seen"], state["detect_on"], variants, detect_on
 
     sorted_nums = sorted(
         all_numbers.items(),
-        key=lambda x: -composite_score(x[0], x[1])
+        key=lambda x: -composite_score(x[0], x[1], expected_range)
     )
 
     numbers_list = [
@@ -298,7 +658,7 @@ def recognize(image_path, preset="standard", expected_range=None):
             "value": val,
             "confidence": round(info["confidence"], 3),
             "variant": info["variant"],
-            "score": round(composite_score(val, info), 3),
+            "score": round(composite_score(val, info, expected_range), 3),
             "keyword_boost": round(info["keyword_boost"], 2),
             "count": info["count"],
         }
@@ -306,6 +666,11 @@ def recognize(image_path, preset="standard", expected_range=None):
     ]
 
     best = sorted_nums[0] if sorted_nums else None
+    if best:
+        record_variant_outcome(preset, variants_read, best[1]["variant"])
+    with variant_stats_lock:
+        pass_stats["requests"] += 1
+        pass_stats["passes"] += len(state["run"])
 
     return {
         "success": True,
@@ -314,6 +679,10 @@ def recognize(image_path, preset="standard", expected_range=None):
         "bestConfidence": best[1]["confidence"] if best else 0,
         "bestVariant": best[1]["variant"] if best else None,
         "rawTexts": raw_texts,
+        "cascade": cascade,
+        "variantsRun": state["run"],
+        "variantsSkipped": state["skipped"],
+        "detection": state["detection"],
     }
 
 
@@ -371,13 +740,10 @@ def recognize_text(image_path):
     all_variant_results = []
 
     for vname, vimg in variants:
-        tmp_path = f"/tmp/counter-ocr/zr_{os.getpid()}_{threading.get_ident()}_{vname}.jpg"
         try:
-            cv2.imwrite(tmp_path, vimg)
+            results = read_variant(vimg)
             del vimg
 
-            results = reader.readtext(tmp_path)
-
             if not results:
                 all_variant_results.append({"variant": vname, "text": "", "lines": 0})
                 continue
@@ -431,11 +797,6 @@ def recognize_text(image_path):
 
         except Exception as e:
             all_variant_results.append({"variant": vname, "error": str(e)})
-        finally:
-            try:
-                os.unlink(tmp_path)
-            except:
-                pass
         gc.collect()
 
     return {
@@ -447,18 +808,208 @@ def recognize_text(image_path):
     }
 
 
+def _variant_numbers(results):
+    nums = set()
+    for _, text, _ in results:
+        for n in re.findall(r'\d[\d\s,.]*\d|\d+', text):
+            clean = re.sub(r'[\s,.]', '', n)
+            if clean.isdigit() and int(clean) > 100:
+                nums.add(int(clean))
+    return nums
+
+
+def benchmark_variants(fixture_dir, preset="standard"):
+    """
+    Per-variant time and recognition parity: in-memory read_variant() vs the
+    old temp-JPEG round trip (imwrite + readtext(path) + unlink). For the
+    counter presets also shared detection (read_variants, as recognize()
+    runs it) vs each variant's own detection.
+
+    Args:
+        fixture_dir: directory of fixture photos (.jpg/.jpeg/.png)
+        preset: recognize() preset, or "zreport" for the Z-report variants
+
+    Returns:
+        dict: per variant — count, mean ms for both paths, share of runs with
+        identical texts / identical extracted numbers (and with shared
+        detection); sharedDetection — detection variant per image and mean
+        ms of all variants with per-variant vs shared detection
+    """
+    import tempfile
+
+    images = sorted(f for f in os.listdir(fixture_dir) if f.lower().endswith(('.jpg', '.jpeg', '.png')))
+    stats = {}
+    shared = {"images": 0, "perVariantMs": 0.0, "sharedMs": 0.0, "fallbacks": 0, "detectedOn": {}}
+    with tempfile.TemporaryDirectory(prefix="ocr-bench-") as tmp_dir:
+        for name in images:
+            img = cv2.imread(os.path.join(fixture_dir, name))
+            if img is None:
+                print(f"[OCR Bench] Cannot read {name}")
+                continue
+            variants = preprocess_zreport(img) if preset == "zreport" else preprocess_image(img, preset)
+            own = {}
+            own_ms = 0.0
+            for vname, vimg in variants:
+                tmp_path = os.path.join(tmp_dir, f"{vname}.jpg")
+                t0 = time.perf_counter()
+                cv2.imwrite(tmp_path, vimg)
+                via_file = reader.readtext(tmp_path)
+                os.unlink(tmp_path)
+                t1 = time.perf_counter()
+                in_memory = read_variant(vimg)
+                t2 = time.perf_counter()
+
+                entry = stats.setdefault(vname, {"count": 0, "fileMs": 0.0, "memoryMs": 0.0,
+                                                 "sameTexts": 0, "sameNumbers": 0})
+                entry["count"] += 1
+                entry["fileMs"] += (t1 - t0) * 1000
+                entry["memoryMs"] += (t2 - t1) * 1000
+                entry["sameTexts"] += [r[1] for r in via_file] == [r[1] for r in in_memory]
+                entry["sameNumbers"] += _variant_numbers(via_file) == _variant_numbers(in_memory)
+                own[vname] = in_memory
+                own_ms += (t2 - t1) * 1000
+
+            if preset == "zreport":
+                continue
+            state = {"seen": {}, "detect_on": detection_variant(variants), "shared": None,
+                     "detection": {"variant": None, "fallbacks": []}, "run": [], "skipped": []}
+            t0 = time.perf_counter()
+            via_shared = read_variants(variants, state)
+            shared["sharedMs"] += (time.perf_counter() - t0) * 1000
+            shared["perVariantMs"] += own_ms
+            shared["images"] += 1
+            shared["fallbacks"] += len(state["detection"]["fallbacks"])
+            det_name = state["detection"]["variant"]
+            shared["detectedOn"][det_name] = shared["detectedOn"].get(det_name, 0) + 1
+            for vname, results in via_shared.items():
+                entry = stats[vname]
+                entry["sharedTexts"] = entry.get("sharedTexts", 0) + \
+                    ([r[1] for r in results] == [r[1] for r in own[vname]])
+                entry["sharedNumbers"] = entry.get("sharedNumbers", 0) + \
+                    (_variant_numbers(results) == _variant_numbers(own[vname]))
+
+    report = {"preset": preset, "images": len(images), "variants": {}}
+    for vname, entry in stats.items():
+        n = entry["count"]
+        report["variants"][vname] = {
+            "count": n,
+            "fileMs": round(entry["fileMs"] / n, 1),
+            "memoryMs": round(entry["memoryMs"] / n, 1),
+            "textParity": round(entry["sameTexts"] / n, 3),
+            "numberParity": round(entry["sameNumbers"] / n, 3),
+        }
+        if "sharedTexts" in entry:
+            report["variants"][vname]["sharedTextParity"] = round(entry["sharedTexts"] / n, 3)
+            report["variants"][vname]["sharedNumberParity"] = round(entry["sharedNumbers"] / n, 3)
+    if shared["images"]:
+        n = shared["images"]
+        report["sharedDetection"] = {
+            "enabled": SHARED_DETECTION,
+            "detectedOn": shared["detectedOn"],
+            "fallbacks": shared["fallbacks"],
+            "perVariantMs": round(shared["perVariantMs"] / n, 1),
+            "sharedMs": round(shared["sharedMs"] / n, 1),
+        }
+    return report
+
+
+def benchmark_load(fixture_dir, preset="standard", levels=(1, 4, 8), rounds=3):
+    """
+    /ocr throughput under concurrent load: `level` threads each run
+    recognize() on every fixture photo `rounds` times, counted as in-flight
+    requests like the HTTP handler does, with and without the recognition
+    batcher. Level 1 is the single-request latency.
+
+    Returns:
+        dict: per mode and level — photos, wall seconds, photos/s, mean and
+        p50/p95 request latency in ms, recognizer batches
+    """
+    global batcher
+
+    images = [os.path.join(fixture_dir, f) for f in sorted(os.listdir(fixture_dir))
+              if f.lower().endswith(('.jpg', '.jpeg', '.png'))]
+    report = {"preset": preset, "images": len(images), "modes": {}}
+    if not images:
+        return report
+
+    def run_one(path, latencies):
+        with inflight_lock:
+            inflight["count"] += 1
+        try:
+            t0 = time.perf_counter()
+            recognize(path, preset)
+            latencies.append(time.perf_counter() - t0)
+        finally:
+            with inflight_lock:
+                inflight["count"] -= 1
+
+    shared_batcher = batcher
+    modes = [("batched", shared_batcher), ("unbatched", None)] if shared_batcher else [("unbatched", None)]
+    try:
+        for mode, mode_batcher in modes:
+            batcher = mode_batcher
+            recognize(images[0], preset)  # warm-up
+            for level in levels:
+                latencies = []
+                batches_before = batcher.stats_snapshot()["batches"] if batcher else 0
+
+                def worker():
+                    for _ in range(rounds):
+                        for path in images:
+                            run_one(path, latencies)
+
+                threads = [threading.Thread(target=worker) for _ in range(level)]
+                t0 = time.perf_counter()
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+                wall = time.perf_counter() - t0
+
+                ms = sorted(x * 1000 for x in latencies)
+                report["modes"].setdefault(mode, {})[str(level)] = {
+                    "photos": len(ms),
+                    "seconds": round(wall, 2),
+                    "photosPerSec": round(len(ms) / wall, 2),
+                    "meanMs": round(sum(ms) / len(ms), 1),
+                    "p50Ms": round(ms[len(ms) // 2], 1),
+                    "p95Ms": round(ms[min(len(ms) - 1, int(len(ms) * 0.95))], 1),
+                    "batches": (batcher.stats_snapshot()["batches"] - batches_before) if batcher else None,
+                }
+                print(f"[OCR Bench] {mode} x{level}: {report['modes'][mode][str(level)]}")
+    finally:
+        batcher = shared_batcher
+    return report
+
+
 class OCRHandler(BaseHTTPRequestHandler):
     def do_GET(self):
         if self.path == "/health":
             self.send_response(200)
             self.send_header("Content-Type", "application/json")
             self.end_headers()
-            self.wfile.write(json.dumps({"status": "ok", "engine": "easyocr", "languages": ["ru", "en"]}).encode())
+            with variant_stats_lock:
+                requests, passes = pass_stats["requests"], pass_stats["passes"]
+            self.wfile.write(json.dumps({"status": "ok", "engine": "easyocr", "languages": ["ru", "en"],
+                                         "inflight": inflight["count"],
+                                         "cascade": CASCADE_DEFAULT,
+                                         "ocrRequests": requests,
+                                         "avgPasses": round(passes / requests, 2) if requests else None,
+                                         "batching": batcher.stats_snapshot() if batcher else None}).encode())
         else:
             self.send_response(404)
             self.end_headers()
 
     def do_POST(self):
+        with inflight_lock:
+            inflight["count"] += 1
+        try:
+            self.handle_post()
+        finally:
+            with inflight_lock:
+                inflight["count"] -= 1
+
+    def handle_post(self):
         if self.path == "/ocr":
             try:
                 content_length = int(self.headers.get("Content-Length", 0))
@@ -468,6 +1019,7 @@ class OCRHandler(BaseHTTPRequestHandler):
                 image_path = data.get("imagePath")
                 preset = data.get("preset", "standard")
                 expected_range = data.get("expectedRange")  # {"min": N, "max": N} from intelligence
+                cascade = data.get("cascade")  # None = OCR_CASCADE default
 
                 if not image_path or not os.path.exists(image_path):
                     self.send_response(400)
@@ -476,7 +1028,7 @@ class OCRHandler(BaseHTTPRequestHandler):
                     self.wfile.write(json.dumps({"error": "imagePath required and must exist"}).encode())
                     return
 
-                result = recognize(image_path, preset, expected_range)
+                result = recognize(image_path, preset, expected_range, cascade)
 
                 self.send_response(200)
                 self.send_header("Content-Type", "application/json")
@@ -522,12 +1074,27 @@ class OCRHandler(BaseHTTPRequestHandler):
 
 
 if __name__ == "__main__":
+    # python3 ocr_server.py --bench <fixture dir> [preset|zreport]
+    # python3 ocr_server.py --bench-load <fixture dir> [preset] [levels, e.g. 1,4,8]
+    if len(sys.argv) > 2 and sys.argv[1] == "--bench-load":
+        levels = tuple(int(n) for n in sys.argv[4].split(",")) if len(sys.argv) > 4 else (1, 4, 8)
+        print(json.dumps(benchmark_load(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else "standard", levels),
+                         indent=2))
+        sys.exit(0)
+    if len(sys.argv) > 2 and sys.argv[1] == "--bench":
+        print(json.dumps(benchmark_variants(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else "standard"),
+                         indent=2))
+        sys.exit(0)
+
     port = int(sys.argv[1]) if len(sys.argv) > 1 else 5001
+    # SIGTERM (process manager stop) exits like Ctrl+C, so the variant stats get flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     server = ThreadingHTTPServer(("127.0.0.1", port), OCRHandler)
     print(f"[OCR Server] Listening on http://127.0.0.1:{port}")
     print(f"[OCR Server] Endpoints: POST /ocr, POST /ocr-text, GET /health")
     try:
         server.serve_forever()
-    except KeyboardInterrupt:
+    except (KeyboardInterrupt, SystemExit):
         print("\n[OCR Server] Shutting down...")
         server.server_close()
+        flush_variant_stats()
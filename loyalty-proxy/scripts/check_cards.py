@@ -1,12 +1,12 @@
 """Проверка: все ли counting фото привязаны к карточкам в каталоге, совпадают ли имена."""
-import json
+import json, os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ml'))
+import training_manifest
 
 with open('/tmp/products.json') as f:
     products = json.load(f).get('products', [])
 
-samples_path = '/root/arabica_app/loyalty-proxy/data/counting-training/samples.json'
-with open(samples_path) as f:
-    samples = json.load(f).get('samples', [])
+samples = training_manifest.samples('counting-training')
 
 # Build catalog lookup
 catalog_barcodes = set()
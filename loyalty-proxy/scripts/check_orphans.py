@@ -1,5 +1,7 @@
 """Check orphan counting barcodes against FULL catalog."""
-import json
+import json, os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ml'))
+import training_manifest
 
 with open('/tmp/products.json') as f:
     prods = json.load(f).get('products', [])
@@ -16,9 +18,8 @@ for p in prods:
 
 print(f'Unique catalog barcodes: {len(all_bc)}')
 
-# Load counting samples
-with open('/root/arabica_app/loyalty-proxy/data/counting-training/samples.json') as f:
-    samples = json.load(f).get('samples', [])
+# Load counting samples (training manifest)
+samples = training_manifest.samples('counting-training')
 
 # Unique barcodes in counting
 counting_bcs = set()
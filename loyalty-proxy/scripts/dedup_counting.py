@@ -1,9 +1,11 @@
 """Удаляет дубли из counting-training (одинаковые фото для одного productId).
 Оставляет копию с employeeAnswer, удаляет остальные.
 """
-import json, hashlib, os
+import json, os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ml'))
+import training_manifest
 
-base_dir = '/root/arabica_app/loyalty-proxy/data/counting-training'
+base_dir = str(training_manifest.DATA_DIR / 'counting-training')
 samples_file = os.path.join(base_dir, 'samples.json')
 images_dir = os.path.join(base_dir, 'images')
 labels_dir = os.path.join(base_dir, 'labels')
@@ -14,15 +16,14 @@ with open(samples_file) as f:
 samples = data.get('samples', [])
 print(f'Total samples before: {len(samples)}')
 
-# Group by (barcode, md5)
+# Хеши содержимого из манифеста (пересчитываются только новые/изменённые фото)
+hashes = {m.get('imageFileName'): m['_sha1'] for m in training_manifest.samples('counting-training')}
+
+# Group by (barcode, sha1)
 groups = {}
 for s in samples:
-    img_path = os.path.join(images_dir, s['imageFileName'])
-    if os.path.exists(img_path):
-        md5 = hashlib.md5(open(img_path, 'rb').read()).hexdigest()
-    else:
-        md5 = 'missing_' + s['id']
-    key = (s.get('barcode', s.get('productId', '')), md5)
+    digest = hashes.get(s['imageFileName']) or 'missing_' + s['id']
+    key = (s.get('barcode', s.get('productId', '')), digest)
     groups.setdefault(key, []).append(s)
 
 to_keep = []